@@ -0,0 +1,428 @@
+#!/usr/bin/python3
+"""
+asyncio variant of the pusher. It shares the station plan, caches, watermarks, spool, processors and SQL with
+Pusher.py, but pushes a window through three stages connected by bounded queues:
+ - extract: bulk extracts batches of series from curw_iot, in priority order,
+ - process: quality controls and processes the extracted series on the worker threads,
+ - load:    upserts the processed series to curw_obs, one transaction per LOAD_BATCH_ROWS rows,
+so reading curw_iot, processing and writing curw_obs overlap, and a full queue holds the stages before it back.
+
+Takes the same options as Pusher.py. Requires aiomysql (pip3 install aiomysql).
+
+    python AsyncPusher.py -c CONFIG.json
+"""
+import asyncio
+import time
+import traceback
+from itertools import groupby
+
+import pymysql
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+from db_adapter.constants import CURW_OBS_HOST, CURW_OBS_PORT, CURW_OBS_USERNAME, CURW_OBS_PASSWORD, CURW_OBS_DATABASE
+from Metrics import STAGE_EVENT_ID, STAGE_EXTRACT, STAGE_PROCESS, STAGE_INSERT
+from Pusher import Pusher, main, get_restart_time, push_timeseries, ER_QUERY_TIMEOUT
+from Series import Series
+from Utils import \
+    bulk_extract_statements, \
+    extracted_series, \
+    upsert_statements, \
+    rollup_read_statements, \
+    rollup_series, \
+    rollup_steps, \
+    TimeseriesWriter
+
+# Max number of series extracted together. Smaller batches reach the load stage sooner.
+EXTRACT_BATCH_SIZE = 50
+
+# Max number of batches waiting between two stages
+QUEUE_SIZE = 4
+
+# Processed rows collected before they are written to curw_obs in one transaction
+LOAD_BATCH_ROWS = 5000
+
+# Seconds after which an idle connection is replaced instead of reused
+POOL_RECYCLE = 3600
+
+
+class _Window:
+    """
+    Progress of a window through the pipeline
+    """
+
+    def __init__(self):
+        self.missed = []
+        self.restart_times = {}
+        self.processed_count = 0
+        self.queued_rows = 0
+        self.inserted_rows = 0
+        self.skipped_rows = 0
+        self.rollup_rows = 0
+        self.failed_entries = []
+        self.failed_series = []
+
+
+def _batches(series, event_ids):
+    """
+    :return: list of (group_operation, list of Plan.SeriesPlan) of the series with an event id, in priority order
+    """
+    batches = []
+    for _, tier in groupby(series, key=lambda entry: entry.priority):
+        groups = {}
+        for entry in tier:
+            if event_ids.get(entry.obs_hash_id) is not None:
+                groups.setdefault(entry.group_operation, []).append(entry)
+        for group_operation, entries in groups.items():
+            for index in range(0, len(entries), EXTRACT_BATCH_SIZE):
+                batches.append((group_operation, entries[index:index + EXTRACT_BATCH_SIZE]))
+    return batches
+
+
+def _process(entry, timeseries, metrics):
+    """
+    Process a single timeseries. Runs inside a worker thread.
+    :return: list of (tms_id, Series, end_date) to write, or None if processing failed
+    """
+    collector = TimeseriesWriter(None)
+    if not push_timeseries(collector, entry, timeseries, metrics):
+        return None
+    return collector.series
+
+
+class AsyncPusher(Pusher):
+    """
+    Pusher whose windows are pushed through an asyncio extract/process/load pipeline using aiomysql connections.
+    Plan compilation, event id lookups, end dates and the spool replay still go through the Pusher connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if aiomysql is None:
+            raise ImportError("AsyncPusher requires aiomysql. Install it with 'pip3 install aiomysql'.")
+        self.loop = asyncio.new_event_loop()
+        self.extract_async_pool = None
+        self.extract_async_settings = None
+        self.load_async_pool = None
+        super().__init__(*args, **kwargs)
+
+    async def _open_pools(self):
+        extract_from = dict(self.plan.extract_from)
+        if self.extract_async_pool is not None and extract_from != self.extract_async_settings:
+            await self._close_pool(self.extract_async_pool)
+            self.extract_async_pool = None
+
+        if self.extract_async_pool is None:
+            # Autocommit, so connections aren't left in a transaction by their SELECTs and dropped by the pool.
+            self.extract_async_pool = await aiomysql.create_pool(
+                host=extract_from['MYSQL_HOST'], port=int(extract_from.get('MYSQL_PORT', 3306)),
+                user=extract_from['MYSQL_USER'], password=extract_from['MYSQL_PASSWORD'],
+                db=extract_from['MYSQL_DB'], maxsize=self.extract_pool_size, autocommit=True,
+                pool_recycle=POOL_RECYCLE)
+            self.extract_async_settings = extract_from
+
+        if self.load_async_pool is None:
+            self.load_async_pool = await aiomysql.create_pool(
+                host=CURW_OBS_HOST, port=int(CURW_OBS_PORT), user=CURW_OBS_USERNAME, password=CURW_OBS_PASSWORD,
+                db=CURW_OBS_DATABASE, maxsize=1, pool_recycle=POOL_RECYCLE)
+
+    @staticmethod
+    async def _close_pool(pool):
+        try:
+            pool.close()
+            await pool.wait_closed()
+        except Exception as ex:
+            print('Error occurred while closing an aiomysql pool.', ex)
+
+    def push_window(self, series, event_ids, start_datetimes, end_datetime, metrics, carry_rows=None, spool=None,
+                    watermarks=None, tail_cache=None, deadline=None):
+        """
+        See Pusher.push_window. Every tier goes through the same pipeline. Batches enter it in priority order, so the
+        most important series still reach curw_obs first.
+        """
+        return self.loop.run_until_complete(self._push_window(
+            sorted(series, key=lambda entry: entry.priority), event_ids, start_datetimes, end_datetime, metrics,
+            carry_rows, spool, watermarks, tail_cache, deadline))
+
+    async def _push_window(self, series, event_ids, start_datetimes, end_datetime, metrics, carry_rows, spool,
+                           watermarks, tail_cache, deadline):
+        await self._open_pools()
+        window = _Window()
+
+        deferred = [entry for entry in series if entry.obs_hash_id not in event_ids]
+        if len(deferred) > 0:
+            print("Deferring %d timeseries whose event id lookup overran." % len(deferred))
+            self.defer(deferred, STAGE_EVENT_ID, metrics)
+            window.missed.extend(deferred)
+        for entry in series:
+            if entry.obs_hash_id in event_ids and event_ids[entry.obs_hash_id] is None:
+                print("No timeseries for the %s of station_Id: %s in the extracting DB."
+                      % (entry.variable, entry.station_id))
+
+        extracted_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        processed_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        stages = [
+            asyncio.ensure_future(self._extract_stage(window, _batches(series, event_ids), event_ids,
+                                                      start_datetimes, end_datetime, metrics, deadline,
+                                                      extracted_queue)),
+            asyncio.ensure_future(self._process_stage(window, event_ids, start_datetimes, end_datetime, metrics,
+                                                      carry_rows, deadline, extracted_queue, processed_queue)),
+            asyncio.ensure_future(self._load_stage(window, metrics, tail_cache, processed_queue))
+        ]
+        try:
+            await asyncio.gather(*stages)
+        except Exception:
+            # A stage failed. Don't leave the others waiting on its queue.
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+
+        metrics.count('queued_rows', window.queued_rows)
+        metrics.count('inserted_rows', window.inserted_rows)
+        metrics.count('series', window.processed_count)
+        print("Inserted %d rows of %d timeseries to curw_obs." % (window.inserted_rows, window.processed_count))
+        if tail_cache is not None:
+            metrics.count('skipped_rows', window.skipped_rows)
+            print("Skipped %d rows unchanged in curw_obs." % window.skipped_rows)
+        if window.rollup_rows > 0:
+            metrics.count('rollup_rows', window.rollup_rows)
+            print("Updated %d hourly and daily rollup rows." % window.rollup_rows)
+
+        if len(window.failed_entries) > 0:
+            spooled_rows = 0
+            if spool is not None and len(window.failed_series) > 0:
+                spooled_rows = spool.append(window.failed_series)
+                metrics.count('spooled_rows', spooled_rows)
+                print("Spooled %d rows to be written on the next healthy cycle." % spooled_rows)
+            if spooled_rows <= 0:
+                for entry in window.failed_entries:
+                    window.restart_times.pop(entry.obs_hash_id, None)
+                window.missed.extend(window.failed_entries)
+
+        if watermarks is not None:
+            for obs_hash_id, restart_time in window.restart_times.items():
+                if restart_time is not None:
+                    watermarks[obs_hash_id] = restart_time
+        return window.queued_rows, window.inserted_rows, window.missed
+
+    async def _extract_stage(self, window, batches, event_ids, start_datetimes, end_datetime, metrics, deadline,
+                             out_queue):
+        try:
+            for group_operation, entries in batches:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    print("Deferring %d timeseries. The cycle deadline passed." % len(entries))
+                    self.defer(entries, STAGE_EXTRACT, metrics)
+                    window.missed.extend(entries)
+                    continue
+
+                windows = [(event_ids[entry.obs_hash_id], start_datetimes[entry.obs_hash_id]) for entry in entries]
+                statements = bulk_extract_statements(windows, end_datetime, group_operation)
+                timeout = self.query_timeout or None
+                if deadline is not None:
+                    remaining = max(0.0, deadline - time.perf_counter())
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+                try:
+                    with metrics.stage(STAGE_EXTRACT, db_calls=len(statements)):
+                        extracted = await asyncio.wait_for(self._fetch(windows, statements), timeout)
+                except asyncio.TimeoutError:
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        print("Bulk extraction of %d timeseries overran the cycle deadline." % len(entries))
+                        self.defer(entries, STAGE_EXTRACT, metrics)
+                        window.missed.extend(entries)
+                    else:
+                        print("Bulk extraction of %d timeseries overran the query timeout." % len(entries))
+                    continue
+                except Exception as ex:
+                    print("Error occurred while bulk extracting %d timeseries." % len(entries), ex)
+                    continue
+
+                await out_queue.put((entries, extracted))
+        finally:
+            await out_queue.put(None)
+
+    async def _fetch(self, windows, statements):
+        """
+        Run bulk extraction statements on a curw_iot connection. A connection error is retried once on a new one.
+        :return: dict of event_id -> Series
+        """
+        for attempt in (1, 2):
+            timeseries = {event_id: Series() for event_id, _ in windows}
+            try:
+                async with self.extract_async_pool.acquire() as connection:
+                    try:
+                        async with connection.cursor() as cursor:
+                            for sql_statement, params in statements:
+                                await cursor.execute(sql_statement, params)
+                                timeseries.update(extracted_series(await cursor.fetchall()))
+                    except asyncio.CancelledError:
+                        # Stopped mid query. The connection can't be reused.
+                        connection.close()
+                        raise
+                return timeseries
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as ex:
+                if attempt > 1 or (ex.args and ex.args[0] == ER_QUERY_TIMEOUT):
+                    raise
+                print('Lost the curw_iot connection. Retrying on a new one.', ex)
+
+    async def _process_stage(self, window, event_ids, start_datetimes, end_datetime, metrics, carry_rows, deadline,
+                             in_queue, out_queue):
+        job_timeout = self.job_timeout if deadline is not None else None
+        try:
+            while True:
+                item = await in_queue.get()
+                if item is None:
+                    break
+                entries, extracted = item
+
+                jobs = []
+                restart_times = {}
+                for entry in entries:
+                    event_id = event_ids[entry.obs_hash_id]
+                    timeseries = extracted[event_id]
+                    restart_times[entry.obs_hash_id] = get_restart_time(entry, timeseries)
+                    metrics.record(STAGE_EXTRACT, 0.0, rows=len(timeseries), station=entry.station_name,
+                                   variable=entry.variable)
+                    if carry_rows is not None and entry.variable == 'Precipitation':
+                        if event_id in carry_rows:
+                            timeseries = Series.concat([carry_rows[event_id], timeseries])
+                        if len(timeseries) > 0:
+                            carry_rows[event_id] = timeseries.tail()
+
+                    print("**************** Station: %s, variable: %s, start_date: %s, end_date: %s **************"
+                          % (entry.station_name, entry.variable, start_datetimes[entry.obs_hash_id], end_datetime))
+
+                    timeout = job_timeout
+                    if deadline is not None:
+                        timeout = min(timeout, max(0.0, deadline - time.perf_counter()))
+                    jobs.append(asyncio.wait_for(
+                        self.loop.run_in_executor(self.executor, _process, entry, timeseries, metrics), timeout))
+
+                results = await asyncio.gather(*jobs, return_exceptions=True)
+                processed = []
+                for entry, result in zip(entries, results):
+                    if isinstance(result, asyncio.TimeoutError):
+                        print("Deferring the %s of station %s. Processing it overran."
+                              % (entry.variable, entry.station_name))
+                        self.defer([entry], STAGE_PROCESS, metrics)
+                        window.missed.append(entry)
+                        continue
+
+                    window.processed_count += 1
+                    if isinstance(result, Exception):
+                        print("Error occurred while pushing %s of station %s." % (entry.variable, entry.station_name),
+                              result)
+                        result = None
+                    processed.append((entry, restart_times[entry.obs_hash_id] if result is not None else None,
+                                      result or []))
+
+                await out_queue.put(processed)
+        finally:
+            await out_queue.put(None)
+
+    async def _load_stage(self, window, metrics, tail_cache, in_queue):
+        pending = []
+        pending_rows = 0
+        while True:
+            item = await in_queue.get()
+            if item is None:
+                break
+            pending.extend(item)
+            pending_rows += sum(len(rows) for _, _, series in item for _, rows, _ in series)
+            if pending_rows >= LOAD_BATCH_ROWS:
+                await self._load(window, pending, metrics, tail_cache)
+                pending = []
+                pending_rows = 0
+
+        if len(pending) > 0:
+            await self._load(window, pending, metrics, tail_cache)
+
+    async def _load(self, window, processed, metrics, tail_cache):
+        """
+        Write processed series to curw_obs in one transaction
+        :param processed: list of (Plan.SeriesPlan, restart time, list of (tms_id, Series, end_date))
+        """
+        series = [item for _, _, entry_series in processed for item in entry_series]
+        row_count = sum(len(rows) for _, rows, _ in series)
+        window.queued_rows += row_count
+        written_series = series
+        if tail_cache is not None and row_count > 0:
+            written_series, skipped_rows = tail_cache.diff(series)
+            row_count -= skipped_rows
+            window.skipped_rows += skipped_rows
+
+        statements = upsert_statements(written_series, row_count)
+        if len(statements) > 0:
+            with metrics.stage(STAGE_INSERT, db_calls=len(statements)) as counts:
+                written = await self._write(window, statements, row_count, written_series)
+                counts['rows'] = row_count if written else 0
+            if written:
+                window.inserted_rows += row_count
+                if tail_cache is not None:
+                    tail_cache.update(written_series)
+            else:
+                window.failed_entries.extend(entry for entry, _, _ in processed)
+                window.failed_series.extend(series)
+
+        for entry, restart_time, _ in processed:
+            window.restart_times[entry.obs_hash_id] = restart_time
+
+    async def _write(self, window, statements, row_count, written_series):
+        """
+        Run the upserts of the written series, then recompute the rollup buckets they touched, in one transaction
+        :return: True if the statements were committed
+        """
+        try:
+            async with self.load_async_pool.acquire() as connection:
+                try:
+                    async with connection.cursor() as cursor:
+                        for sql_statement, params in statements:
+                            await cursor.execute(sql_statement, params)
+                        rollup_rows = await self._write_rollups(cursor, written_series)
+                    await connection.commit()
+                    window.rollup_rows += rollup_rows
+                    return True
+                except Exception:
+                    await connection.rollback()
+                    raise
+        except Exception:
+            traceback.print_exc()
+            print("Exception occurred while pushing {} rows of {} timeseries to curw_obs"
+                  .format(row_count, len(written_series)))
+            return False
+
+    async def _write_rollups(self, cursor, written_series):
+        """
+        See Utils.TimeseriesWriter._write_rollups
+        :return: number of rollup rows written
+        """
+        if not self.rollups:
+            return 0
+
+        row_count = 0
+        series = written_series
+        for step in rollup_steps(self.rollups):
+            stored = {}
+            for sql_statement, params in rollup_read_statements(series, step):
+                await cursor.execute(sql_statement, params)
+                stored.update(extracted_series(await cursor.fetchall()))
+
+            series = rollup_series(series, step, stored)
+            step_rows = sum(len(rows) for _, rows, _ in series)
+            for sql_statement, params in upsert_statements(series, step_rows):
+                await cursor.execute(sql_statement, params)
+            row_count += step_rows
+        return row_count
+
+    def close(self):
+        for pool in (self.extract_async_pool, self.load_async_pool):
+            if pool is not None:
+                self.loop.run_until_complete(self._close_pool(pool))
+        self.loop.close()
+        return super().close()
+
+
+if __name__ == '__main__':
+    main(AsyncPusher)
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+
+# Stages of a pusher cycle
+STAGE_HASH_ID = 'hash_id'
+STAGE_END_DATE = 'end_date'
+STAGE_EVENT_ID = 'event_id'
+STAGE_EXTRACT = 'extract'
+STAGE_PROCESS = 'process'
+# Rows of the quality control stage are the rows it dropped
+STAGE_QC = 'qc'
+STAGE_INSERT = 'insert'
+
+# Series key of the stages which work on all the series at once (bulk queries)
+ALL_SERIES = ('*', '*')
+
+
+class CycleMetrics:
+    """
+    Wall time, row counts and DB call counts of each stage of a pusher cycle, per station and variable.
+    Stages working on all the series at once are recorded against ALL_SERIES.
+    Thread safe, so worker threads can record into the same instance.
+    """
+
+    def __init__(self, mode='cycle'):
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.started_perf = time.perf_counter()
+        self.duration = None
+        self.series = {}
+        self.counters = {}
+        self.missed = []
+
+    def record(self, stage, seconds, rows=0, db_calls=0, station=None, variable=None):
+        """
+        :param stage: str: one of the STAGE_* constants
+        :param seconds: float: wall time spent
+        :param rows: int: rows handled by the stage
+        :param db_calls: int: database round trips made by the stage
+        :param station: str: station name. None for stages working on all the series.
+        :param variable: str: variable name. None for stages working on all the series.
+        """
+        key = ALL_SERIES if station is None else (station, variable)
+        with self.lock:
+            stages = self.series.setdefault(key, {})
+            totals = stages.setdefault(stage, {'seconds': 0.0, 'rows': 0, 'db_calls': 0})
+            totals['seconds'] += seconds
+            totals['rows'] += rows
+            totals['db_calls'] += db_calls
+
+    @contextmanager
+    def stage(self, stage, db_calls=0, station=None, variable=None):
+        """
+        Time a block as a stage. Yields a dict whose 'rows' and 'db_calls' can be set inside the block.
+        """
+        counts = {'rows': 0, 'db_calls': db_calls}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.record(stage, time.perf_counter() - start, rows=counts['rows'], db_calls=counts['db_calls'],
+                        station=station, variable=variable)
+
+    def miss(self, station, variable, stage):
+        """
+        Record a series which overran its job timeout or the cycle deadline at a stage, and was deferred to the
+        next cycle
+        """
+        with self.lock:
+            self.missed.append({'station': station, 'variable': variable, 'stage': stage})
+            self.counters['deferred_series'] = self.counters.get('deferred_series', 0) + 1
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started_perf
+
+    def summary(self):
+        """
+        :return: dict: machine readable summary of the cycle
+        """
+        with self.lock:
+            stage_totals = {}
+            series = []
+            for (station, variable), stages in sorted(self.series.items()):
+                for stage, totals in stages.items():
+                    stage_total = stage_totals.setdefault(stage, {'seconds': 0.0, 'rows': 0, 'db_calls': 0})
+                    for field, value in totals.items():
+                        stage_total[field] += value
+                if (station, variable) != ALL_SERIES:
+                    series.append({
+                        'station': station,
+                        'variable': variable,
+                        'seconds': round(sum(totals['seconds'] for totals in stages.values()), 6),
+                        'stages': stages
+                    })
+
+            duration = self.duration if self.duration is not None else time.perf_counter() - self.started_perf
+            return {
+                'mode': self.mode,
+                'started_at': datetime.fromtimestamp(self.started_at).strftime('%Y-%m-%d %H:%M:%S'),
+                'duration_seconds': round(duration, 6),
+                'stages': stage_totals,
+                'counters': dict(self.counters),
+                'missed_deadline': list(self.missed),
+                'series': series
+            }
+
+    def write_json_lines(self, path, per_series=False):
+        """
+        Append the cycle summary as a single json line
+        :param per_series: bool: also include the stages of every series. Makes each line grow with the series count
+        (about 90 KB for 67 stations), so the file should be rotated.
+        """
+        summary = self.summary()
+        if not per_series:
+            del summary['series']
+        try:
+            with open(path, 'a') as metrics_file:
+                metrics_file.write(json.dumps(summary, sort_keys=True) + '\n')
+        except Exception:
+            traceback.print_exc()
+            print("Exception occurred while writing cycle metrics to {}".format(path))
+
+    def write_prometheus(self, path):
+        """
+        Write the cycle summary as a Prometheus textfile (node_exporter textfile collector format).
+        The file is replaced atomically.
+        """
+        summary = self.summary()
+        lines = [
+            '# HELP pusher_cycle_duration_seconds Wall time of the last pusher cycle.',
+            '# TYPE pusher_cycle_duration_seconds gauge',
+            'pusher_cycle_duration_seconds{mode="%s"} %f' % (_escape(self.mode), summary['duration_seconds']),
+            '# HELP pusher_cycle_timestamp_seconds Start time of the last pusher cycle.',
+            '# TYPE pusher_cycle_timestamp_seconds gauge',
+            'pusher_cycle_timestamp_seconds{mode="%s"} %f' % (_escape(self.mode), self.started_at)
+        ]
+
+        lines.append('# HELP pusher_cycle_counter Counters of the last pusher cycle.')
+        lines.append('# TYPE pusher_cycle_counter gauge')
+        for counter, value in sorted(summary['counters'].items()):
+            lines.append('pusher_cycle_counter{counter="%s"} %d' % (_escape(counter), value))
+
+        lines.append('# HELP pusher_series_missed_deadline Series deferred to the next cycle by the last pusher cycle.')
+        lines.append('# TYPE pusher_series_missed_deadline gauge')
+        for missed in summary['missed_deadline']:
+            lines.append('pusher_series_missed_deadline{station="%s",variable="%s",stage="%s"} 1'
+                         % (_escape(missed['station']), _escape(missed['variable']), _escape(missed['stage'])))
+
+        for field, help_text in (('seconds', 'Wall time'), ('rows', 'Row count'), ('db_calls', 'DB call count')):
+            metric = 'pusher_stage_%s' % field
+            lines.append('# HELP %s %s of each stage of the last pusher cycle.' % (metric, help_text))
+            lines.append('# TYPE %s gauge' % metric)
+            for stage, totals in sorted(summary['stages'].items()):
+                lines.append('%s{stage="%s"} %s' % (metric, _escape(stage), _format(totals[field])))
+
+        for field, help_text in (('seconds', 'Wall time'), ('rows', 'Row count'), ('db_calls', 'DB call count')):
+            metric = 'pusher_series_%s' % field
+            lines.append('# HELP %s %s of each series and stage of the last pusher cycle.' % (metric, help_text))
+            lines.append('# TYPE %s gauge' % metric)
+            for series in summary['series']:
+                for stage, totals in sorted(series['stages'].items()):
+                    lines.append('%s{station="%s",variable="%s",stage="%s"} %s'
+                                 % (metric, _escape(series['station']), _escape(series['variable']),
+                                    _escape(stage), _format(totals[field])))
+
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as prometheus_file:
+                prometheus_file.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, path)
+        except Exception:
+            traceback.print_exc()
+            print("Exception occurred while writing cycle metrics to {}".format(path))
+
+
+def _escape(label_value):
+    return str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%f' % value
+    return str(value)
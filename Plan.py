@@ -0,0 +1,353 @@
+import hashlib
+import json
+import os
+import traceback
+from collections import namedtuple
+from types import MappingProxyType
+
+from Scheduler import variable_priority
+from Utils import \
+    VARIABLE_REGISTRY, \
+    ROLLUP_REGISTRY, \
+    get_rollup_meta, \
+    get_timeseries_meta, \
+    curw_obs_hash_id_key, \
+    load_hash_id_cache, \
+    save_hash_id_cache, \
+    resolve_curw_obs_hash_ids
+
+# One (station, variable) timeseries to push, with everything needed to extract, process and insert it prebuilt.
+SeriesPlan = namedtuple('SeriesPlan', [
+    'station_id',         # str: stationId of the station
+    'station_name',       # str: name of the station
+    'variable',           # str: e.g. "Precipitation"
+    'unit',               # str: curw_obs unit, e.g. "mm"
+    'unit_type',          # str: curw_obs unit type, e.g. "Accumulative"
+    'obs_hash_id',        # str: curw_obs timeseries (hash) id
+    'timeseries_meta',    # read only dict: event metadata of the timeseries in the extracting DB
+    'group_operation',    # TimeseriesGroupOperation: 5 minute grouping applied while extracting
+    'processor',          # function: timeseries processor, or None
+    'processor_kwargs',   # read only dict: keyword arguments of the processor
+    'min_value',          # float: quality control lower bound of the extracted values, or None
+    'max_value',          # float: quality control upper bound of the extracted values, or None
+    'priority',           # int: scheduling priority. Lower runs first.
+    'rollups'             # tuple of RollupPlan: rollup series maintained from this series. Empty if none.
+])
+
+# One rollup series derived from a SeriesPlan
+RollupPlan = namedtuple('RollupPlan', [
+    'bucket_seconds',     # int: bucket length, e.g. 3600
+    'aggregate',          # str: 'Sum' | 'Mean' | 'Max'
+    'obs_hash_id'         # str: curw_obs timeseries (hash) id of the rollup series
+])
+
+# Bumped whenever SeriesPlan or the way it is compiled changes, so plans cached by an older version are recompiled
+PLAN_FORMAT_VERSION = 6
+
+# Compiled config: flat, immutable list of series, ordered by priority, plus the extracting DB settings.
+StationPlan = namedtuple('StationPlan', [
+    'config_hash',        # str: sha256 of the config file the plan was compiled from
+    'config_mtime',       # float: mtime of the config file
+    'extract_from',       # read only dict: extracting DB settings
+    'entries',            # tuple of SeriesPlan
+    'complete'            # bool: False if some hash ids couldn't be resolved. Incomplete plans are not cached.
+])
+
+
+def validate_station(station):
+    """
+    :param station: station config
+    :return: list of problems in the station config which leave none of its variables usable. Empty if the station is
+    valid. Problems of single variables are found by validate_variables.
+    """
+    errors = []
+    for key in ('stationId', 'name', 'station_meta', 'source', 'type', 'run_name', 'variables', 'units',
+                'unit_type'):
+        if key not in station:
+            errors.append("missing '%s'" % key)
+    if errors:
+        return errors
+
+    try:
+        float(station['station_meta'][2])
+        float(station['station_meta'][3])
+    except (IndexError, TypeError, ValueError):
+        errors.append("station_meta should hold the latitude and longitude at indices 2 and 3")
+
+    variables = station['variables']
+    if not isinstance(variables, list) or not len(variables) > 0:
+        errors.append("variable list is not valid: %s" % variables)
+        return errors
+
+    if len(station['units']) != len(variables) or len(station['unit_type']) != len(variables):
+        errors.append("variables, units and unit_type should have the same length")
+
+    return errors
+
+
+def validate_variables(station):
+    """
+    :param station: station config which passed validate_station
+    :return: dict of variable index -> problem, of the variables which can't be pushed. The station's other variables
+    are still pushed.
+    """
+    errors = {}
+    seen = set()
+    for index, variable in enumerate(station['variables']):
+        spec = VARIABLE_REGISTRY.get(variable)
+        if variable in seen:
+            errors[index] = "duplicate variable: %s" % variable
+        elif spec is None:
+            errors[index] = "unknown variable type: %s" % variable
+        elif spec.processor_kwargs is not None:
+            try:
+                kwargs = spec.processor_kwargs(station)
+                if 'mean_sea_level' in kwargs and not isinstance(kwargs['mean_sea_level'], (float, int)):
+                    errors[index] = "invalid mean_sea_level. Should be a real number."
+            except (AttributeError, KeyError) as ex:
+                errors[index] = "%s processor settings are not valid: %s" % (variable, ex)
+        seen.add(variable)
+
+    return errors
+
+
+def parse_bounds(station, index):
+    """
+    Quality control bounds of a station variable from the station's max_values/min_values. Bounds only apply to
+    instantaneous values which are pushed as extracted. Accumulative values are quality controlled by their processor
+    after differencing, and processed values (e.g. water levels, bounded by min_wl/max_wl) by their processor, as the
+    extracted readings aren't on the scale of the configured bounds.
+    :param station: station config
+    :param index: int: index of the variable in the station's variable list
+    :return: (min_value, max_value). A bound is None if it isn't configured.
+    """
+    if station['unit_type'][index] != 'Instantaneous' or \
+            VARIABLE_REGISTRY[station['variables'][index]].processor is not None:
+        return None, None
+
+    bounds = []
+    for key in ('min_values', 'max_values'):
+        try:
+            bounds.append(float(station[key][index]))
+        except (KeyError, IndexError, TypeError, ValueError):
+            if key in station:
+                print("Ignoring invalid %s of the %s of station %s." % (key, station['variables'][index],
+                                                                        station['name']))
+            bounds.append(None)
+    return tuple(bounds)
+
+
+def compile_station_plan(pool, config_content, config_mtime, hash_id_cache_path, metrics=None):
+    """
+    Validate the station lists of a config and compile them into a station plan. Hash ids are resolved through the
+    hash id cache, so only series missing from it hit curw_obs.
+    :param pool: curw_obs database connection pool
+    :param config_content: bytes: content of the config file
+    :param config_mtime: float: mtime of the config file
+    :param hash_id_cache_path: str: path of the hash id cache
+    :param metrics: Metrics.CycleMetrics
+    :return: StationPlan
+    """
+    config_hash = hashlib.sha256(config_content).hexdigest()
+    CONFIG = json.loads(config_content.decode())
+
+    # (station config, indices of the variables skipped)
+    stations = []
+    for station in CONFIG['weather_stations'] + CONFIG['water_level_stations']:
+        errors = validate_station(station)
+        if errors:
+            print("Skipping station %s. %s" % (station.get('name', station.get('stationId')), '; '.join(errors)))
+            continue
+        variable_errors = validate_variables(station)
+        if len(variable_errors) >= len(station['variables']):
+            print("Skipping station %s. %s" % (station['name'], '; '.join(variable_errors.values())))
+            continue
+        for index, error in sorted(variable_errors.items()):
+            print("Skipping the %s of station %s. %s" % (station['variables'][index], station['name'], error))
+        stations.append((station, set(variable_errors)))
+
+    rollup_variables = []
+    for variable in CONFIG.get('rollups', []):
+        if variable in ROLLUP_REGISTRY:
+            rollup_variables.append(variable)
+        else:
+            print("Ignoring rollups of %s. Rollups are only maintained for %s."
+                  % (variable, ', '.join(sorted(ROLLUP_REGISTRY))))
+
+    # Only the hash ids of the valid variables are resolved, so no curw_obs run is created for the skipped ones.
+    valid_stations = []
+    for station, skipped in stations:
+        indices = [index for index in range(len(station['variables'])) if index not in skipped]
+        valid_stations.append(dict(station, **{key: [station[key][index] for index in indices]
+                                               for key in ('variables', 'units', 'unit_type')}))
+
+    hash_ids = load_hash_id_cache(hash_id_cache_path, config_hash)
+    resolved_count = resolve_curw_obs_hash_ids(pool, valid_stations, hash_ids, metrics, rollup_variables)
+    if resolved_count > 0:
+        print("Resolved %d curw_obs hash ids from the database." % resolved_count)
+        save_hash_id_cache(hash_id_cache_path, config_hash, hash_ids)
+
+    entries = []
+    complete = True
+    for station, skipped in stations:
+        latitude = station['station_meta'][2]
+        longitude = station['station_meta'][3]
+
+        for index, (variable, unit, unit_type) in enumerate(zip(station['variables'], station['units'],
+                                                                 station['unit_type'])):
+            if index in skipped:
+                continue
+            obs_hash_id = hash_ids.get(curw_obs_hash_id_key(variable, unit, unit_type, latitude, longitude))
+            if obs_hash_id is None:
+                print("No curw_obs hash id for the %s of station %s." % (variable, station['name']))
+                complete = False
+                continue
+
+            rollups = []
+            if variable in rollup_variables:
+                for bucket_seconds, aggregate, rollup_variable, rollup_unit_type, station_type in \
+                        get_rollup_meta(variable):
+                    rollup_hash_id = hash_ids.get(curw_obs_hash_id_key(rollup_variable, unit, rollup_unit_type,
+                                                                       latitude, longitude, station_type))
+                    if rollup_hash_id is None:
+                        print("No curw_obs hash id for the %s of station %s." % (rollup_variable, station['name']))
+                        complete = False
+                        continue
+                    rollups.append(RollupPlan(bucket_seconds, aggregate, rollup_hash_id))
+
+            spec = VARIABLE_REGISTRY[variable]
+            processor_kwargs = spec.processor_kwargs(station) if spec.processor_kwargs is not None else {}
+            min_value, max_value = parse_bounds(station, index)
+            entries.append(SeriesPlan(
+                station_id=station['stationId'],
+                station_name=station['name'],
+                variable=variable,
+                unit=unit,
+                unit_type=unit_type,
+                obs_hash_id=obs_hash_id,
+                timeseries_meta=MappingProxyType(get_timeseries_meta(station, variable)),
+                group_operation=spec.group_operation,
+                processor=spec.processor,
+                processor_kwargs=MappingProxyType(processor_kwargs),
+                min_value=min_value,
+                max_value=max_value,
+                priority=variable_priority(variable, CONFIG.get('variable_priorities')),
+                rollups=tuple(rollups)))
+
+    entries.sort(key=lambda entry: entry.priority)
+    print("Compiled station plan with %d timeseries of %d stations." % (len(entries), len(stations)))
+    return StationPlan(config_hash=config_hash, config_mtime=config_mtime,
+                       extract_from=MappingProxyType(CONFIG['extract_from']), entries=tuple(entries),
+                       complete=complete)
+
+
+def _entry_to_json(entry):
+    return {
+        'station_id': entry.station_id,
+        'station_name': entry.station_name,
+        'variable': entry.variable,
+        'unit': entry.unit,
+        'unit_type': entry.unit_type,
+        'obs_hash_id': entry.obs_hash_id,
+        'timeseries_meta': dict(entry.timeseries_meta),
+        'processor_kwargs': dict(entry.processor_kwargs),
+        'min_value': entry.min_value,
+        'max_value': entry.max_value,
+        'priority': entry.priority,
+        'rollups': [list(rollup) for rollup in entry.rollups]
+    }
+
+
+def _entry_from_json(entry):
+    # Group operation and processor are looked up from the variable registry.
+    spec = VARIABLE_REGISTRY[entry['variable']]
+    return SeriesPlan(
+        station_id=entry['station_id'],
+        station_name=entry['station_name'],
+        variable=entry['variable'],
+        unit=entry['unit'],
+        unit_type=entry['unit_type'],
+        obs_hash_id=entry['obs_hash_id'],
+        timeseries_meta=MappingProxyType(entry['timeseries_meta']),
+        group_operation=spec.group_operation,
+        processor=spec.processor,
+        processor_kwargs=MappingProxyType(entry['processor_kwargs']),
+        min_value=entry['min_value'],
+        max_value=entry['max_value'],
+        priority=entry['priority'],
+        rollups=tuple(RollupPlan(*rollup) for rollup in entry['rollups']))
+
+
+def save_station_plan(plan_cache_path, plan):
+
+    try:
+        tmp_path = plan_cache_path + '.tmp'
+        with open(tmp_path, 'w') as plan_file:
+            json.dump({
+                'format_version': PLAN_FORMAT_VERSION,
+                'config_hash': plan.config_hash,
+                'config_mtime': plan.config_mtime,
+                'extract_from': dict(plan.extract_from),
+                'entries': [_entry_to_json(entry) for entry in plan.entries]
+            }, plan_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, plan_cache_path)
+    except Exception:
+        traceback.print_exc()
+        print("Exception occurred while saving station plan {}.".format(plan_cache_path))
+
+
+def read_station_plan(plan_cache_path):
+    """
+    :return: StationPlan cached at plan_cache_path, or None
+    """
+    if not os.path.exists(plan_cache_path):
+        return None
+
+    try:
+        with open(plan_cache_path) as plan_file:
+            cached = json.load(plan_file)
+        if cached.get('format_version') != PLAN_FORMAT_VERSION:
+            return None
+        return StationPlan(config_hash=cached['config_hash'], config_mtime=cached['config_mtime'],
+                           extract_from=MappingProxyType(cached['extract_from']),
+                           entries=tuple(_entry_from_json(entry) for entry in cached['entries']),
+                           complete=True)
+    except Exception:
+        traceback.print_exc()
+        print("Exception occurred while reading station plan {}. Ignoring it.".format(plan_cache_path))
+        return None
+
+
+def load_station_plan(pool, config_path, plan_cache_path, hash_id_cache_path, current_plan=None, metrics=None):
+    """
+    Get the station plan of a config file. The plan is only recompiled when the config file changed (mtime, then
+    sha256) since the current or the cached plan was compiled.
+    :param pool: curw_obs database connection pool
+    :param config_path: str: path of the config file
+    :param plan_cache_path: str: path of the on-disk plan cache
+    :param hash_id_cache_path: str: path of the hash id cache
+    :param current_plan: StationPlan already in memory (daemon mode), if any
+    :param metrics: Metrics.CycleMetrics
+    :return: StationPlan
+    """
+    config_mtime = os.stat(config_path).st_mtime
+    if current_plan is not None and current_plan.complete and current_plan.config_mtime == config_mtime:
+        return current_plan
+
+    cached_plan = read_station_plan(plan_cache_path)
+    if cached_plan is not None and cached_plan.config_mtime == config_mtime:
+        return cached_plan
+
+    config_content = open(config_path, 'rb').read()
+    config_hash = hashlib.sha256(config_content).hexdigest()
+    for plan in (current_plan, cached_plan):
+        if plan is not None and plan.complete and plan.config_hash == config_hash:
+            # Touched but unchanged config
+            plan = plan._replace(config_mtime=config_mtime)
+            save_station_plan(plan_cache_path, plan)
+            return plan
+
+    plan = compile_station_plan(pool, config_content, config_mtime, hash_id_cache_path, metrics)
+    if plan.complete:
+        save_station_plan(plan_cache_path, plan)
+    return plan
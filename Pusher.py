@@ -1,156 +1,1150 @@
 #!/usr/bin/python3
 
 import argparse
+import fcntl
 import json
+import math
 import os
+import queue
+import resource
+import signal
+import sys
+import threading
+import time
+
+# Wall time of the third party and project imports below, reported by --profile-startup
+_IMPORTS_STARTED = time.perf_counter()
+
+import pymysql
 import pytz
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
+from itertools import groupby
 
 from curwmysqladapter import MySQLAdapter, Station
 from db_adapter.constants import CURW_OBS_HOST, CURW_OBS_PORT, CURW_OBS_USERNAME, CURW_OBS_PASSWORD, CURW_OBS_DATABASE
 from db_adapter.base import get_Pool, destroy_Pool
-from db_adapter.curw_obs.timeseries import Timeseries
+from Metrics import CycleMetrics, STAGE_END_DATE, STAGE_EVENT_ID, STAGE_EXTRACT, STAGE_PROCESS, STAGE_INSERT
+from Plan import load_station_plan
+from Scheduler import run_jobs
+from Series import Series
+from Sharding import ShardLeases, DEFAULT_LEASE_SECONDS
+from Spool import WriteSpool
 from Utils import \
-    generate_curw_obs_hash_id, \
-    extract_n_push_precipitation, \
-    extract_n_push_temperature, \
-    extract_n_push_windspeed, \
-    extract_n_push_windgust, \
-    extract_n_push_humidity, \
-    extract_n_push_solarradiation, \
-    extract_n_push_winddirection, \
-    extract_n_push_waterlevel, \
-    extract_n_push_pressure
+    get_end_dates, \
+    extract_grouped_time_series_bulk, \
+    _extract_n_push, \
+    stream_extracted_rows, \
+    stream_series, \
+    TimeseriesWriter, \
+    ChunkedWriter, \
+    TailCache, \
+    EventIdCache, \
+    get_curw_iot_event_id, \
+    get_existing_event_ids, \
+    BULK_EXTRACT_BATCH_SIZE, \
+    UPSERT_BATCH_SIZE, \
+    STREAM_CHUNK_ROWS
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORTS_STARTED
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+COMMON_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+COMMON_DATE_FORMATSTRT = '%Y-%m-%d %H:%M:00'
+COMMON_DATE_FORMATEND = '%Y-%m-%d %H:%M:00'
+
+DEFAULT_WORKERS = 4
+DEFAULT_INTERVAL = 300
+DEFAULT_CHUNK_HOURS = 24
+HASH_ID_CACHE_FILE = '.curw_obs_hash_ids.json'
+STATION_PLAN_FILE = '.station_plan.json'
+BACKFILL_CHECKPOINT_FILE = '.backfill_checkpoint.json'
+WRITE_SPOOL_FILE = '.write_spool.jsonl'
+WATERMARK_FILE = '.watermarks.json'
+TAIL_CACHE_FILE = '.tail_cache.json'
+EVENT_ID_CACHE_FILE = '.curw_iot_event_ids.json'
+DEFAULT_RECONCILE_INTERVAL = 3600
+DEFAULT_RECONCILE_MINUTES = 180
+DEFAULT_JOB_TIMEOUT = 60
+DEFAULT_CYCLE_DEADLINE = 240
+DEFAULT_QUERY_TIMEOUT = 300
+DEFAULT_EVENT_ID_TTL = 24 * 3600
+DEFAULT_EVENT_ID_NEGATIVE_TTL = 3600
+
+# MySQL error of a query stopped by MAX_EXECUTION_TIME
+ER_QUERY_TIMEOUT = 3024
+LOCK_FILE = '.pusher.lock'
+# Backfills take their own lock: they don't touch the watermarks or the spool, so live cycles keep running alongside.
+BACKFILL_LOCK_FILE = '.pusher_backfill.lock'
+METRICS_FILE = 'pusher_metrics.jsonl'
+PROMETHEUS_FILE = 'pusher.prom'
+
 
 def utc_to_sl(utc_dt):
     sl_timezone = pytz.timezone('Asia/Colombo')
     return utc_dt.replace(tzinfo=pytz.utc).astimezone(tz=sl_timezone)
 
-try:
-    pool = get_Pool(host=CURW_OBS_HOST, port=CURW_OBS_PORT, user=CURW_OBS_USERNAME, password=CURW_OBS_PASSWORD, db=CURW_OBS_DATABASE)
-    ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
-    COMMON_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
-    COMMON_DATE_FORMATSTRT = '%Y-%m-%d %H:%M:00'
-    COMMON_DATE_FORMATEND = '%Y-%m-%d %H:%M:00'
-    forceInsert = False
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-c', '--config',
-                        help='Configuration file that includes db configs and stations. Default is ./CONFIG.json.')
-    parser.add_argument('-f', '--force', action='store_true', help='Enables force insert.')
-    args = parser.parse_args()
-
-    print('\n\nCommandline Options:', args)
-
-    if args.config:
-        CONFIG = json.loads(open(os.path.join(ROOT_DIR, args.config)).read())
-    else:
-        CONFIG = json.loads(open(os.path.join(ROOT_DIR, './CONFIG.json')).read())
-    forceInsert = args.force
-
-    weather_stations = CONFIG['weather_stations']
-    water_level_stations = CONFIG['water_level_stations']
-    stations = weather_stations + water_level_stations
-
-
-    extract_from_db = CONFIG['extract_from']
-
-    extract_adapter = MySQLAdapter(
-        host=extract_from_db['MYSQL_HOST'],
-        user=extract_from_db['MYSQL_USER'],
-        password=extract_from_db['MYSQL_PASSWORD'],
-        db=extract_from_db['MYSQL_DB'])
-
-    # Prepare start and date times.
-    now_date = utc_to_sl(datetime.now())
-    # now_date = datetime.now()
-    start_datetime_obj = now_date - timedelta(minutes=30)
-    end_datetime_obj = now_date
-
-    start_datetime = start_datetime_obj.strftime(COMMON_DATE_FORMATSTRT)
-    end_datetime = end_datetime_obj.strftime(COMMON_DATE_FORMATEND)
-
-    # start_datetime = '2018-07-04 00:00:00'
-    # end_datetime = '2018-07-31 00:00:00'
-
-    for station in stations:
-        print("**************** Station: %s, start_date: %s, end_date: %s **************"
-              % (station['name'], start_datetime, end_datetime))
-
-        variables = station['variables']
-        if not isinstance(variables, list) or not len(variables) > 0:
-            print("Station's variable list is not valid.", variables)
-            continue
-
-        station_name = station['name']
-        latitude = station['station_meta'][2]
-        longitude = station['station_meta'][3]
-        units = station['units']
-        unit_types = station['unit_type']
-        description = station['description']
-
-        for variable, unit, unit_type in zip(variables, units, unit_types):
-
-            obs_hash_id = generate_curw_obs_hash_id(pool, variable=variable, unit=unit, unit_type=unit_type,
-                                                    latitude=latitude, longitude=longitude, station_name=station_name, description=description)
-            TS = Timeseries(pool=pool)
-            prev_end_date = TS.get_end_date(obs_hash_id)
-
-            if prev_end_date is not None:
-                start_datetime = (prev_end_date - timedelta(minutes=30)).strftime(COMMON_DATE_FORMAT)
-            if variable == 'Precipitation':
-                try:
-                    extract_n_push_precipitation(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing precipitation.", ex)
-            elif variable == 'Temperature':
-                try:
-                    extract_n_push_temperature(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing temperature.", ex)
-            elif variable == 'WindSpeed':
-                try:
-                    extract_n_push_windspeed(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing wind-speed.", ex)
-            elif variable == 'WindGust':
-                try:
-                    extract_n_push_windgust(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing wind-gust.", ex)
-            elif variable == 'Humidity':
+
+class ExtractAdapterPool:
+    """
+    Pool of MySQLAdapters (curw_iot connections) shared by the worker threads. MySQLAdapter wraps a single
+    connection which can't be used by two threads at once, so an adapter is checked out for the duration of a call.
+    Idle adapters are pinged before reuse and replaced if the connection dropped, and a call failing with a
+    connection error is retried once on a fresh adapter.
+    """
+
+    def __init__(self, extract_from_db, size=DEFAULT_WORKERS, query_timeout=DEFAULT_QUERY_TIMEOUT):
+        self.extract_from_db = extract_from_db
+        self.query_timeout = query_timeout
+        self.slots = threading.BoundedSemaphore(max(1, size))
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.adapters = []
+        self.session_timeout_supported = True
+
+    def _connect(self):
+        adapter = MySQLAdapter(
+            host=self.extract_from_db['MYSQL_HOST'],
+            user=self.extract_from_db['MYSQL_USER'],
+            password=self.extract_from_db['MYSQL_PASSWORD'],
+            db=self.extract_from_db['MYSQL_DB'])
+        # Autocommit, so a connection reused across cycles doesn't keep reading the snapshot of its first SELECT
+        # (REPEATABLE READ) and miss the rows curw_iot received since.
+        adapter.connection.autocommit(True)
+        if self.query_timeout and self.session_timeout_supported:
+            # Server side limit of every SELECT on this connection (MySQL 5.7.8+)
+            try:
+                self._set_query_timeout(adapter, self.query_timeout)
+            except Exception as ex:
+                print('curw_iot does not support MAX_EXECUTION_TIME. Queries run without a timeout.', ex)
+                self.session_timeout_supported = False
+        with self.lock:
+            self.adapters.append(adapter)
+        return adapter
+
+    @staticmethod
+    def _set_query_timeout(adapter, seconds):
+        """
+        :param seconds: query timeout of the session. 0 disables it.
+        """
+        with adapter.connection.cursor() as cursor:
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME=%s", (int(seconds * 1000),))
+
+    def _discard(self, adapter):
+        with self.lock:
+            if adapter in self.adapters:
+                self.adapters.remove(adapter)
+        try:
+            adapter.connection.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        self.slots.acquire()
+        try:
+            while True:
                 try:
-                    extract_n_push_humidity(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing humidity", ex)
-            elif variable == 'SolarRadiation':
+                    adapter = self.idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
                 try:
-                    extract_n_push_solarradiation(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing solar-radiation", ex)
-            elif variable == 'WindDirection':
+                    # Don't let ping reconnect: a new connection would lose the session's query timeout.
+                    adapter.connection.ping(reconnect=False)
+                    return adapter
+                except Exception:
+                    print('Dropped an idle curw_iot connection which was closed.')
+                    self._discard(adapter)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _checkin(self, adapter):
+        self.idle.put(adapter)
+        self.slots.release()
+
+    def run(self, function):
+        """
+        Call function with an adapter of the pool
+        :param function: function(MySQLAdapter) -> result
+        :return: result of the function
+        """
+        for attempt in (1, 2):
+            adapter = self._checkout()
+            try:
+                result = function(adapter)
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as ex:
+                if ex.args and ex.args[0] == ER_QUERY_TIMEOUT:
+                    # The connection is fine, the query was too slow. Running it again won't help.
+                    self._checkin(adapter)
+                    raise
+                self._discard(adapter)
+                self.slots.release()
+                if attempt > 1:
+                    raise
+                print('Lost the curw_iot connection. Retrying on a new one.', ex)
+                continue
+            except Exception:
+                self._checkin(adapter)
+                raise
+            self._checkin(adapter)
+            return result
+
+    def run_without_timeout(self, function):
+        """
+        Call function with an adapter of the pool whose session has no query timeout while it runs. For unbuffered
+        queries: MAX_EXECUTION_TIME keeps counting while the client consumes the rows, so a slowly consumed stream
+        would be killed with ER_QUERY_TIMEOUT however cheap the query is. The function should close the result set
+        before it returns.
+        :param function: function(MySQLAdapter) -> result
+        :return: result of the function
+        """
+        if not self.query_timeout or not self.session_timeout_supported:
+            return self.run(function)
+
+        def call(adapter):
+            self._set_query_timeout(adapter, 0)
+            try:
+                return function(adapter)
+            finally:
+                self._set_query_timeout(adapter, self.query_timeout)
+
+        return self.run(call)
+
+    def close(self):
+        with self.lock:
+            adapters = self.adapters
+            self.adapters = []
+        for adapter in adapters:
+            try:
+                adapter.connection.close()
+            except Exception as ex:
+                print('Error occurred while closing extract adapter connection.', ex)
+
+
+def resolve_event_id(extract_pool, entry, metrics):
+    """
+    Find the curw_iot timeseries id (event_id) of a station plan entry. Runs inside a worker thread.
+    """
+    with metrics.stage(STAGE_EVENT_ID, db_calls=1, station=entry.station_name, variable=entry.variable):
+        return extract_pool.run(lambda adapter: adapter.get_event_id(dict(entry.timeseries_meta)))
+
+
+def push_timeseries(writer, entry, timeseries, metrics):
+    """
+    Process a single (station, variable) timeseries bulk extracted from curw_iot and queue it to be pushed to
+    curw_obs. Runs inside a worker thread.
+    :return: True if the timeseries was processed
+    """
+    with metrics.stage(STAGE_PROCESS, station=entry.station_name, variable=entry.variable) as counts:
+        try:
+            counts['rows'] = _extract_n_push(entry, timeseries, writer, metrics)
+            return True
+        except Exception as ex:
+            print("Error occured while pushing %s of station %s." % (entry.variable, entry.station_name), ex)
+            return False
+
+
+def get_restart_time(entry, timeseries):
+    """
+    Watermark of a series after consuming an extracted timeseries: the time of the first 5 minute group the next
+    cycle has to read again. The last group may still be filling up in curw_iot, so it is always read again.
+    Precipitation also keeps the group before it, whose cumulative reading the next difference needs.
+    :param entry: Plan.SeriesPlan
+    :param timeseries: Series extracted from curw_iot
+    :return: str: restart time, or None if nothing was extracted
+    """
+    if len(timeseries) <= 0:
+        return None
+    if entry.variable == 'Precipitation' and len(timeseries) > 1:
+        return timeseries.time_at(-2)
+    return timeseries.time_at(-1)
+
+
+class CycleLock:
+    """
+    Non-blocking file lock held for the duration of a cycle, so two cycles never overlap.
+    Also keeps a cron run and a daemon from pushing at the same time, and two backfills from sharing a checkpoint.
+    """
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class Pusher:
+    """
+    Long lived pusher state: curw_obs pool, curw_iot connections, worker pool and the compiled station plan.
+    Kept alive across cycles in daemon mode.
+    """
+
+    def __init__(self, pool, config_path, workers=DEFAULT_WORKERS, metrics_path=None, prometheus_path=None,
+                 reconcile_interval=DEFAULT_RECONCILE_INTERVAL, reconcile_minutes=DEFAULT_RECONCILE_MINUTES,
+                 skip_unchanged=False, job_timeout=DEFAULT_JOB_TIMEOUT, cycle_deadline=DEFAULT_CYCLE_DEADLINE,
+                 extract_pool_size=None, query_timeout=DEFAULT_QUERY_TIMEOUT, event_id_ttl=DEFAULT_EVENT_ID_TTL,
+                 event_id_negative_ttl=DEFAULT_EVENT_ID_NEGATIVE_TTL, shard_leases=None, metrics_per_series=False):
+        self.pool = pool
+        self.config_path = config_path
+        self.metrics_path = metrics_path
+        self.metrics_per_series = metrics_per_series
+        self.prometheus_path = prometheus_path
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_minutes = reconcile_minutes
+        self.job_timeout = job_timeout
+        self.cycle_deadline = cycle_deadline
+        self.deferred = set()
+        # True once a job overran and was abandoned. Its worker may still be hung.
+        self.abandoned_jobs = False
+        self.plan = None
+        self.rollups = {}
+        self.spool = WriteSpool(os.path.join(ROOT_DIR, WRITE_SPOOL_FILE))
+        self.watermark_path = os.path.join(ROOT_DIR, WATERMARK_FILE)
+        self.watermarks = load_watermarks(self.watermark_path)
+        self.event_id_cache = EventIdCache(os.path.join(ROOT_DIR, EVENT_ID_CACHE_FILE), event_id_ttl,
+                                           event_id_negative_ttl)
+        self.tail_cache = None
+        if skip_unchanged:
+            # Long enough to cover a reconciliation window
+            self.tail_cache = TailCache(os.path.join(ROOT_DIR, TAIL_CACHE_FILE), max(reconcile_minutes, 30) + 5)
+        self.extract_pool = None
+        self.extract_pool_size = extract_pool_size or workers
+        self.query_timeout = query_timeout
+        self.shard_leases = shard_leases
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.load_config()
+
+    def load_config(self, metrics=None):
+        """
+        Load the station plan of the config. It is only recompiled when the config file changed.
+        :param metrics: Metrics.CycleMetrics: hash id lookups of a recompile are recorded into it
+        :return: True if the plan changed
+        """
+        plan = load_station_plan(self.pool, self.config_path, os.path.join(ROOT_DIR, STATION_PLAN_FILE),
+                                 os.path.join(ROOT_DIR, HASH_ID_CACHE_FILE), current_plan=self.plan, metrics=metrics)
+        if plan is self.plan:
+            return False
+
+        if self.plan is None or dict(plan.extract_from) != dict(self.plan.extract_from):
+            print("Loaded config %s" % self.config_path)
+            if self.extract_pool is not None:
+                self.extract_pool.close()
+            self.extract_pool = ExtractAdapterPool(dict(plan.extract_from), self.extract_pool_size, self.query_timeout)
+
+        self.plan = plan
+        self.rollups = {entry.obs_hash_id: entry.rollups for entry in plan.entries if len(entry.rollups) > 0}
+        return True
+
+    def collect_series(self):
+        """
+        :return: list of Plan.SeriesPlan of every configured series. In sharded mode, only the series of the shards
+        leased by this node, after renewing its leases.
+        """
+        if self.shard_leases is None:
+            return list(self.plan.entries)
+
+        self.shard_leases.acquire()
+        return [entry for entry in self.plan.entries if self.shard_leases.owns(entry.obs_hash_id)]
+
+    def resolve_event_ids(self, series, metrics, deadline=None):
+        """
+        Resolve curw_iot event ids of the series. Fresh entries of the event id cache are used as they are. The
+        rest are checked with one bulk query, and the ones it doesn't find are looked up one by one, concurrently
+        and in priority order, before being cached as missing.
+        :param deadline: float: time.perf_counter() by which the event ids should be resolved, or None
+        :return: dict of curw_obs hash id -> curw_iot event id (None if the series isn't in curw_iot). Series whose
+        lookup overran the job timeout or the deadline are left out.
+        """
+        now = time.time()
+        keys = {entry.obs_hash_id: get_curw_iot_event_id(entry.timeseries_meta) for entry in series}
+        event_ids = {}
+        misses = []
+        for entry in series:
+            cached, event_id = self.event_id_cache.get(keys[entry.obs_hash_id], now)
+            if cached:
+                event_ids[entry.obs_hash_id] = event_id
+            else:
+                misses.append(entry)
+        metrics.count('event_id_cache_hits', len(series) - len(misses))
+
+        if len(misses) > 0:
+            candidates = sorted(set(keys[entry.obs_hash_id] for entry in misses))
+
+            def find_existing():
+                db_calls = int(math.ceil(len(candidates) / float(BULK_EXTRACT_BATCH_SIZE)))
+                with metrics.stage(STAGE_EVENT_ID, db_calls=db_calls) as counts:
+                    existing = self.extract_pool.run(lambda adapter: get_existing_event_ids(adapter, candidates))
+                    counts['rows'] = len(existing)
+                    return existing
+
+            results, _ = run_jobs(self.executor, [('bulk', find_existing, ())], deadline=deadline)
+            existing = set()
+            if 'bulk' in results:
+                succeeded, result = results['bulk']
+                if succeeded:
+                    existing = result
+                else:
+                    print("Error occurred while bulk checking %d event ids." % len(candidates), result)
+
+            lookups = []
+            for entry in misses:
+                key = keys[entry.obs_hash_id]
+                if key in existing:
+                    event_ids[entry.obs_hash_id] = key
+                    self.event_id_cache.put(key, key, now)
+                else:
+                    lookups.append(entry)
+
+            jobs = [(entry.obs_hash_id, resolve_event_id, (self.extract_pool, entry, metrics)) for entry in lookups]
+            results, _ = run_jobs(self.executor, jobs, job_timeout=self.job_timeout if deadline is not None else None,
+                                  deadline=deadline)
+            for entry in lookups:
+                if entry.obs_hash_id not in results:
+                    continue
+                succeeded, result = results[entry.obs_hash_id]
+                if succeeded:
+                    self.event_id_cache.put(keys[entry.obs_hash_id], result, now)
+                else:
+                    print("Error occurred while finding the event id of %s of station %s."
+                          % (entry.variable, entry.station_name), result)
+                    result = None
+                event_ids[entry.obs_hash_id] = result
+
+        self.event_id_cache.retain(keys.values())
+        self.event_id_cache.save()
+        return event_ids
+
+    def push_window(self, series, event_ids, start_datetimes, end_datetime, metrics, carry_rows=None, spool=None,
+                    watermarks=None, tail_cache=None, deadline=None):
+        """
+        Extract, process and push one time window of the series. Series are pushed a priority tier at a time, so
+        the most important ones reach curw_obs first.
+        :param series: list of Plan.SeriesPlan
+        :param event_ids: dict of curw_obs hash id -> curw_iot event id. Series left out of it are deferred.
+        :param start_datetimes: dict of curw_obs hash id -> window start
+        :param end_datetime: str: common end of the windows
+        :param metrics: Metrics.CycleMetrics: stage timings of the window are recorded into it
+        :param carry_rows: dict of event_id -> last extracted cumulative row of the previous window, as a one row
+        Series. Prepended to the precipitation series so differencing continues across consecutive windows, and
+        updated in place.
+        :param spool: Spool.WriteSpool: rows are spooled to it if the write to curw_obs fails
+        :param watermarks: dict of curw_obs hash id -> restart time (see get_restart_time). Advanced in place for the
+        series whose rows were written or spooled.
+        :param tail_cache: Utils.TailCache: rows unchanged since they were last written are skipped
+        :param deadline: float: time.perf_counter() by which the window should be pushed, or None. Series whose
+        jobs overran the job timeout or the deadline are deferred to the next cycle.
+        :return: (number of rows queued, number of rows inserted, list of Plan.SeriesPlan deferred or not written)
+        """
+        queued_rows = 0
+        inserted_rows = 0
+        missed = []
+        for priority, tier in groupby(sorted(series, key=lambda entry: entry.priority),
+                                      key=lambda entry: entry.priority):
+            tier = list(tier)
+            if deadline is not None and time.perf_counter() >= deadline:
+                print("Deferring %d timeseries of priority %d. The cycle deadline passed." % (len(tier), priority))
+                self.defer(tier, STAGE_EXTRACT, metrics)
+                missed.extend(tier)
+                continue
+
+            tier_queued_rows, tier_inserted_rows, tier_missed = self.push_tier(
+                tier, event_ids, start_datetimes, end_datetime, metrics, carry_rows, spool, watermarks, tail_cache,
+                deadline)
+            queued_rows += tier_queued_rows
+            inserted_rows += tier_inserted_rows
+            missed.extend(tier_missed)
+
+        return queued_rows, inserted_rows, missed
+
+    def defer(self, series, stage, metrics):
+        if len(series) > 0:
+            self.abandoned_jobs = True
+        for entry in series:
+            self.deferred.add(entry.obs_hash_id)
+            metrics.miss(entry.station_name, entry.variable, stage)
+
+    def push_tier(self, series, event_ids, start_datetimes, end_datetime, metrics, carry_rows, spool, watermarks,
+                  tail_cache, deadline):
+        """
+        Push the series of one priority tier. See push_window.
+        """
+        writer = TimeseriesWriter(self.pool, tail_cache=tail_cache, rollups=self.rollups)
+        job_timeout = self.job_timeout if deadline is not None else None
+
+        deferred = [entry for entry in series if entry.obs_hash_id not in event_ids]
+        if len(deferred) > 0:
+            print("Deferring %d timeseries whose event id lookup overran." % len(deferred))
+            self.defer(deferred, STAGE_EVENT_ID, metrics)
+
+        # Extract all the series with one grouped statement per group operation.
+        windows = {}
+        for entry in series:
+            event_id = event_ids.get(entry.obs_hash_id)
+            if event_id is not None:
+                windows.setdefault(entry.group_operation, []).append((event_id, start_datetimes[entry.obs_hash_id]))
+
+        def extract(group_operation, group_windows):
+            db_calls = int(math.ceil(len(group_windows) / float(BULK_EXTRACT_BATCH_SIZE)))
+            with metrics.stage(STAGE_EXTRACT, db_calls=db_calls):
+                return self.extract_pool.run(lambda adapter: extract_grouped_time_series_bulk(
+                    adapter, group_windows, end_datetime, group_operation))
+
+        results, overrun = run_jobs(self.executor, [(group_operation, extract, (group_operation, group_windows))
+                                                    for group_operation, group_windows in windows.items()],
+                                    deadline=deadline)
+        extracted = {}
+        for group_operation, (succeeded, result) in results.items():
+            if succeeded:
+                extracted.update(result)
+            else:
+                print("Error occurred while bulk extracting %d timeseries." % len(windows[group_operation]), result)
+        for group_operation in overrun:
+            print("Bulk extraction of %d timeseries overran the cycle deadline." % len(windows[group_operation]))
+
+        jobs = []
+        restart_times = {}
+        for entry in series:
+            event_id = event_ids.get(entry.obs_hash_id)
+            if entry.obs_hash_id not in event_ids:
+                continue
+            if event_id is None:
+                print("No timeseries for the %s of station_Id: %s in the extracting DB."
+                      % (entry.variable, entry.station_id))
+                continue
+            if entry.group_operation in overrun:
+                deferred.append(entry)
+                self.defer([entry], STAGE_EXTRACT, metrics)
+                continue
+            if event_id not in extracted:
+                # Bulk extraction failed for this series' group operation.
+                continue
+
+            timeseries = extracted[event_id]
+            restart_times[entry.obs_hash_id] = get_restart_time(entry, timeseries)
+            metrics.record(STAGE_EXTRACT, 0.0, rows=len(timeseries), station=entry.station_name,
+                           variable=entry.variable)
+            if carry_rows is not None and entry.variable == 'Precipitation':
+                if event_id in carry_rows:
+                    timeseries = Series.concat([carry_rows[event_id], timeseries])
+                if len(timeseries) > 0:
+                    carry_rows[event_id] = timeseries.tail()
+
+            print("**************** Station: %s, variable: %s, start_date: %s, end_date: %s **************"
+                  % (entry.station_name, entry.variable, start_datetimes[entry.obs_hash_id], end_datetime))
+
+            jobs.append((entry.obs_hash_id, push_timeseries, (writer, entry, timeseries, metrics)))
+
+        entries = {entry.obs_hash_id: entry for entry in series}
+        results, overrun = run_jobs(self.executor, jobs, job_timeout=job_timeout, deadline=deadline)
+        overrun = [entries[obs_hash_id] for obs_hash_id in overrun]
+        for obs_hash_id, (succeeded, result) in results.items():
+            entry = entries[obs_hash_id]
+            if not succeeded:
+                print("Error occurred while pushing %s of station %s." % (entry.variable, entry.station_name), result)
+            if not succeeded or not result:
+                restart_times.pop(entry.obs_hash_id, None)
+        for entry in overrun:
+            print("Deferring the %s of station %s. Processing it overran." % (entry.variable, entry.station_name))
+            restart_times.pop(entry.obs_hash_id, None)
+            deferred.append(entry)
+        self.defer(overrun, STAGE_PROCESS, metrics)
+
+        # Write every processed series of the tier to curw_obs together.
+        queued_rows = writer.row_count
+        db_calls = int(math.ceil(queued_rows / float(UPSERT_BATCH_SIZE))) + 1 if queued_rows > 0 else 0
+        with metrics.stage(STAGE_INSERT, db_calls=db_calls) as counts:
+            inserted_rows = writer.flush()
+            counts['rows'] = inserted_rows
+        metrics.count('queued_rows', queued_rows)
+        metrics.count('inserted_rows', inserted_rows)
+        metrics.count('series', len(results))
+        print("Inserted %d rows of %d timeseries to curw_obs." % (inserted_rows, len(results)))
+        if tail_cache is not None:
+            metrics.count('skipped_rows', writer.skipped_rows)
+            print("Skipped %d rows unchanged in curw_obs." % writer.skipped_rows)
+        if writer.rollup_rows > 0:
+            metrics.count('rollup_rows', writer.rollup_rows)
+            print("Updated %d hourly and daily rollup rows." % writer.rollup_rows)
+
+        written = len(writer.failed_series) <= 0
+        if spool is not None and len(writer.failed_series) > 0:
+            spooled_rows = spool.append(writer.failed_series)
+            metrics.count('spooled_rows', spooled_rows)
+            print("Spooled %d rows to be written on the next healthy cycle." % spooled_rows)
+            written = spooled_rows > 0
+
+        if not written:
+            return queued_rows, inserted_rows, deferred + [entries[obs_hash_id] for obs_hash_id in results]
+
+        if watermarks is not None:
+            for obs_hash_id, restart_time in restart_times.items():
+                if restart_time is not None:
+                    watermarks[obs_hash_id] = restart_time
+        return queued_rows, inserted_rows, deferred
+
+    def run_cycle(self):
+        """
+        Extract every configured series from curw_iot and push it to curw_obs
+        :return: number of rows inserted
+        """
+        metrics = CycleMetrics(mode='cycle')
+        try:
+            return self._run_cycle(metrics)
+        finally:
+            self.write_metrics(metrics)
+
+    def _run_cycle(self, metrics):
+        self.load_config(metrics)
+
+        # Writes which failed on earlier cycles go first, with a few large upserts.
+        if not self.spool.is_empty():
+            with metrics.stage(STAGE_INSERT) as counts:
+                counts['rows'] = self.spool.replay(
+                    lambda batch_size: TimeseriesWriter(self.pool, batch_size, rollups=self.rollups))
+            metrics.count('replayed_rows', counts['rows'])
+            metrics.count('quarantined_rows', self.spool.quarantined_rows)
+
+        # Prepare start and date times.
+        now_date = utc_to_sl(datetime.now())
+        # now_date = datetime.now()
+        start_datetime_obj = now_date - timedelta(minutes=30)
+        end_datetime_obj = now_date
+
+        start_datetime = start_datetime_obj.strftime(COMMON_DATE_FORMATSTRT)
+        end_datetime = end_datetime_obj.strftime(COMMON_DATE_FORMATEND)
+
+        series = self.collect_series()
+        watermarks = self.watermarks['series']
+
+        # Every so often widen the windows, to pick up source rows which arrived late.
+        reconcile = False
+        if self.reconcile_interval > 0:
+            reconciled_at = self.watermarks.get('reconciled_at')
+            if reconciled_at is None:
+                # Nothing to reconcile yet. Start counting from now.
+                self.watermarks['reconciled_at'] = now_date.strftime(COMMON_DATE_FORMAT)
+            reconcile = reconciled_at is not None and \
+                (now_date.replace(tzinfo=None) - datetime.strptime(reconciled_at, COMMON_DATE_FORMAT)) \
+                .total_seconds() >= self.reconcile_interval
+        if reconcile:
+            print("Reconciling the last %d minutes of every series." % self.reconcile_minutes)
+            metrics.count('reconcile', 1)
+
+        # Series with a watermark restart from it. The others restart 30 minutes before their last pushed timestamp
+        # (fetched in one query), or their last spooled timestamp if the spool is ahead (e.g. curw_obs is
+        # unreachable).
+        new_series = [entry for entry in series if entry.obs_hash_id not in watermarks]
+        end_dates = {}
+        if len(new_series) > 0:
+            with metrics.stage(STAGE_END_DATE, db_calls=1) as counts:
+                end_dates = get_end_dates(self.pool, [entry.obs_hash_id for entry in new_series])
+                counts['rows'] = len(end_dates or {})
+        if end_dates is None:
+            print("Continuing from the spooled end dates.")
+            end_dates = {}
+        for obs_hash_id, spooled_end_date in self.spool.get_end_dates().items():
+            spooled_end_date = datetime.strptime(spooled_end_date, COMMON_DATE_FORMAT)
+            if obs_hash_id not in end_dates or spooled_end_date > end_dates[obs_hash_id]:
+                end_dates[obs_hash_id] = spooled_end_date
+
+        start_datetimes = {}
+        for entry in series:
+            start_datetimes[entry.obs_hash_id] = start_datetime
+            prev_end_date = end_dates.get(entry.obs_hash_id)
+            if entry.obs_hash_id in watermarks:
+                start_datetimes[entry.obs_hash_id] = watermarks[entry.obs_hash_id]
+            elif prev_end_date is not None:
+                start_datetimes[entry.obs_hash_id] = (prev_end_date - timedelta(minutes=30)).strftime(COMMON_DATE_FORMAT)
+            if reconcile:
+                start_datetimes[entry.obs_hash_id] = min(
+                    start_datetimes[entry.obs_hash_id],
+                    (now_date - timedelta(minutes=self.reconcile_minutes)).strftime(COMMON_DATE_FORMATSTRT))
+
+        # Series deferred by the last cycle go first within their priority.
+        series.sort(key=lambda entry: (entry.priority, entry.obs_hash_id not in self.deferred))
+        self.deferred = set()
+
+        deadline = metrics.started_perf + self.cycle_deadline if self.cycle_deadline else None
+        event_ids = self.resolve_event_ids(series, metrics, deadline)
+        _, inserted_rows, _ = self.push_window(series, event_ids, start_datetimes, end_datetime, metrics,
+                                              spool=self.spool, watermarks=watermarks, tail_cache=self.tail_cache,
+                                              deadline=deadline)
+
+        # Watermarks of series no longer in the plan are dropped.
+        self.watermarks['series'] = {entry.obs_hash_id: watermarks[entry.obs_hash_id]
+                                     for entry in series if entry.obs_hash_id in watermarks}
+        if reconcile:
+            self.watermarks['reconciled_at'] = now_date.strftime(COMMON_DATE_FORMAT)
+        save_watermarks(self.watermark_path, self.watermarks)
+        if self.tail_cache is not None:
+            self.tail_cache.retain([entry.obs_hash_id for entry in series])
+            self.tail_cache.save()
+        return inserted_rows
+
+    def write_metrics(self, metrics):
+        metrics.finish()
+        summary = metrics.summary()
+        print("Cycle took %.3fs: %s" % (summary['duration_seconds'],
+                                        ', '.join('%s %.3fs' % (stage, totals['seconds'])
+                                                  for stage, totals in sorted(summary['stages'].items()))))
+        if len(summary['missed_deadline']) > 0:
+            print("Deferred to the next cycle: %s" % ', '.join('%s %s (%s)' % (missed['station'], missed['variable'],
+                                                                              missed['stage'])
+                                                               for missed in summary['missed_deadline']))
+        if self.metrics_path:
+            metrics.write_json_lines(self.metrics_path, self.metrics_per_series)
+        if self.prometheus_path:
+            metrics.write_prometheus(self.prometheus_path)
+
+    def run_backfill(self, from_datetime, to_datetime, chunk_hours=DEFAULT_CHUNK_HOURS, stream=False,
+                     chunk_rows=STREAM_CHUNK_ROWS):
+        """
+        Push a historical range chunk by chunk, so memory use doesn't grow with the range. Completed chunks are
+        checkpointed per series, so an interrupted backfill resumes from where it stopped when rerun with the same
+        range.
+        :param from_datetime: datetime: start of the range. Rounded down to 5 minutes.
+        :param to_datetime: datetime: end of the range
+        :param chunk_hours: int: size of a chunk
+        :param stream: bool: stream each series over the whole range instead (see stream_backfill)
+        :param chunk_rows: int: rows written at a time when streaming
+        """
+        metrics = CycleMetrics(mode='backfill')
+        self.load_config(metrics)
+
+        from_datetime = from_datetime.replace(minute=from_datetime.minute - from_datetime.minute % 5, second=0)
+        checkpoint_path = os.path.join(ROOT_DIR, BACKFILL_CHECKPOINT_FILE)
+        checkpoint = load_backfill_checkpoint(checkpoint_path, from_datetime.strftime(COMMON_DATE_FORMAT),
+                                              to_datetime.strftime(COMMON_DATE_FORMAT))
+        completed = checkpoint['series']
+
+        series = self.collect_series()
+        event_ids = self.resolve_event_ids(series, metrics)
+        self.write_metrics(metrics)
+        if stream:
+            return self.stream_backfill(series, event_ids, from_datetime, to_datetime, checkpoint, checkpoint_path,
+                                        chunk_rows)
+        carry_rows = {}
+
+        chunk_start = from_datetime
+        while chunk_start < to_datetime:
+            chunk_end = min(chunk_start + timedelta(hours=chunk_hours), to_datetime)
+            chunk_start_str = chunk_start.strftime(COMMON_DATE_FORMAT)
+            # Windows are inclusive at both ends. Stop a second before the next chunk to not read a row twice.
+            chunk_end_str = (chunk_end - timedelta(seconds=1)).strftime(COMMON_DATE_FORMAT)
+            if chunk_end == to_datetime:
+                chunk_end_str = chunk_end.strftime(COMMON_DATE_FORMAT)
+
+            chunk_series = [entry for entry in series if completed.get(entry.obs_hash_id, '') < chunk_end_str]
+            if len(chunk_series) > 0:
+                print("################ Backfilling %d timeseries from %s to %s ################"
+                      % (len(chunk_series), chunk_start_str, chunk_end_str))
+
+                start_datetimes = {}
+                for entry in chunk_series:
+                    start_datetimes[entry.obs_hash_id] = chunk_start_str
+                    if entry.variable == 'Precipitation' and event_ids[entry.obs_hash_id] not in carry_rows:
+                        # Resuming or first chunk: also read the cumulative readings of the previous hour, so
+                        # precipitation at the start of the chunk can be differenced.
+                        start_datetimes[entry.obs_hash_id] = (chunk_start - timedelta(hours=1)).strftime(COMMON_DATE_FORMAT)
+
+                metrics = CycleMetrics(mode='backfill')
                 try:
-                    extract_n_push_winddirection(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing solar-radiation", ex)
-            elif variable == 'Waterlevel':
+                    _, _, missed = self.push_window(chunk_series, event_ids, start_datetimes, chunk_end_str, metrics,
+                                                    carry_rows)
+                finally:
+                    self.write_metrics(metrics)
+                if len(missed) > 0:
+                    print("Backfill stopped at %s. Rerun with the same range to resume." % chunk_start_str)
+                    return False
+
+                for entry in chunk_series:
+                    completed[entry.obs_hash_id] = chunk_end_str
+                save_backfill_checkpoint(checkpoint_path, checkpoint)
+
+            chunk_start = chunk_end
+
+        print("Backfill from %s to %s completed." % (from_datetime.strftime(COMMON_DATE_FORMAT),
+                                                     to_datetime.strftime(COMMON_DATE_FORMAT)))
+        return True
+
+    def stream_backfill(self, series, event_ids, from_datetime, to_datetime, checkpoint, checkpoint_path,
+                        chunk_rows=STREAM_CHUNK_ROWS):
+        """
+        Backfill each series with a single unbuffered extraction over the whole range. Rows flow one at a time
+        through the streaming processors into a ChunkedWriter, so memory stays flat regardless of the range length.
+        The time of the last row written is checkpointed after every chunk, and a rerun resumes each series from it.
+        Streaming queries aren't limited by --query-timeout, which would otherwise end any stream running longer.
+        :param series: list of Plan.SeriesPlan
+        :param event_ids: dict of curw_obs hash id -> curw_iot event id
+        :param checkpoint: dict: see load_backfill_checkpoint. Updated in place.
+        :return: True if every series was backfilled
+        """
+        from_str = from_datetime.strftime(COMMON_DATE_FORMAT)
+        to_str = to_datetime.strftime(COMMON_DATE_FORMAT)
+        completed = checkpoint['series']
+        checkpoint_lock = threading.Lock()
+        metrics = CycleMetrics(mode='backfill')
+
+        def checkpoint_series(entry, written_until):
+            with checkpoint_lock:
+                completed[entry.obs_hash_id] = written_until
+                save_backfill_checkpoint(checkpoint_path, checkpoint)
+
+        def backfill_series(entry, start_date):
+            """
+            :return: True if the series was backfilled. Runs inside a worker thread.
+            """
+            writer = ChunkedWriter(self.pool, entry.obs_hash_id, chunk_rows,
+                                   on_flush=lambda written_until: checkpoint_series(entry, written_until),
+                                   rollups=self.rollups)
+            def stream(adapter):
+                rows = stream_extracted_rows(adapter, event_ids[entry.obs_hash_id], start_date, to_str,
+                                             entry.group_operation)
                 try:
-                    extract_n_push_waterlevel(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
-                except Exception as ex:
-                    print("Error occured while pushing water-level", ex)
+                    return writer.write(stream_series(entry, rows))
+                finally:
+                    # Drains the unbuffered result set if the write stopped early, so the connection can be reused.
+                    rows.close()
 
-            elif variable == 'Pressure':
+            with metrics.stage(STAGE_PROCESS, station=entry.station_name, variable=entry.variable) as counts:
                 try:
-                    extract_n_push_pressure(extract_adapter, station, start_datetime, end_datetime, pool, obs_hash_id)
+                    # A stream stays in execution until it is consumed, so it runs without the query timeout.
+                    done = self.extract_pool.run_without_timeout(stream)
                 except Exception as ex:
-                    print("Error occured while pushing water-level", ex)
+                    print("Error occured while streaming %s of station %s." % (entry.variable, entry.station_name),
+                          ex)
+                    done = False
+                counts['rows'] = writer.written_rows
+            if done:
+                checkpoint_series(entry, to_str)
+            return done
 
-            else:
-                print("Unknown variable type: %s" %variable)
+        jobs = []
+        for entry in series:
+            if event_ids.get(entry.obs_hash_id) is None or completed.get(entry.obs_hash_id, '') >= to_str:
+                continue
+            # Resuming from the last row written also reads the cumulative reading precipitation is differenced
+            # from. A fresh start reads the hour before the range for it.
+            start_date = completed.get(entry.obs_hash_id)
+            if start_date is None:
+                start_date = from_str
+                if entry.variable == 'Precipitation':
+                    start_date = (from_datetime - timedelta(hours=1)).strftime(COMMON_DATE_FORMAT)
+            jobs.append((entry, self.executor.submit(backfill_series, entry, start_date)))
+
+        print("################ Streaming %d timeseries from %s to %s ################" % (len(jobs), from_str, to_str))
+        failed = [entry for entry, job in jobs if not job.result()]
+        self.write_metrics(metrics)
+        if len(failed) > 0:
+            print("Backfill of %d timeseries stopped. Rerun with the same range to resume." % len(failed))
+            return False
+
+        print("Backfill from %s to %s completed." % (from_str, to_str))
+        return True
+
+    def close(self):
+        """
+        Stop the workers and close the curw_iot connections. Jobs abandoned as overrun may never return, so they
+        aren't waited for: jobs which haven't started are cancelled instead.
+        :return: True if abandoned jobs may still be running, which keeps the interpreter from exiting (see main)
+        """
+        abandoned = self.abandoned_jobs or len(self.deferred) > 0
+        if abandoned:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            self.executor.shutdown(wait=True)
+        if self.extract_pool is not None:
+            self.extract_pool.close()
+        return abandoned
+
+
+def load_backfill_checkpoint(checkpoint_path, from_datetime, to_datetime):
+    """
+    :return: dict: {'from': str, 'to': str, 'series': {curw_obs hash id: end of the last completed chunk}}.
+    Checkpoints of a different range are ignored.
+    """
+    if os.path.exists(checkpoint_path):
+        try:
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint.get('from') == from_datetime and checkpoint.get('to') == to_datetime:
+                print("Resuming backfill from checkpoint %s" % checkpoint_path)
+                return checkpoint
+        except Exception as ex:
+            print('Error occurred while loading backfill checkpoint. Starting over.', ex)
+
+    return {'from': from_datetime, 'to': to_datetime, 'series': {}}
+
+
+def save_backfill_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def load_watermarks(watermark_path):
+    """
+    :return: dict: {'series': {curw_obs hash id: restart time}, 'reconciled_at': time of the last reconciliation}
+    """
+    if os.path.exists(watermark_path):
+        try:
+            with open(watermark_path) as watermark_file:
+                watermarks = json.load(watermark_file)
+            watermarks.setdefault('series', {})
+            watermarks.setdefault('reconciled_at', None)
+            return watermarks
+        except Exception as ex:
+            print('Error occurred while loading watermarks. Falling back to the curw_obs end dates.', ex)
+
+    return {'series': {}, 'reconciled_at': None}
+
+
+def save_watermarks(watermark_path, watermarks):
+    try:
+        tmp_path = watermark_path + '.tmp'
+        with open(tmp_path, 'w') as watermark_file:
+            json.dump(watermarks, watermark_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, watermark_path)
+    except Exception as ex:
+        print('Error occurred while saving watermarks.', ex)
+
+
+def parse_datetime(datetime_str):
+    for date_format in (COMMON_DATE_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(datetime_str, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid date time '%s'. Expected format is '%s'."
+                                     % (datetime_str, COMMON_DATE_FORMAT))
+
+
+def print_startup_profile(timings):
+    """
+    :param timings: list of (step, seconds) of the startup
+    """
+    print("Startup profile:")
+    for step, seconds in timings:
+        print("    %-20s %8.3fs" % (step, seconds))
+    print("    %-20s %8.3fs" % ('total', sum(seconds for _, seconds in timings)))
+    # ru_maxrss is in kilobytes on Linux
+    print("    %-20s %8.1fMB" % ('peak memory', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def run_locked_cycle(pusher):
+    with CycleLock(os.path.join(ROOT_DIR, LOCK_FILE)) as locked:
+        if not locked:
+            print("Another pusher cycle is still running. Skipping this cycle.")
+            return
+        try:
+            pusher.run_cycle()
+        except Exception as ex:
+            print('Error occurred while extracting and pushing data:', ex)
+
+
+def run_daemon(pusher, interval):
+    """
+    Run pusher cycles on a wall clock aligned interval (e.g. every 5 minutes at :00, :05, ...) until SIGTERM/SIGINT.
+    Cycles never overlap. Ticks missed while a cycle overran are caught up with a single immediate cycle, since
+    each cycle pushes everything since the last pushed timestamp of every series.
+    """
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        print("Received signal %d. Stopping after the current cycle." % signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    next_tick = (int(time.time()) // interval + 1) * interval
+    while not stop_event.is_set():
+        wait = next_tick - time.time()
+        if wait > 0 and stop_event.wait(wait):
+            break
+
+        print("\n\n################ Pusher cycle at %s ################" % datetime.now().strftime(COMMON_DATE_FORMAT))
+        run_locked_cycle(pusher)
+
+        next_tick += interval
+        now = time.time()
+        if now >= next_tick:
+            missed = int((now - next_tick) // interval) + 1
+            print("Cycle overran the interval. Catching up %d missed tick(s) with one cycle." % missed)
+            next_tick += (missed - 1) * interval
+
+    if pusher.shard_leases is not None:
+        # Let the other nodes take over now rather than when the leases expire.
+        pusher.shard_leases.release()
+    print("Pusher daemon stopped.")
+
+
+def main(pusher_class=Pusher):
+    """
+    Command line entry point
+    :param pusher_class: Pusher or a subclass of it, e.g. AsyncPusher.AsyncPusher
+    """
+    pool = None
+    pusher = None
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-c', '--config',
+                            help='Configuration file that includes db configs and stations. Default is ./CONFIG.json.')
+        parser.add_argument('-f', '--force', action='store_true', help='Enables force insert.')
+        parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Number of station/variable timeseries pushed concurrently. Default is %d.'
+                                 % DEFAULT_WORKERS)
+        parser.add_argument('-d', '--daemon', action='store_true',
+                            help='Keep running and push on an interval instead of running a single cycle.')
+        parser.add_argument('-i', '--interval', type=int, default=DEFAULT_INTERVAL,
+                            help='Seconds between cycles in daemon mode. Default is %d.' % DEFAULT_INTERVAL)
+        parser.add_argument('--from', dest='from_datetime', type=parse_datetime,
+                            help="Backfill start, e.g. '2018-07-04 00:00:00'. Requires --to.")
+        parser.add_argument('--to', dest='to_datetime', type=parse_datetime,
+                            help="Backfill end, e.g. '2018-07-31 00:00:00'. Requires --from.")
+        parser.add_argument('--metrics-file', default=METRICS_FILE,
+                            help='File the json lines summary of each cycle (stage totals and counters) is appended '
+                                 'to. Default is ./%s.' % METRICS_FILE)
+        parser.add_argument('--metrics-per-series', action='store_true',
+                            help='Also append the stages of every series to --metrics-file. Adds about 90 KB per '
+                                 'cycle for 67 stations, so rotate the file, e.g. with logrotate.')
+        parser.add_argument('--prometheus-file', default=PROMETHEUS_FILE,
+                            help='Prometheus textfile the last cycle summary is written to. Default is ./%s.'
+                                 % PROMETHEUS_FILE)
+        parser.add_argument('--chunk-hours', type=int, default=DEFAULT_CHUNK_HOURS,
+                            help='Size of a backfill chunk in hours. Default is %d.' % DEFAULT_CHUNK_HOURS)
+        parser.add_argument('--stream', action='store_true',
+                            help='Backfill each series with a single streamed query instead of in chunks of '
+                                 '--chunk-hours. Memory use stays flat regardless of the range.')
+        parser.add_argument('--chunk-rows', type=int, default=STREAM_CHUNK_ROWS,
+                            help='Rows written to curw_obs at a time by a streamed backfill. Default is %d.'
+                                 % STREAM_CHUNK_ROWS)
+        parser.add_argument('--reconcile-interval', type=int, default=DEFAULT_RECONCILE_INTERVAL,
+                            help='Seconds between reconciliation cycles, which re-read a wider window to pick up '
+                                 'late source rows. 0 disables them. Default is %d.' % DEFAULT_RECONCILE_INTERVAL)
+        parser.add_argument('--reconcile-minutes', type=int, default=DEFAULT_RECONCILE_MINUTES,
+                            help='Window re-read by a reconciliation cycle in minutes. Default is %d.'
+                                 % DEFAULT_RECONCILE_MINUTES)
+        parser.add_argument('--job-timeout', type=int, default=DEFAULT_JOB_TIMEOUT,
+                            help='Seconds a single station/variable job may run before it is deferred to the next '
+                                 'cycle. Default is %d.' % DEFAULT_JOB_TIMEOUT)
+        parser.add_argument('--cycle-deadline', type=int, default=DEFAULT_CYCLE_DEADLINE,
+                            help='Seconds a cycle may run. Series not pushed by then are deferred to the next cycle. '
+                                 '0 disables it. Default is %d.' % DEFAULT_CYCLE_DEADLINE)
+        parser.add_argument('--extract-pool-size', type=int,
+                            help='Number of curw_iot connections. Default is the worker count.')
+        parser.add_argument('--query-timeout', type=int, default=DEFAULT_QUERY_TIMEOUT,
+                            help='Seconds a curw_iot query may run. 0 disables it. It does not apply to the queries '
+                                 'of a --stream backfill, which run as long as the stream. Default is %d.'
+                                 % DEFAULT_QUERY_TIMEOUT)
+        parser.add_argument('--event-id-ttl', type=int, default=DEFAULT_EVENT_ID_TTL,
+                            help='Seconds a resolved curw_iot event id is cached. Default is %d.' % DEFAULT_EVENT_ID_TTL)
+        parser.add_argument('--event-id-negative-ttl', type=int, default=DEFAULT_EVENT_ID_NEGATIVE_TTL,
+                            help='Seconds a series missing from curw_iot is cached as missing. Default is %d.'
+                                 % DEFAULT_EVENT_ID_NEGATIVE_TTL)
+        parser.add_argument('--skip-unchanged', action='store_true',
+                            help='Leave rows already written with the same value out of the upserts.')
+        parser.add_argument('--profile-startup', action='store_true',
+                            help='Report import and connection setup times before running.')
+        parser.add_argument('--shards', type=int, default=0,
+                            help='Run as one of several pusher nodes, each pushing the series of the shards it leases '
+                                 'in curw_obs. Number of shards the series are hashed to. Every node must use the '
+                                 'same number. 0 pushes every series. Default is 0.')
+        parser.add_argument('--node-id',
+                            help='Id of this node in sharded mode. Default is the host name.')
+        parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS,
+                            help='Seconds a shard lease lasts unless renewed by a cycle. Shards of a node which stopped '
+                                 'are failed over after it. Default is %d.' % DEFAULT_LEASE_SECONDS)
+        args = parser.parse_args()
+
+        print('\n\nCommandline Options:', args)
+
+        if args.config:
+            config_path = os.path.join(ROOT_DIR, args.config)
+        else:
+            config_path = os.path.join(ROOT_DIR, './CONFIG.json')
+        forceInsert = args.force
+
+        startup_timings = [('imports', IMPORT_SECONDS)]
+        step_started = time.perf_counter()
+        pool = get_Pool(host=CURW_OBS_HOST, port=CURW_OBS_PORT, user=CURW_OBS_USERNAME, password=CURW_OBS_PASSWORD,
+                        db=CURW_OBS_DATABASE)
+        startup_timings.append(('curw_obs pool', time.perf_counter() - step_started))
+
+        shard_leases = None
+        if args.shards > 0:
+            shard_leases = ShardLeases(pool, args.node_id, args.shards, max(1, args.lease_seconds))
+
+        step_started = time.perf_counter()
+        pusher = pusher_class(pool, config_path, workers=args.workers,
+                              metrics_path=os.path.join(ROOT_DIR, args.metrics_file),
+                              prometheus_path=os.path.join(ROOT_DIR, args.prometheus_file),
+                              reconcile_interval=max(0, args.reconcile_interval),
+                              reconcile_minutes=max(1, args.reconcile_minutes),
+                              skip_unchanged=args.skip_unchanged,
+                              job_timeout=max(1, args.job_timeout),
+                              cycle_deadline=max(0, args.cycle_deadline),
+                              extract_pool_size=max(1, args.extract_pool_size or args.workers),
+                              query_timeout=max(0, args.query_timeout),
+                              event_id_ttl=max(0, args.event_id_ttl),
+                              event_id_negative_ttl=max(0, args.event_id_negative_ttl),
+                              shard_leases=shard_leases, metrics_per_series=args.metrics_per_series)
+        startup_timings.append(('station plan', time.perf_counter() - step_started))
+
+        if args.profile_startup:
+            step_started = time.perf_counter()
+            pusher.extract_pool.run(lambda adapter: adapter.connection.ping(reconnect=False))
+            startup_timings.append(('curw_iot connection', time.perf_counter() - step_started))
+            print_startup_profile(startup_timings)
+
+        if (args.from_datetime is None) != (args.to_datetime is None):
+            parser.error('--from and --to should be given together.')
+
+        if args.from_datetime is not None:
+            with CycleLock(os.path.join(ROOT_DIR, BACKFILL_LOCK_FILE)) as locked:
+                if not locked:
+                    print("Another backfill is running. Try the backfill again later.")
+                else:
+                    pusher.run_backfill(args.from_datetime, args.to_datetime, max(1, args.chunk_hours),
+                                        stream=args.stream, chunk_rows=max(1, args.chunk_rows))
+        elif args.daemon:
+            run_daemon(pusher, max(1, args.interval))
+        else:
+            run_locked_cycle(pusher)
+
+    except Exception as ex:
+        print('Error occurred while extracting and pushing data:', ex)
+
+    finally:
+        abandoned = False
+        if pusher is not None:
+            abandoned = pusher.close()
+        if pool is not None:
+            destroy_Pool(pool=pool)
+        if abandoned:
+            # The interpreter joins every worker thread on exit, so a hung job would keep the process alive after the
+            # cycle lock is released, and cron would pile them up. Everything is written and closed by now.
+            print("Exiting without waiting for the jobs abandoned as overrun.")
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
 
-except Exception as ex:
-    print('Error occurred while extracting and pushing data:', ex)
 
-finally:
-    destroy_Pool(pool=pool)
+if __name__ == '__main__':
+    main()
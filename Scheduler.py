@@ -0,0 +1,83 @@
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# Default priority of the variables. Lower runs first. Precipitation and water level feed the flood models.
+DEFAULT_VARIABLE_PRIORITIES = {
+    'Precipitation': 0,
+    'Waterlevel': 0
+}
+DEFAULT_PRIORITY = 1
+
+# How often jobs are checked against their timeout while they wait for a worker
+POLL_SECONDS = 0.5
+
+
+def variable_priority(variable, priorities=None):
+    """
+    :param variable: str: e.g. "Precipitation"
+    :param priorities: dict of variable -> priority overriding DEFAULT_VARIABLE_PRIORITIES
+    :return: int: priority of the variable. Lower runs first.
+    """
+    if priorities is not None and variable in priorities:
+        try:
+            return int(priorities[variable])
+        except (TypeError, ValueError):
+            print("Ignoring invalid priority of %s: %s" % (variable, priorities[variable]))
+    return DEFAULT_VARIABLE_PRIORITIES.get(variable, DEFAULT_PRIORITY)
+
+
+def run_jobs(executor, jobs, job_timeout=None, deadline=None):
+    """
+    Run jobs on an executor, in the given order, without letting a slow job hold up the caller.
+    A job overruns when it has been running for longer than job_timeout, or is still pending at the deadline. Jobs
+    which haven't started by then are cancelled. Python threads can't be killed, so an overrunning job which already
+    started keeps its worker until it returns, and its result is ignored.
+    :param executor: concurrent.futures.Executor
+    :param jobs: list of (key, function, args)
+    :param job_timeout: float: max seconds a job may run, or None
+    :param deadline: float: time.perf_counter() by which all the jobs should be done, or None
+    :return: (dict of key -> (True, result) | (False, exception), list of keys of the jobs which overran)
+    """
+    started = {}
+
+    def run(key, function, args):
+        started[key] = time.perf_counter()
+        return function(*args)
+
+    futures = {executor.submit(run, key, function, args): key for key, function, args in jobs}
+    results = {}
+    overrun = []
+    pending = set(futures)
+    while pending:
+        now = time.perf_counter()
+        timeouts = []
+        if deadline is not None:
+            timeouts.append(deadline - now)
+        if job_timeout is not None:
+            timeouts.append(POLL_SECONDS)
+            timeouts.extend(started[futures[future]] + job_timeout - now
+                            for future in pending if futures[future] in started)
+        done, pending = wait(pending, timeout=max(0.0, min(timeouts)) if timeouts else None,
+                             return_when=FIRST_COMPLETED)
+
+        for future in done:
+            try:
+                results[futures[future]] = (True, future.result())
+            except Exception as ex:
+                results[futures[future]] = (False, ex)
+
+        now = time.perf_counter()
+        if deadline is not None and now >= deadline:
+            for future in pending:
+                future.cancel()
+                overrun.append(futures[future])
+            break
+
+        if job_timeout is not None:
+            for future in list(pending):
+                key = futures[future]
+                if key in started and now - started[key] >= job_timeout:
+                    pending.discard(future)
+                    overrun.append(key)
+
+    return results, overrun
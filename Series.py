@@ -0,0 +1,126 @@
+from datetime import datetime
+
+import numpy as np
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_EMPTY_TIMES = np.empty(0, dtype=np.int64)
+_EMPTY_VALUES = np.empty(0, dtype=np.float64)
+
+
+def to_epoch(time):
+    """
+    :param time: str: e.g. "2019-07-01 00:00:00", or datetime. Naive local time, kept as it is.
+    :return: int: seconds since 1970-01-01 00:00:00 of the same wall clock time
+    """
+    if not isinstance(time, datetime):
+        time = datetime.strptime(str(time)[:19], DATE_FORMAT)
+    return int(np.datetime64(time.replace(tzinfo=None), 's').astype(np.int64))
+
+
+def format_epochs(times):
+    """
+    :param times: array of epoch seconds
+    :return: list of str: e.g. ["2019-07-01 00:00:00", ...]
+    """
+    if len(times) <= 0:
+        return []
+    return np.char.replace(np.datetime_as_string(np.asarray(times).astype('datetime64[s]'), unit='s'), 'T', ' ')\
+        .tolist()
+
+
+class Series:
+    """
+    Compact timeseries passed from extraction through quality control and the processors to the writer: epoch second
+    timestamps (int64) and values (float64, NaN for a missing value) in two NumPy arrays, instead of a list of
+    [time string, value] lists. Timestamps are only formatted when they are written out.
+    """
+    __slots__ = ('times', 'values', 'tms_id', 'unit', 'unit_type')
+
+    def __init__(self, times=None, values=None, tms_id=None, unit=None, unit_type=None):
+        """
+        :param times: array of epoch seconds, ascending
+        :param values: array of values, as long as times
+        :param tms_id: str: curw_obs timeseries (hash) id, if known
+        :param unit: str: e.g. "mm"
+        :param unit_type: str: e.g. "Accumulative"
+        """
+        self.times = _EMPTY_TIMES if times is None else np.asarray(times, dtype=np.int64)
+        self.values = _EMPTY_VALUES if values is None else np.asarray(values, dtype=np.float64)
+        self.tms_id = tms_id
+        self.unit = unit
+        self.unit_type = unit_type
+
+    @classmethod
+    def from_rows(cls, rows, tms_id=None, unit=None, unit_type=None):
+        """
+        :param rows: list of [time, value] lists. time is a str or datetime. Invalid rows are skipped.
+        :return: Series
+        """
+        times = []
+        values = []
+        for t in rows:
+            if len(t) > 1:
+                times.append(to_epoch(t[0]))
+                values.append(t[1])
+            else:
+                print('Invalid timeseries data:: %s', t)
+        return cls(np.array(times, dtype=np.int64), np.array(values, dtype=np.float64), tms_id, unit, unit_type)
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        :param parts: list of Series, in time order. Metadata is taken from the last one.
+        :return: Series
+        """
+        parts = [part for part in parts if len(part) > 0] or parts[-1:]
+        if len(parts) == 1:
+            return parts[0]
+        return parts[-1].derive(np.concatenate([part.times for part in parts]),
+                                np.concatenate([part.values for part in parts]))
+
+    def derive(self, times, values):
+        """
+        :return: Series of the given arrays with the metadata of this one
+        """
+        return Series(times, values, self.tms_id, self.unit, self.unit_type)
+
+    def take(self, selection):
+        """
+        :param selection: boolean mask or index array
+        :return: Series of the selected rows
+        """
+        return self.derive(self.times[selection], self.values[selection])
+
+    def tail(self, count=1):
+        return self.derive(self.times[-count:], self.values[-count:])
+
+    def time_at(self, index):
+        """
+        :return: str: formatted timestamp of a row
+        """
+        return format_epochs(self.times[index:index + 1 or None])[0]
+
+    def time_strings(self):
+        return format_epochs(self.times)
+
+    def value_list(self):
+        """
+        :return: list of float values, None for a missing value
+        """
+        values = self.values.tolist()
+        if np.isnan(self.values).any():
+            values = [None if value != value else value for value in values]
+        return values
+
+    def to_rows(self):
+        """
+        :return: list of [time string, value] lists
+        """
+        return [[time, value] for time, value in zip(self.time_strings(), self.value_list())]
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return 'Series(tms_id=%s, rows=%d)' % (self.tms_id, len(self))
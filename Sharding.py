@@ -0,0 +1,180 @@
+import hashlib
+import math
+import socket
+import time
+import traceback
+
+# Series are hashed to a fixed number of shards, and pusher nodes lease shards. Every node must use the same count.
+DEFAULT_SHARD_COUNT = 64
+
+# Seconds a lease lasts unless renewed. Should span a few cycles: a node which stops renewing is failed over after it.
+DEFAULT_LEASE_SECONDS = 900
+
+LEASE_TABLE = 'pusher_lease'
+NODE_TABLE = 'pusher_node'
+
+
+def default_node_id():
+    """
+    :return: str: id of this pusher node. Stable across cron runs on the same host.
+    """
+    return socket.gethostname()
+
+
+def shard_of(obs_hash_id, shard_count=DEFAULT_SHARD_COUNT):
+    """
+    :param obs_hash_id: str: curw_obs timeseries (hash) id
+    :param shard_count: int: number of shards
+    :return: int: shard of the series. Doesn't depend on the nodes, so only shard ownership moves when nodes come
+    and go.
+    """
+    return int(hashlib.sha256(obs_hash_id.encode()).hexdigest()[:8], 16) % shard_count
+
+
+def _preference(node_id, shard):
+    # Rendezvous hashing: every node prefers a different order of the shards, so nodes starting together don't all
+    # race for the same free shards.
+    return hashlib.sha256(('%s:%d' % (node_id, shard)).encode()).hexdigest()
+
+
+class ShardLeases:
+    """
+    Time limited leases of shards, held in a small curw_obs table (one row per shard: owning node and expiry in
+    unix seconds of the database clock), next to a heartbeat table of the live nodes. On every acquire() a node
+    renews its heartbeat and leases, hands back the shards above its fair share (shard count / live nodes) so new
+    nodes get some, and claims free or expired shards up to it.
+    Claims are compare-and-set updates, so two nodes never hold the same shard at once. A node which stops renewing
+    loses its shards to the others once its leases expire. Writes are upserts, so a node still finishing a cycle on
+    a shard it just lost only rewrites the same rows.
+    """
+
+    def __init__(self, pool, node_id=None, shard_count=DEFAULT_SHARD_COUNT, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.pool = pool
+        self.node_id = node_id or default_node_id()
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.table_ready = False
+        self.shards = set()
+        self.valid_until = 0.0
+
+    def _ensure_table(self, cursor):
+        if self.table_ready:
+            return
+        cursor.execute("CREATE TABLE IF NOT EXISTS `{}` ("
+                       "`shard` INT NOT NULL PRIMARY KEY, "
+                       "`node` VARCHAR(255) NOT NULL DEFAULT '', "
+                       "`expires_at` BIGINT NOT NULL DEFAULT 0)".format(LEASE_TABLE))
+        cursor.execute("INSERT IGNORE INTO `{}` (`shard`, `node`, `expires_at`) VALUES {}"
+                       .format(LEASE_TABLE, ', '.join(["(%s, '', 0)"] * self.shard_count)),
+                       list(range(self.shard_count)))
+        cursor.execute("CREATE TABLE IF NOT EXISTS `{}` ("
+                       "`node` VARCHAR(255) NOT NULL PRIMARY KEY, "
+                       "`expires_at` BIGINT NOT NULL DEFAULT 0)".format(NODE_TABLE))
+        self.table_ready = True
+
+    def acquire(self):
+        """
+        Renew, rebalance and claim shard leases
+        :return: set of shards owned by this node. If the lease table can't be reached, the shards of the last
+        acquire are kept until their leases would have expired.
+        """
+        started = time.monotonic()
+        connection = None
+        try:
+            connection = self.pool.connection()
+            with connection.cursor() as cursor:
+                self._ensure_table(cursor)
+                cursor.execute("SELECT `shard`, `node`, `expires_at`, UNIX_TIMESTAMP() AS `now` FROM `{}` "
+                               "WHERE `shard` < %s".format(LEASE_TABLE), [self.shard_count])
+                rows = cursor.fetchall()
+                now = rows[0]['now'] if len(rows) > 0 else int(time.time())
+                expires_at = now + self.lease_seconds
+
+                # Heartbeat, so the other nodes count this one even while it holds no shards
+                cursor.execute("INSERT IGNORE INTO `{}` (`node`, `expires_at`) VALUES (%s, %s)".format(NODE_TABLE),
+                               [self.node_id, expires_at])
+                cursor.execute("UPDATE `{}` SET `expires_at`=%s WHERE `node`=%s".format(NODE_TABLE),
+                               [expires_at, self.node_id])
+                cursor.execute("SELECT `node` FROM `{}` WHERE `expires_at` > %s".format(NODE_TABLE), [now])
+                live_nodes = set(row['node'] for row in cursor.fetchall())
+                live_nodes.add(self.node_id)
+                fair_share = int(math.ceil(self.shard_count / float(len(live_nodes))))
+
+                owned = sorted((row['shard'] for row in rows if row['node'] == self.node_id),
+                               key=lambda shard: _preference(self.node_id, shard))
+                extra = owned[fair_share:]
+                owned = owned[:fair_share]
+                if len(extra) > 0:
+                    cursor.execute("UPDATE `{}` SET `node`='', `expires_at`=0 WHERE `node`=%s AND `shard` IN ({})"
+                                   .format(LEASE_TABLE, ', '.join(['%s'] * len(extra))), [self.node_id] + extra)
+                    print("Released %d shards for the other %d pusher nodes." % (len(extra), len(live_nodes) - 1))
+                if len(owned) > 0:
+                    cursor.execute("UPDATE `{}` SET `expires_at`=%s WHERE `node`=%s AND `shard` IN ({})"
+                                   .format(LEASE_TABLE, ', '.join(['%s'] * len(owned))),
+                                   [expires_at, self.node_id] + owned)
+
+                free = sorted((row['shard'] for row in rows
+                               if row['node'] != self.node_id and (row['node'] == '' or row['expires_at'] <= now)),
+                              key=lambda shard: _preference(self.node_id, shard))
+                claimed = 0
+                for shard in free[:max(0, fair_share - len(owned))]:
+                    claimed += cursor.execute("UPDATE `{}` SET `node`=%s, `expires_at`=%s "
+                                              "WHERE `shard`=%s AND (`node`='' OR `expires_at` <= UNIX_TIMESTAMP())"
+                                              .format(LEASE_TABLE), [self.node_id, expires_at, shard])
+
+                cursor.execute("SELECT `shard` FROM `{}` WHERE `node`=%s AND `expires_at` > UNIX_TIMESTAMP() AND "
+                               "`shard` < %s".format(LEASE_TABLE), [self.node_id, self.shard_count])
+                shards = set(row['shard'] for row in cursor.fetchall())
+
+            connection.commit()
+            if claimed > 0:
+                print("Claimed %d free shards." % claimed)
+            self.shards = shards
+            # Leases are timed by the database clock. The local fallback counts from before they were renewed, so it
+            # never outlives them.
+            self.valid_until = started + self.lease_seconds
+            print("Pusher node %s holds %d of %d shards (%d live nodes)."
+                  % (self.node_id, len(self.shards), self.shard_count, len(live_nodes)))
+            return set(self.shards)
+
+        except Exception:
+            if connection is not None:
+                connection.rollback()
+            traceback.print_exc()
+            print("Exception occurred while acquiring shard leases of node {}".format(self.node_id))
+            if time.monotonic() >= self.valid_until:
+                self.shards = set()
+            print("Continuing with the %d shards leased before." % len(self.shards))
+            return set(self.shards)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def release(self):
+        """
+        Hand back every shard of this node, so the other nodes take them over without waiting for the leases to expire
+        """
+        connection = None
+        try:
+            connection = self.pool.connection()
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE `{}` SET `node`='', `expires_at`=0 WHERE `node`=%s".format(LEASE_TABLE),
+                               [self.node_id])
+                cursor.execute("DELETE FROM `{}` WHERE `node`=%s".format(NODE_TABLE), [self.node_id])
+            connection.commit()
+            self.shards = set()
+            self.valid_until = 0.0
+        except Exception:
+            if connection is not None:
+                connection.rollback()
+            traceback.print_exc()
+            print("Exception occurred while releasing shard leases of node {}".format(self.node_id))
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def owns(self, obs_hash_id):
+        """
+        :return: True if the series falls into a shard leased by this node on the last acquire
+        """
+        return shard_of(obs_hash_id, self.shard_count) in self.shards
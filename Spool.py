@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+import traceback
+
+import pymysql
+
+# Max rows kept in the spool. Beyond this the oldest rows are dropped on compaction; they can still be re-extracted
+# from curw_iot.
+MAX_SPOOL_ROWS = 2000000
+
+# Rows per multi-row upsert while replaying the spool
+REPLAY_BATCH_SIZE = 5000
+
+# Errors curw_obs raises for the rows themselves. Replaying the series again won't fix them, so they are quarantined.
+# Any other error (e.g. curw_obs unreachable, a lock wait timeout) may pass, so the series stay in the spool.
+DATA_ERRORS = (pymysql.err.IntegrityError, pymysql.err.DataError)
+
+
+class WriteSpool:
+    """
+    Local, append-only spool of the curw_obs writes that failed. Each line of the spool file is a json object
+    {"tms_id": str, "end_date": str, "rows": [[time, value], ...]}, so a crash mid-append loses at most the last
+    line. The spool is replayed with large bulk upserts on the next healthy cycle, and compacted (rows deduplicated by
+    tms_id and time, oldest rows dropped beyond max_rows) whenever a replay fails or it grows past max_rows.
+    Series curw_obs rejects with a data error are moved to a quarantine file next to the spool.
+    """
+
+    def __init__(self, path, max_rows=MAX_SPOOL_ROWS):
+        self.path = path
+        self.quarantine_path = path + '.quarantine'
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.row_count = None
+        self.end_dates = None
+        self.quarantined_rows = 0
+
+    def _load_index(self):
+        if self.row_count is None:
+            series = self._read()
+            self.row_count = sum(len(rows) for rows, _ in series.values())
+            self.end_dates = {tms_id: end_date for tms_id, (_, end_date) in series.items()}
+
+    def _read(self):
+        """
+        :return: dict of tms_id -> ({time: value}, end_date), merged across all the spool lines
+        """
+        series = {}
+        if not os.path.exists(self.path):
+            return series
+
+        with open(self.path) as spool_file:
+            for line_number, line in enumerate(spool_file, start=1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print("Skipping unreadable line %d of write spool %s." % (line_number, self.path))
+                    continue
+                rows, end_date = series.setdefault(record['tms_id'], ({}, record['end_date']))
+                for time, value in record['rows']:
+                    rows[time] = value
+                series[record['tms_id']] = (rows, max(end_date, record['end_date']))
+        return series
+
+    def _write(self, series):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as spool_file:
+            for tms_id, (rows, end_date) in sorted(series.items()):
+                spool_file.write(json.dumps({'tms_id': tms_id, 'end_date': end_date,
+                                             'rows': sorted([time, value] for time, value in rows.items())}) + '\n')
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _ends_with_newline(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) <= 0:
+            return True
+        with open(self.path, 'rb') as spool_file:
+            spool_file.seek(-1, os.SEEK_END)
+            return spool_file.read(1) == b'\n'
+
+    def is_empty(self):
+        with self.lock:
+            self._load_index()
+            return self.row_count <= 0
+
+    def get_end_dates(self):
+        """
+        :return: dict of tms_id -> latest spooled time. Lets a cycle continue from the spooled data while curw_obs
+        is unreachable.
+        """
+        with self.lock:
+            self._load_index()
+            return dict(self.end_dates)
+
+    def append(self, series):
+        """
+        Durably append failed writes to the spool
+        :param series: list of (tms_id, Series, end_date), as held by TimeseriesWriter
+        :return: number of rows spooled
+        """
+        row_count = 0
+        with self.lock:
+            self._load_index()
+            try:
+                with open(self.path, 'a') as spool_file:
+                    if not self._ends_with_newline():
+                        # Terminate a line left partially written by a crash, so it doesn't swallow the next one.
+                        spool_file.write('\n')
+                    for tms_id, rows, end_date in series:
+                        spool_file.write(json.dumps({'tms_id': tms_id, 'end_date': end_date,
+                                                     'rows': rows.to_rows()}) + '\n')
+                        row_count += len(rows)
+                        if end_date > self.end_dates.get(tms_id, ''):
+                            self.end_dates[tms_id] = end_date
+                    spool_file.flush()
+                    os.fsync(spool_file.fileno())
+            except Exception:
+                traceback.print_exc()
+                print("Exception occurred while spooling {} rows to {}".format(row_count, self.path))
+                self.row_count = None
+                return 0
+
+            self.row_count += row_count
+            if self.row_count > self.max_rows:
+                self._compact()
+        return row_count
+
+    def _compact(self, series=None):
+        if series is None:
+            series = self._read()
+
+        row_count = sum(len(rows) for rows, _ in series.values())
+        if row_count > self.max_rows:
+            # Drop the oldest rows across all the series
+            times = sorted(time for rows, _ in series.values() for time in rows)
+            cutoff = times[row_count - self.max_rows - 1]
+            dropped = 0
+            for rows, _ in series.values():
+                for time in [time for time in rows if time <= cutoff]:
+                    del rows[time]
+                    dropped += 1
+            print("Write spool is full. Dropped %d rows up to %s." % (dropped, cutoff))
+            series = {tms_id: (rows, end_date) for tms_id, (rows, end_date) in series.items() if len(rows) > 0}
+
+        self._write(series)
+        self.row_count = sum(len(rows) for rows, _ in series.values())
+        self.end_dates = {tms_id: end_date for tms_id, (_, end_date) in series.items()}
+
+    @staticmethod
+    def _flush(writer_factory, series):
+        """
+        Write spooled series to curw_obs in one transaction
+        :param series: dict of tms_id -> ({time: value}, end_date)
+        :return: (number of rows inserted, exception the write failed with or None)
+        """
+        writer = writer_factory(REPLAY_BATCH_SIZE)
+        for tms_id, (rows, end_date) in series.items():
+            writer.add(tms_id=tms_id, timeseries=sorted([time, value] for time, value in rows.items()),
+                       end_date=end_date)
+        inserted_rows = writer.flush()
+        if len(writer.failed_series) > 0:
+            return inserted_rows, writer.error or Exception('write failed')
+        return inserted_rows, None
+
+    def _quarantine(self, series):
+        """
+        Move series curw_obs rejects out of the spool into quarantine_path, in the spool's format, so they don't
+        block the replay of the rest. Nothing replays the quarantine file: fix the rows and append them back to the
+        spool to push them.
+        :param series: dict of tms_id -> ({time: value}, end_date)
+        :return: True if the series were quarantined
+        """
+        try:
+            with open(self.quarantine_path, 'a') as quarantine_file:
+                for tms_id, (rows, end_date) in sorted(series.items()):
+                    quarantine_file.write(json.dumps({'tms_id': tms_id, 'end_date': end_date,
+                                                      'rows': sorted([time, value] for time, value in rows.items())})
+                                          + '\n')
+                quarantine_file.flush()
+                os.fsync(quarantine_file.fileno())
+        except Exception:
+            traceback.print_exc()
+            print("Exception occurred while quarantining {} timeseries to {}".format(len(series), self.quarantine_path))
+            return False
+
+        print("Quarantined %d rows of %d timeseries curw_obs rejected to %s: %s"
+              % (sum(len(rows) for rows, _ in series.values()), len(series), self.quarantine_path,
+                 ', '.join(sorted(series))))
+        return True
+
+    def replay(self, writer_factory):
+        """
+        Write the spooled rows to curw_obs. The spool is cleared if the write succeeds. If the bulk write fails with a
+        data error (see DATA_ERRORS), the series are written one at a time, and the ones curw_obs rejects with a data
+        error are quarantined instead of failing every later replay. Any other error keeps the rest of the spool for
+        the next replay, without trying the series one by one: curw_obs is likely down, and every attempt could wait
+        out the connect timeout. quarantined_rows is set to the rows quarantined by the replay.
+        :param writer_factory: function(batch_size) -> Utils.TimeseriesWriter
+        :return: number of rows replayed
+        """
+        with self.lock:
+            self.quarantined_rows = 0
+            series = self._read()
+            if len(series) <= 0:
+                self.row_count = 0
+                self.end_dates = {}
+                return 0
+
+            row_count = sum(len(rows) for rows, _ in series.values())
+            inserted_rows, error = self._flush(writer_factory, series)
+            replayed_series = len(series)
+            remaining = {}
+            if error is not None and not isinstance(error, DATA_ERRORS):
+                remaining = series
+            elif error is not None:
+                print("Replaying %d spooled rows at once failed. Replaying them a timeseries at a time." % row_count)
+                rejected = {}
+                for tms_id, item in series.items():
+                    if error is not None and not isinstance(error, DATA_ERRORS):
+                        # Stop at the first other error. The series not tried yet stay in the spool.
+                        remaining[tms_id] = item
+                        continue
+                    series_rows, error = self._flush(writer_factory, {tms_id: item})
+                    if error is None:
+                        inserted_rows += series_rows
+                    elif isinstance(error, DATA_ERRORS):
+                        rejected[tms_id] = item
+                    else:
+                        remaining[tms_id] = item
+                if len(rejected) > 0 and self._quarantine(rejected):
+                    self.quarantined_rows = sum(len(rows) for rows, _ in rejected.values())
+                    replayed_series -= len(rejected)
+                else:
+                    remaining.update(rejected)
+                replayed_series -= len(remaining)
+
+            try:
+                if len(remaining) <= 0:
+                    os.remove(self.path)
+                    self.row_count = 0
+                    self.end_dates = {}
+                    print("Replayed %d spooled rows of %d timeseries to curw_obs." % (inserted_rows, replayed_series))
+                else:
+                    self._compact(remaining)
+                    print("Replaying %d spooled rows failed. Kept them in %s."
+                          % (sum(len(rows) for rows, _ in remaining.values()), self.path))
+            except Exception:
+                traceback.print_exc()
+                print("Exception occurred while updating write spool {}".format(self.path))
+                self.row_count = None
+            return inserted_rows
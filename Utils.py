@@ -1,9 +1,14 @@
 import copy
-import decimal
+import hashlib
+import json
+import os
+import threading
+import time
 import traceback
-import pandas as pd
+import pymysql
+import numpy as np
+from collections import namedtuple
 from datetime import datetime, timedelta
-import pandas as pd
 
 
 from db_adapter.curw_obs.station import StationEnum, get_station_id, add_station, update_description
@@ -13,6 +18,9 @@ from db_adapter.curw_obs.timeseries import Timeseries
 
 from curwmysqladapter import TimeseriesGroupOperation, Station, Data
 
+from Metrics import STAGE_HASH_ID, STAGE_QC
+from Series import Series, to_epoch, format_epochs
+
 CURW_WEATHER_STATION = 'CUrW_WeatherStation'
 CURW_WATER_LEVEL_STATION = 'CUrW_WaterLevelGauge'
 CURW_CROSS_SECTION = 'CUrW_CrossSection'
@@ -26,387 +34,509 @@ timeseries_meta_struct = {
     'source': '',
     'name': ''
 }
-def get_time_duration(pre_datetime, lat_datetime):
-
-    datetime_lat = datetime.strptime(lat_datetime, '%Y-%m-%d %H:%M:%S')
-    datetime_pre = datetime.strptime(pre_datetime, '%Y-%m-%d %H:%M:%S')
-
-    duration = datetime_lat - datetime_pre
-
-    duration_in_s = duration.total_seconds()
-    minutes = divmod(duration_in_s, 60)[0]
-
-    return minutes
-
-def get_missing_timsesries(dur_minutes, instantaneous_percipitation, pre_datetime, lat_datetime):
-    no_intervals = int(dur_minutes / 5)
-
-    #no_intervals_1 = int(no_intervals)
-
-    avg_precip = instantaneous_percipitation / no_intervals
-
-    #precep_arr = [avg_precip for _ in range(no_intervals_1 - 1)]
-
-
-    datetime_range = [pre_datetime, lat_datetime]
-    str_timeseries = [str(x) for x in datetime_range]
-
 
-    df_prd_timeseries = pd.period_range(str_timeseries[0], str_timeseries[1], freq="5T0S")
-    df_prd_timeseries = df_prd_timeseries[1:-1]
+# Max number of timeseries fetched by a single bulk extraction statement
+BULK_EXTRACT_BATCH_SIZE = 500
 
-    df_timeseries = df_prd_timeseries.to_series()
-    timeseries_s = [str(x) for x in df_timeseries]
+# Max number of rows sent to curw_obs by a single multi-row upsert
+UPSERT_BATCH_SIZE = 1000
 
+# Rows fetched from curw_iot at a time while streaming a timeseries
+STREAM_FETCH_ROWS = 1000
 
-    #new_timeseries = []
-    timeseries = []
-    for time in timeseries_s:
-        time_1 = datetime.strptime(time, '%Y-%m-%d %H:%M')
-        time = time_1.strftime('%Y-%m-%d %H:%M:00')
-        timeseries.append([time, avg_precip])
+# Rows buffered by ChunkedWriter before they are written to curw_obs
+STREAM_CHUNK_ROWS = 10000
 
-    print(timeseries)
-    timeseries.append([lat_datetime, avg_precip])
-    return timeseries
 
 def _precipitation_timeseries_processor(timeseries, _=None):
-    if timeseries is None or len(timeseries) <= 0:
-        return []
+    """
+    Convert a cumulative precipitation timeseries into 5 minute precipitation values.
+    Works on whole arrays instead of walking the timeseries row by row.
+    - Negative differences and differences beyond the quality control value are set to 0.
+    - Differences over gaps of 9 to 60 minutes are spread evenly across the missing 5 minute steps.
+    - Readings without a value are skipped.
+    :param timeseries: Series of cumulative values
+    :return: Series
+    """
+    if timeseries is None:
+        return Series()
+    timeseries = timeseries.take(~np.isnan(timeseries.values))
+    if len(timeseries) <= 1:
+        return timeseries.take(slice(0, 0))
 
     # Max value for precipitation in 100 years for 5 minute time interval
-    global value
-    qualitControl = 41.63
-    index = 0
-    new_timeseries = []
-    while (index + 1) < len(timeseries):
-        pre_datetime = timeseries[index][0]
-        lat_datetime = timeseries[index + 1][0]
-
-        lat_value = float(timeseries[index + 1][1])
-        pre_value = float(timeseries[index][1])
-
-        instantaneous_percipitation = lat_value - pre_value
-
-        dur_minutes = get_time_duration(pre_datetime, lat_datetime)
-        resample_timeseries = []
-
-        if instantaneous_percipitation < 0:
-            value = 0
-
-
-        elif 0 <= instantaneous_percipitation < qualitControl:
+    quality_control = 41.63
 
-            if dur_minutes < 9:
+    times = timeseries.times
+    instantaneous_precipitation = np.diff(timeseries.values)
+    dur_minutes = np.diff(times) // 60
 
-                value = instantaneous_percipitation
+    valid = (instantaneous_precipitation >= 0) & (instantaneous_precipitation < quality_control)
+    step_values = np.where(valid, instantaneous_precipitation, 0.0)
 
+    # Gaps of 9 to 60 minutes are filled with 5 minute steps starting from the previous timestamp (truncated to the
+    # minute), followed by the value at the latter timestamp itself.
+    gaps = valid & (dur_minutes >= 9) & (dur_minutes < 60)
+    step_values[gaps] = instantaneous_precipitation[gaps] / (dur_minutes[gaps] // 5)
 
-            elif 9 <= dur_minutes < 60:
+    pre_minutes = times[:-1] // 60
+    gap_minutes = times[1:] // 60 - pre_minutes
+    fill_counts = np.where(gaps, np.maximum(gap_minutes // 5 - 1, 0), 0)
+    rows_per_step = fill_counts + 1
 
-                resample_timeseries = get_missing_timsesries(dur_minutes, instantaneous_percipitation, pre_datetime,
+    total_rows = int(rows_per_step.sum())
+    steps = np.repeat(np.arange(len(rows_per_step)), rows_per_step)
+    step_positions = np.arange(total_rows) - np.repeat(np.cumsum(rows_per_step) - rows_per_step, rows_per_step)
+    is_fill = step_positions < fill_counts[steps]
 
-                                                             lat_datetime)
+    new_times = np.empty(total_rows, dtype=np.int64)
+    new_times[~is_fill] = times[1:]
+    new_times[is_fill] = (pre_minutes[steps[is_fill]] + (step_positions[is_fill] + 1) * 5) * 60
 
-                print(resample_timeseries)
-
-
-            elif dur_minutes >= 60:
-
-                value = instantaneous_percipitation
-
-        elif instantaneous_percipitation >= qualitControl:
-            value = 0
-
-        else:
-            value = 0
-
-        if not resample_timeseries:
-            new_timeseries.append([lat_datetime, value])
-
-        else:
-            new_timeseries.extend(resample_timeseries)
-
-
-        index += 1
-
-    return new_timeseries
+    return timeseries.derive(new_times, np.repeat(step_values, rows_per_step))
 
 
 def _waterlevel_timeseries_processor(timeseries, mean_sea_level=None, waterLevel_min=None, waterLevel_max=None):
-    # print("**_waterlevel_timeseries_processor**")
-    # print(timeseries)
-    if timeseries is None or len(timeseries) <= 0:
-        return []
+    """
+    Convert gauge readings into water levels (mean sea level - reading), keeping only the levels within
+    [waterLevel_min, waterLevel_max]. Station constants are converted once and the whole timeseries is processed as
+    float64 arrays, which hold more significant digits than the source readings carry.
+    :param timeseries: Series of gauge readings
+    :return: Series of water levels
+    """
+    if timeseries is None:
+        return Series()
+    if len(timeseries) <= 0:
+        return timeseries
 
     if mean_sea_level is None or not isinstance(mean_sea_level, (float, int)):
         raise ValueError('Invalid mean_sea_level. Should be a real number.')
 
-    new_timeseries = []
-    if decimal.Decimal(mean_sea_level) > 30.00:
-        for tms_step in timeseries:
-            wl = decimal.Decimal(mean_sea_level) - tms_step[1]
-            # Waterlevel should be in between -1 and 3
-            if decimal.Decimal(waterLevel_min) <= wl <= decimal.Decimal(waterLevel_max):
-                new_timeseries.append([tms_step[0], wl])
-    else:
-        for tms_step in timeseries:
-            wl = decimal.Decimal(mean_sea_level) - tms_step[1]
-            # Waterlevel should be in between -1 and 3
-            if decimal.Decimal(waterLevel_min) <= wl <= decimal.Decimal(waterLevel_max):
-                new_timeseries.append([tms_step[0], wl])
-    # print("New Timeseries:")
-    # print(new_timeseries)
-    return new_timeseries
-
-
-def _extract_n_push(extract_adapter, station, start_date, end_date, pool, obs_hash_id,
-                        timeseries_meta, group_operation,
-                        timeseries_processor=None, **timeseries_processor_kwargs):
-    # If there is no timeseries-id in the extracting DB then just return without doing anything.
-
-    timeseries_id = extract_adapter.get_event_id(timeseries_meta)
-    # print("*****************")
-    # print(timeseries_id)
-    # print(start_date)
-    # print(end_date)
-    # print(group_operation)
-    # print("*****************")
-    if timeseries_id is None:
-        print("No timeseries for the Precipitation of station_Id: %s in the extracting DB."
-              % station['stationId'])
-        return False
-
-    timeseries = []
-    if timeseries_processor is not None:
-        # print("1")
-        timeseries = timeseries_processor(
-            extract_adapter.extract_grouped_time_series(timeseries_id, start_date, end_date, group_operation),
-            **timeseries_processor_kwargs
-        )
-        # print(timeseries)
-    else:
-        # print("2")
-        timeseries = extract_adapter.extract_grouped_time_series(timeseries_id, start_date, end_date, group_operation)
-        # print(timeseries)
-
-    # print(timeseries,list)
-    if not isinstance(timeseries, list) or len(timeseries) <= 0:
-        print("No value in the timeseries for the %s of station_Id: %s in the extracting DB."
-              % (timeseries_meta['variable'], station['stationId']))
-        return False
+    water_levels = float(mean_sea_level) - timeseries.values
 
-    #if station['stationId'] == 'curw_wl_test':
-        #obs_hash_id = obs_hash_id_1
+    # Waterlevel should be in between -1 and 3
+    in_range = (water_levels >= float(waterLevel_min)) & (water_levels <= float(waterLevel_max))
 
-    #insert extracted time series to the curwobs db
-    inserted_rows = insert_timeseries(pool=pool, timeseries=timeseries, tms_id=obs_hash_id)
-    print("Inserted tmieseries length {} values successfully...".format(len(timeseries)))
+    return timeseries.derive(timeseries.times[in_range], water_levels[in_range])
 
-def extract_n_push_precipitation(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
 
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-    timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-    timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'Precipitation'
-    timeseries_meta['unit'] = 'mm'
-    timeseries_meta['type'] = station['type']
-    timeseries_meta['source'] = station['source']
-    timeseries_meta['name'] = station['run_name']
+def _waterlevel_processor_kwargs(station):
+    if 'mean_sea_level' not in station.keys():
+        raise AttributeError('Attribute mean_sea_level is required.')
+    return {
+        'mean_sea_level': station['mean_sea_level'],
+        'waterLevel_min': station['min_wl'],
+        'waterLevel_max': station['max_wl']
+    }
 
-    print("#############Extracting and Pushing Precipitation of Station: %s###############" % station['name'])
 
-    _extract_n_push(
-        extract_adapter,
-        station,
-        start_date,
-        end_date, pool, obs_hash_id, timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_max,
-        _precipitation_timeseries_processor)
+def _quality_control(timeseries, min_value=None, max_value=None):
+    """
+    Drop the rows whose value is outside [min_value, max_value] in a single pass over the whole timeseries.
+    Rows without a value are dropped as well.
+    :param timeseries: Series
+    :param min_value: float: lower bound, or None
+    :param max_value: float: upper bound, or None
+    :return: (Series of the rows within the bounds, number of rows dropped)
+    """
+    if timeseries is None:
+        return Series(), 0
+    if len(timeseries) <= 0:
+        return timeseries, 0
 
-def extract_n_push_temperature(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-    timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-    timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'Temperature'
-    timeseries_meta['unit'] = 'oC'
-    timeseries_meta['type'] = station['type']
-    timeseries_meta['source'] = station['source']
-    timeseries_meta['name'] = station['run_name']
+    values = timeseries.values
+    in_range = ~np.isnan(values)
+    if min_value is not None:
+        in_range &= values >= min_value
+    if max_value is not None:
+        in_range &= values <= max_value
 
-    print("#############Extracting and Pushing Temperature of Station: %s###############" % station['name'])
+    dropped = len(timeseries) - int(np.count_nonzero(in_range))
+    if dropped == 0:
+        return timeseries, 0
+    return timeseries.take(in_range), dropped
 
-    _extract_n_push(
-        extract_adapter,
-        station,
-        start_date,
-        end_date, pool, obs_hash_id,
-        timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_avg)
 
-def extract_n_push_windspeed(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-    timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-    timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'WindSpeed'
-    timeseries_meta['unit'] = 'm/s'
-    timeseries_meta['type'] = station['type']
-    timeseries_meta['source'] = station['source']
-    timeseries_meta['name'] = station['run_name']
+def _stream_precipitation_timeseries(rows, _=None):
+    """
+    Streaming variant of _precipitation_timeseries_processor. Only the previous cumulative reading, which is also
+    the start of a gap, is carried across rows, so memory doesn't grow with the length of the timeseries.
+    :param rows: iterator of (epoch seconds, cumulative value) rows, ascending
+    :return: generator of (epoch seconds, value) rows
+    """
+    # Max value for precipitation in 100 years for 5 minute time interval
+    quality_control = 41.63
+
+    pre_time = None
+    pre_value = None
+    for row_time, value in rows:
+        if value is None or value != value:
+            continue
+        if pre_time is None:
+            pre_time, pre_value = row_time, value
+            continue
+
+        instantaneous_precipitation = value - pre_value
+        dur_minutes = (row_time - pre_time) // 60
+        if not 0 <= instantaneous_precipitation < quality_control:
+            yield row_time, 0.0
+        elif 9 <= dur_minutes < 60:
+            # Same 5 minute steps as the array processor: from the previous timestamp truncated to the minute
+            step_value = instantaneous_precipitation / (dur_minutes // 5)
+            pre_minute = pre_time // 60
+            for step in range(1, (row_time // 60 - pre_minute) // 5):
+                yield (pre_minute + step * 5) * 60, step_value
+            yield row_time, step_value
+        else:
+            yield row_time, instantaneous_precipitation
 
-    print("#############Extracting and Pushing WindSpeed of Station: %s###############" % station['name'])
+        pre_time, pre_value = row_time, value
 
-    _extract_n_push(
-        extract_adapter,
-        station,
-        start_date,
-        end_date, pool, obs_hash_id,
-        timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_avg)
 
-def extract_n_push_windgust(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-    timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-    timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'WindGust'
-    timeseries_meta['unit'] = 'm/s'
-    timeseries_meta['type'] = station['type']
-    timeseries_meta['source'] = station['source']
-    timeseries_meta['name'] = station['run_name']
+def _stream_waterlevel_timeseries(rows, mean_sea_level=None, waterLevel_min=None, waterLevel_max=None):
+    """
+    Streaming variant of _waterlevel_timeseries_processor
+    :param rows: iterator of (epoch seconds, reading) rows
+    :return: generator of (epoch seconds, water level) rows
+    """
+    if mean_sea_level is None or not isinstance(mean_sea_level, (float, int)):
+        raise ValueError('Invalid mean_sea_level. Should be a real number.')
 
-    print("#############Extracting and Pushing WindGust of Station: %s###############" % station['name'])
+    mean_sea_level = float(mean_sea_level)
+    waterLevel_min = float(waterLevel_min)
+    waterLevel_max = float(waterLevel_max)
+    return ((row_time, mean_sea_level - reading) for row_time, reading in rows
+            if waterLevel_min <= mean_sea_level - reading <= waterLevel_max)
 
-    _extract_n_push(
-        extract_adapter,
-        station,
-        start_date,
-        end_date, pool, obs_hash_id,
-        timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_avg)
 
+def _stream_quality_control(rows, min_value=None, max_value=None):
+    """
+    Streaming variant of _quality_control
+    :param rows: iterator of (epoch seconds, value) rows
+    :return: generator of the rows within [min_value, max_value]. Rows without a value are dropped as well.
+    """
+    return ((row_time, value) for row_time, value in rows
+            if value == value and (min_value is None or value >= min_value)
+            and (max_value is None or value <= max_value))
+
+
+# How each variable is extracted and processed:
+#   unit: unit of the variable in the extracting (curw_iot) DB
+#   group_operation: 5 minute grouping applied while extracting
+#   processor: timeseries processor applied to the extracted timeseries, if any
+#   processor_kwargs: function(station) -> keyword arguments of the processor, if any
+#   stream_processor: streaming variant of the processor, taking the same keyword arguments, if any
+VariableSpec = namedtuple('VariableSpec', ['unit', 'group_operation', 'processor', 'processor_kwargs',
+                                           'stream_processor'])
+
+VARIABLE_REGISTRY = {
+    'Precipitation': VariableSpec('mm', TimeseriesGroupOperation.mysql_5min_max, _precipitation_timeseries_processor,
+                                  None, _stream_precipitation_timeseries),
+    'Temperature': VariableSpec('oC', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'WindSpeed': VariableSpec('m/s', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'WindGust': VariableSpec('m/s', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'WindDirection': VariableSpec('degrees', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'SolarRadiation': VariableSpec('W/m2', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'Humidity': VariableSpec('%', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'Pressure': VariableSpec('mmHg', TimeseriesGroupOperation.mysql_5min_avg, None, None, None),
+    'Waterlevel': VariableSpec('m', TimeseriesGroupOperation.mysql_5min_avg, _waterlevel_timeseries_processor,
+                               _waterlevel_processor_kwargs, _stream_waterlevel_timeseries)
+}
 
-# TODO think of a normalization form.
 
-def extract_n_push_winddirection(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-        # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-        timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-        timeseries_meta['station'] = station['name']
-        timeseries_meta['variable'] = 'WindDirection'
-        timeseries_meta['unit'] = 'degrees'
-        timeseries_meta['type'] = station['type']
-        timeseries_meta['source'] = station['source']
-        timeseries_meta['name'] = station['run_name']
+# Rollups maintained for a variable: (aggregate, curw_obs unit type of the derived series). Each aggregate is kept
+# for every bucket length of ROLLUP_BUCKETS. Buckets are aligned to the local wall clock time the series are stored in.
+# Longer buckets aggregate the shorter ones (see rollup_steps), so a daily Mean is the mean of its hourly means.
+ROLLUP_REGISTRY = {
+    'Precipitation': (('Sum', 'Accumulative'),),
+    'Waterlevel': (('Mean', 'Mean'), ('Max', 'Instantaneous'))
+}
 
-        print("#############Extracting and Pushing WindDirection of Station: %s###############" % station['name'])
+ROLLUP_BUCKETS = (('Hourly', 3600), ('Daily', 24 * 3600))
 
-        _extract_n_push(
-            extract_adapter,
-            station,
-            start_date,
-            end_date, pool, obs_hash_id,
-            timeseries_meta,
-            TimeseriesGroupOperation.mysql_5min_avg)
 
+def get_rollup_meta(variable):
+    """
+    Derived series maintained for a variable
+    :param variable: str: e.g. "Precipitation"
+    :return: list of (bucket_seconds, aggregate, derived variable, unit type, station type) tuples, e.g.
+    (3600, 'Sum', 'Precipitation_Hourly_Sum', 'Accumulative', 'CUrW_WeatherStation'). Empty if the variable has none.
+    """
+    # Derived variable names don't tell the station type apart, so it is given explicitly.
+    station_type = CURW_WATER_LEVEL_STATION if variable == 'Waterlevel' else CURW_WEATHER_STATION
+    return [(bucket_seconds, aggregate, '%s_%s_%s' % (variable, bucket_name, aggregate), unit_type, station_type)
+            for bucket_name, bucket_seconds in ROLLUP_BUCKETS
+            for aggregate, unit_type in ROLLUP_REGISTRY.get(variable, ())]
 
 
-def extract_n_push_solarradiation(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
+def get_timeseries_meta(station, variable):
+    """
+    Event metadata of a station variable. Event metadata is used to find the timeseries id (event_id) in the
+    extracting DB.
+    """
     timeseries_meta = copy.deepcopy(timeseries_meta_struct)
     timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'SolarRadiation'
-    timeseries_meta['unit'] = 'W/m2'
+    timeseries_meta['variable'] = variable
+    timeseries_meta['unit'] = VARIABLE_REGISTRY[variable].unit
     timeseries_meta['type'] = station['type']
     timeseries_meta['source'] = station['source']
     timeseries_meta['name'] = station['run_name']
+    return timeseries_meta
 
-    print("#############Extracting and Pushing SolarRadiation of Station: %s###############" % station['name'])
 
-    _extract_n_push(
-        station,
-        start_date,
-        end_date, pool, obs_hash_id,
-        timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_avg)
+def get_curw_iot_event_id(timeseries_meta):
+    """
+    Id a timeseries has in the extracting DB, if it exists there: sha256 of its event metadata, computed the same way
+    as MySQLAdapter.get_event_id does before looking it up.
+    """
+    hash_data = {key: timeseries_meta[key] for key in timeseries_meta_struct.keys()}
+    return hashlib.sha256(json.dumps(hash_data, sort_keys=True).encode('ascii')).hexdigest()
 
 
+def get_existing_event_ids(extract_adapter, event_ids):
+    """
+    Check which of many event ids exist in the extracting DB, with one query per BULK_EXTRACT_BATCH_SIZE ids
+    :param extract_adapter: MySQLAdapter of the extracting DB
+    :param event_ids: list of event ids
+    :return: set of the event ids found
+    """
+    existing = set()
+    for index in range(0, len(event_ids), BULK_EXTRACT_BATCH_SIZE):
+        batch = event_ids[index:index + BULK_EXTRACT_BATCH_SIZE]
+        sql_statement = "SELECT `id` FROM `run` WHERE `id` IN ({})".format(', '.join(['%s'] * len(batch)))
+        with extract_adapter.connection.cursor(pymysql.cursors.Cursor) as cursor:
+            cursor.execute(sql_statement, batch)
+            existing.update(row[0] for row in cursor.fetchall())
+    return existing
 
-def extract_n_push_humidity(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-        # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-        timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-        timeseries_meta['station'] = station['name']
-        timeseries_meta['variable'] = 'Humidity'
-        timeseries_meta['unit'] = '%'
-        timeseries_meta['type'] = station['type']
-        timeseries_meta['source'] = station['source']
-        timeseries_meta['name'] = station['run_name']
 
-        print("#############Extracting and Pushing Humidity of Station: %s###############" % station['name'])
+class EventIdCache:
+    """
+    Event ids of the extracting DB by event metadata, persisted to a json file. Found event ids are kept for ttl
+    seconds, and series missing from the extracting DB for negative_ttl seconds, so neither costs a query every cycle.
+    Keys are derived from the event metadata, so a config change simply misses the cache.
+    """
 
-        _extract_n_push(
-            extract_adapter,
-            station,
-            start_date,
-            end_date, pool, obs_hash_id,
-            timeseries_meta,
-            TimeseriesGroupOperation.mysql_5min_avg)
+    def __init__(self, path, ttl, negative_ttl):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except Exception:
+                traceback.print_exc()
+                print("Exception occurred while reading event id cache {}. Ignoring it.".format(self.path))
+
+    def get(self, key, now=None):
+        """
+        :param key: str: see get_curw_iot_event_id
+        :return: (True, event id or None) if the cached entry is still fresh, (False, None) otherwise
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            ttl = self.ttl if entry['event_id'] is not None else self.negative_ttl
+            if now - entry['resolved_at'] >= ttl:
+                return False, None
+            return True, entry['event_id']
+
+    def put(self, key, event_id, now=None):
+        with self.lock:
+            self._load()
+            self.entries[key] = {'event_id': event_id, 'resolved_at': time.time() if now is None else now}
+
+    def retain(self, keys):
+        """
+        Forget the entries not in keys
+        """
+        with self.lock:
+            self._load()
+            keys = set(keys)
+            self.entries = {key: entry for key, entry in self.entries.items() if key in keys}
+
+    def save(self):
+        with self.lock:
+            if self.entries is None:
+                return
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as cache_file:
+                    json.dump(self.entries, cache_file, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                traceback.print_exc()
+                print("Exception occurred while saving event id cache {}".format(self.path))
+
+
+def bulk_extract_statements(windows, end_date, group_operation):
+    """
+    Grouped statements extracting the 5 minute grouped timeseries of many events from the extracting DB
+    :param windows: list of (event_id, start_date) tuples
+    :param end_date: str: e.g. "2019-07-01 00:00:00"; common end of all the windows
+    :param group_operation: TimeseriesGroupOperation.mysql_5min_max | TimeseriesGroupOperation.mysql_5min_avg
+    :return: list of (sql_statement, params), one per BULK_EXTRACT_BATCH_SIZE windows. Each statement returns
+    (event_id, time, value) rows.
+    """
+    if group_operation == TimeseriesGroupOperation.mysql_5min_max:
+        aggregate = 'MAX'
+    elif group_operation == TimeseriesGroupOperation.mysql_5min_avg:
+        aggregate = 'AVG'
+    else:
+        raise ValueError('Unsupported group operation for bulk extraction: %s' % group_operation)
+
+    statements = []
+    for index in range(0, len(windows), BULK_EXTRACT_BATCH_SIZE):
+        batch = windows[index:index + BULK_EXTRACT_BATCH_SIZE]
+        sql_statement = "SELECT `id`, MIN(`time`), {}(`value`) FROM `data` " \
+                        "WHERE `time` <= %s AND ({}) " \
+                        "GROUP BY `id`, UNIX_TIMESTAMP(`time`) DIV 300 " \
+                        "ORDER BY `id`, MIN(`time`)"\
+            .format(aggregate, ' OR '.join(['(`id`=%s AND `time` >= %s)'] * len(batch)))
+        params = [end_date]
+        for event_id, start_date in batch:
+            params.extend([event_id, start_date])
+        statements.append((sql_statement, params))
+    return statements
+
+
+def extracted_series(rows):
+    """
+    :param rows: (event_id, time, value) rows returned by a bulk_extract_statements statement, ordered by event_id
+    :return: dict of event_id -> Series of the event's rows
+    """
+    if len(rows) <= 0:
+        return {}
+
+    event_ids = [row[0] for row in rows]
+    times = np.array([row[1] for row in rows], dtype='datetime64[s]').astype(np.int64)
+    values = np.array([row[2] for row in rows], dtype=np.float64)
+
+    timeseries = {}
+    start = 0
+    for end in range(1, len(rows) + 1):
+        if end == len(rows) or event_ids[end] != event_ids[start]:
+            timeseries[event_ids[start]] = Series(times[start:end], values[start:end])
+            start = end
+    return timeseries
 
 
-def extract_n_push_pressure(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-    timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-    timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'Pressure'
-    timeseries_meta['unit'] = 'mmHg'
-    timeseries_meta['type'] = station['type']
-    timeseries_meta['source'] = station['source']
-    timeseries_meta['name'] = station['run_name']
+def extract_grouped_time_series_bulk(extract_adapter, windows, end_date, group_operation):
+    """
+    Extract 5 minute grouped timeseries of many events from the extracting DB with a few grouped statements,
+    instead of one extract_grouped_time_series call per event.
+    :param extract_adapter: MySQLAdapter of the extracting DB
+    :param windows: list of (event_id, start_date) tuples
+    :param end_date: str: e.g. "2019-07-01 00:00:00"; common end of all the windows
+    :param group_operation: TimeseriesGroupOperation.mysql_5min_max | TimeseriesGroupOperation.mysql_5min_avg
+    :return: dict of event_id -> Series. Every event in windows gets an entry.
+    """
+    timeseries = {event_id: Series() for event_id, _ in windows}
 
-    print("#############Extracting and Pushing Pressure of Station: %s###############" % station['name'])
+    for sql_statement, params in bulk_extract_statements(windows, end_date, group_operation):
+        with extract_adapter.connection.cursor(pymysql.cursors.Cursor) as cursor:
+            cursor.execute(sql_statement, params)
+            timeseries.update(extracted_series(cursor.fetchall()))
 
-    _extract_n_push(
-        extract_adapter,
-        station,
-        start_date,
-        end_date, pool, obs_hash_id,
-        timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_avg)
+    return timeseries
 
 
+def stream_extracted_rows(extract_adapter, event_id, start_date, end_date, group_operation,
+                          fetch_rows=STREAM_FETCH_ROWS):
+    """
+    Extract the 5 minute grouped timeseries of one event over an unbounded range with an unbuffered cursor, so rows
+    are fetched from the extracting DB as they are consumed instead of being held in memory all at once.
+    The connection can't run another statement until the generator is exhausted or closed. The query stays in
+    execution until its last row is fetched, so a session MAX_EXECUTION_TIME would end long streams: run it on a
+    session without one (see Pusher.ExtractAdapterPool.run_without_timeout).
+    :param extract_adapter: MySQLAdapter of the extracting DB
+    :param event_id: str: curw_iot timeseries id
+    :param start_date: str: e.g. "2019-07-01 00:00:00"
+    :param end_date: str: e.g. "2019-07-31 00:00:00"
+    :param group_operation: TimeseriesGroupOperation.mysql_5min_max | TimeseriesGroupOperation.mysql_5min_avg
+    :return: generator of (epoch seconds, value) rows. The value is NaN if it is missing.
+    """
+    (sql_statement, params), = bulk_extract_statements([(event_id, start_date)], end_date, group_operation)
+    with extract_adapter.connection.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(sql_statement, params)
+        while True:
+            rows = cursor.fetchmany(fetch_rows)
+            if not rows:
+                break
+            for _, row_time, value in rows:
+                yield to_epoch(row_time), float(value) if value is not None else float('nan')
+
+
+def stream_series(entry, rows):
+    """
+    Quality control and process an unbounded stream of rows extracted for a station plan entry, row by row
+    :param entry: Plan.SeriesPlan
+    :param rows: iterator of (epoch seconds, value) rows, e.g. from stream_extracted_rows
+    :return: generator of (epoch seconds, value) rows to write
+    """
+    if entry.min_value is not None or entry.max_value is not None:
+        rows = _stream_quality_control(rows, entry.min_value, entry.max_value)
+    stream_processor = VARIABLE_REGISTRY[entry.variable].stream_processor
+    if stream_processor is not None:
+        rows = stream_processor(rows, **entry.processor_kwargs)
+    return rows
 
-def extract_n_push_waterlevel(extract_adapter, station, start_date, end_date, pool, obs_hash_id):
-    if 'mean_sea_level' not in station.keys():
-        raise AttributeError('Attribute mean_sea_level is required.')
-    msl = station['mean_sea_level']
-    wl_min = station['min_wl']
-    wl_max = station['max_wl']
 
-    #if station['stationId'] == 'curw_wl_test':
-        #msl = 5.676
-        #wl_min = -1.00
-        #wl_max = 3.00
+def _extract_n_push(entry, timeseries, writer, metrics=None):
+    """
+    Quality control and process the timeseries extracted for a station plan entry and queue it to be written to
+    curw_obs
+    :param entry: Plan.SeriesPlan
+    :param timeseries: Series extracted from the extracting DB
+    :param writer: TimeseriesWriter of the cycle
+    :param metrics: Metrics.CycleMetrics: rows dropped by the quality control are recorded into it
+    :return: number of rows queued
+    """
+    if timeseries is None:
+        timeseries = Series()
+    # Shares the arrays of the extracted series
+    timeseries = Series(timeseries.times, timeseries.values, entry.obs_hash_id, entry.unit, entry.unit_type)
+    if entry.min_value is not None or entry.max_value is not None:
+        qc_started = time.perf_counter()
+        extracted_rows = len(timeseries)
+        timeseries, dropped_rows = _quality_control(timeseries, entry.min_value, entry.max_value)
+        if dropped_rows > 0:
+            print("Dropped %d of %d values of the %s of station_Id: %s outside [%s, %s]."
+                  % (dropped_rows, extracted_rows, entry.variable, entry.station_id, entry.min_value,
+                     entry.max_value))
+        if metrics is not None:
+            metrics.record(STAGE_QC, time.perf_counter() - qc_started, rows=dropped_rows,
+                           station=entry.station_name, variable=entry.variable)
+            metrics.count('qc_dropped_rows', dropped_rows)
+
+    if entry.processor is not None:
+        timeseries = entry.processor(timeseries, **entry.processor_kwargs)
 
-    # Create even metadata. Event metadata is used to create timeseries id (event_id) for the timeseries.
-    timeseries_meta = copy.deepcopy(timeseries_meta_struct)
-    timeseries_meta['station'] = station['name']
-    timeseries_meta['variable'] = 'Waterlevel'
-    timeseries_meta['unit'] = 'm'
-    timeseries_meta['type'] = station['type']
-    timeseries_meta['source'] = station['source']
-    timeseries_meta['name'] = station['run_name']
+    if timeseries is None or len(timeseries) <= 0:
+        print("No value in the timeseries for the %s of station_Id: %s in the extracting DB."
+              % (entry.variable, entry.station_id))
+        return 0
 
-    print("#############Extracting and water level of Station: %s###############" % station['name'])
+    # queue extracted time series to be written to the curwobs db at the end of the cycle
+    queued_rows = writer.add(tms_id=entry.obs_hash_id, timeseries=timeseries)
+    print("Queued timeseries length {} values for insertion...".format(queued_rows))
+    return queued_rows
 
-    _extract_n_push(
-        extract_adapter,
-        station,
-        start_date,
-        end_date, pool, obs_hash_id,
-        timeseries_meta,
-        TimeseriesGroupOperation.mysql_5min_avg,
-        timeseries_processor=_waterlevel_timeseries_processor, mean_sea_level=msl, waterLevel_min=wl_min, waterLevel_max=wl_max)
 
 def generate_curw_obs_hash_id(pool, variable, unit, unit_type, latitude, longitude, station_type=None,
-                              station_name=None, description=None, append_description=False, start_date=None):
+                              station_name=None, description=None, append_description=False, start_date=None,
+                              counts=None):
 
     """
     Generate corresponding curw_obs hash id for a given curw observational station
@@ -421,6 +551,8 @@ def generate_curw_obs_hash_id(pool, variable, unit, unit_type, latitude, longitu
     :param description: str: "A&T Communication Box, Texas Standard Rain Gauge"
     :param append_description: bool:
     :param start_date: str: e.g."2019-07-01 00:00:00" ; the timestamp of the very first entry of the timeseries
+    :param counts: dict: if given, its 'db_calls' is increased by the database calls made, at least 4 (unit, variable,
+    station and run lookups) plus the inserts and re-lookups of whatever is missing
 
     :return: new curw_obs hash id
     """
@@ -429,6 +561,7 @@ def generate_curw_obs_hash_id(pool, variable, unit, unit_type, latitude, longitu
     #           "weather stations")
     #     exit(1)
 
+    db_calls = 0
     try:
 
         lat = '%.6f' % float(latitude)
@@ -455,34 +588,43 @@ def generate_curw_obs_hash_id(pool, variable, unit, unit_type, latitude, longitu
 
         meta_data['station_type'] = StationEnum.getTypeString(station_type)
 
+        db_calls += 1
         unit_id = get_unit_id(pool=pool, unit=unit, unit_type=UnitType.getType(unit_type))
 
         if unit_id is None:
+            db_calls += 2
             add_unit(pool=pool, unit=unit, unit_type=UnitType.getType(unit_type))
             unit_id = get_unit_id(pool=pool, unit=unit, unit_type=UnitType.getType(unit_type))
 
+        db_calls += 1
         variable_id = get_variable_id(pool=pool, variable=variable)
 
         if variable_id is None:
+            db_calls += 2
             add_variable(pool=pool, variable=variable)
             variable_id = get_variable_id(pool=pool, variable=variable)
 
+        db_calls += 1
         station_id = get_station_id(pool=pool, latitude=lat, longitude=lon, station_type=station_type)
 
         if station_id is None:
+            db_calls += 2
             add_station(pool=pool, name=station_name, latitude=lat, longitude=lon,
                     station_type=station_type)
             station_id = get_station_id(pool=pool, latitude=lat, longitude=lon,
                     station_type=station_type)
             if description:
+                db_calls += 1
                 update_description(pool=pool, id_=station_id, description=description, append=False)
 
         elif append_description:
             if description:
+                db_calls += 1
                 update_description(pool=pool, id_=station_id, description=description, append=True)
 
         TS = Timeseries(pool=pool)
 
+        db_calls += 1
         tms_id = TS.get_timeseries_id_if_exists(meta_data=meta_data)
 
         meta_data['station_id'] = station_id
@@ -492,8 +634,10 @@ def generate_curw_obs_hash_id(pool, variable, unit, unit_type, latitude, longitu
         if tms_id is None:
             tms_id = TS.generate_timeseries_id(meta_data=meta_data)
             meta_data['tms_id'] = tms_id
+            db_calls += 1
             TS.insert_run(run_meta=meta_data)
             if start_date:
+                db_calls += 1
                 TS.update_start_date(id_=tms_id, start_date=start_date)
 
         return tms_id
@@ -501,40 +645,561 @@ def generate_curw_obs_hash_id(pool, variable, unit, unit_type, latitude, longitu
     except Exception:
         traceback.print_exc()
         print("Exception occurred while inserting run entries to curw_obs run table and making hash mapping")
+    finally:
+        if counts is not None:
+            counts['db_calls'] = counts.get('db_calls', 0) + db_calls
 
 
-def insert_timeseries(pool, timeseries, tms_id, end_date=None):
-
+def curw_obs_hash_id_key(variable, unit, unit_type, latitude, longitude, station_type=None):
     """
-    Insert timeseries to curw_obs database
-    :param pool: database connection pool
-    :param timeseries: list of [time, value] lists
-    :param end_date: str: timestamp of the latest data
-    :param tms_id: str: curw_obs timeseries (hash) id
-    :return:
-    """
-    new_timeseries = []
-    for t in [i for i in timeseries]:
-        if len(t) > 1:
-            # Insert EventId in front of timestamp, value list
-            t.insert(0, tms_id)
-            new_timeseries.append(t)
+    Build the hash id cache key of a curw_obs timeseries. Mirrors the meta data generate_curw_obs_hash_id resolves
+    the hash id from: (variable, unit, unit_type, lat, lon, station_type)
+    :return: str: e.g. "Precipitation|mm|Accumulative|6.865576|79.958180|CUrW_WeatherStation"
+    """
+    if variable == "Waterlevel":
+        variable = "WaterLevel"
+
+    if not (station_type and station_type in (CURW_WATER_LEVEL_STATION, CURW_WEATHER_STATION, CURW_CROSS_SECTION)):
+        if variable == "WaterLevel":
+            station_type = CURW_WATER_LEVEL_STATION
+        elif variable == "CrossSection":
+            station_type = CURW_CROSS_SECTION
         else:
-            print('Invalid timeseries data:: %s', t)
+            station_type = CURW_WEATHER_STATION
+
+    return '|'.join([variable, unit, unit_type, '%.6f' % float(latitude), '%.6f' % float(longitude), station_type])
 
-    if end_date is None:
-        end_date = new_timeseries[-1][1]
+
+def load_hash_id_cache(cache_path, config_hash):
+    """
+    Load the on-disk curw_obs hash id cache
+    :param cache_path: str: path of the json cache file
+    :param config_hash: str: hash of the config file. Cache is discarded when it was built for a different config.
+    :return: dict of cache key -> curw_obs hash id
+    """
+    if not os.path.exists(cache_path):
+        return {}
 
     try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+        if cache.get('config_hash') != config_hash:
+            print("Config changed since the hash id cache was built. Invalidating %s" % cache_path)
+            return {}
+        return cache.get('hash_ids', {})
+    except Exception:
+        traceback.print_exc()
+        print("Exception occurred while loading hash id cache {}. Ignoring it.".format(cache_path))
+        return {}
 
-        ts = Timeseries(pool=pool)
 
-        ts.insert_data(timeseries=new_timeseries, upsert=True)
-        ts.update_end_date(id_=tms_id, end_date=end_date)
+def save_hash_id_cache(cache_path, config_hash, hash_ids):
 
-    except Exception as e:
+    try:
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'config_hash': config_hash, 'hash_ids': hash_ids}, cache_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, cache_path)
+    except Exception:
         traceback.print_exc()
-        print("Exception occurred while pushing timeseries for tms_id {} to curw_obs".format(tms_id))
+        print("Exception occurred while saving hash id cache {}.".format(cache_path))
+
+
+def resolve_curw_obs_hash_ids(pool, stations, hash_ids, metrics=None, rollup_variables=()):
+    """
+    Resolve the curw_obs hash ids of every configured (station, variable) in one pass. Only series missing from the
+    cache hit the database.
+    :param pool: database connection pool
+    :param stations: list of station configs
+    :param hash_ids: dict: cache key -> hash id, as returned by load_hash_id_cache. Updated in place.
+    :param metrics: Metrics.CycleMetrics: records the time spent resolving each series missing from the cache
+    :param rollup_variables: variables whose rollup series (see get_rollup_meta) are resolved as well
+    :return: number of hash ids resolved from the database
+    """
+    resolved = 0
+    for station in stations:
+        latitude = station['station_meta'][2]
+        longitude = station['station_meta'][3]
+
+        for variable, unit, unit_type in zip(station['variables'], station['units'], station['unit_type']):
+            series = [(variable, unit_type, None)]
+            if variable in rollup_variables:
+                series.extend((rollup_variable, rollup_unit_type, station_type) for _, _, rollup_variable,
+                              rollup_unit_type, station_type in get_rollup_meta(variable))
+
+            for series_variable, series_unit_type, station_type in series:
+                key = curw_obs_hash_id_key(series_variable, unit, series_unit_type, latitude, longitude, station_type)
+                if key in hash_ids:
+                    continue
+
+                start = time.perf_counter()
+                counts = {'db_calls': 0}
+                tms_id = generate_curw_obs_hash_id(pool, variable=series_variable, unit=unit,
+                                                   unit_type=series_unit_type, latitude=latitude, longitude=longitude,
+                                                   station_type=station_type, station_name=station['name'],
+                                                   description=station['description'], counts=counts)
+                if metrics is not None:
+                    metrics.record(STAGE_HASH_ID, time.perf_counter() - start, rows=1, db_calls=counts['db_calls'],
+                                   station=station['name'], variable=series_variable)
+                if tms_id is not None:
+                    hash_ids[key] = tms_id
+                    resolved += 1
+
+    return resolved
+
+
+def get_end_dates(pool, tms_ids):
+    """
+    Fetch the end dates of many curw_obs timeseries in a single query
+    :param pool: database connection pool
+    :param tms_ids: list of curw_obs timeseries (hash) ids
+    :return: dict of tms_id -> end_date (datetime), or None if the query failed. Timeseries without an end date
+    are left out.
+    """
+    end_dates = {}
+    if not tms_ids:
+        return end_dates
+
+    connection = None
+    try:
+        connection = pool.connection()
+        with connection.cursor() as cursor:
+            sql_statement = "SELECT `id`, `end_date` FROM `run` WHERE `id` IN ({})"\
+                .format(', '.join(['%s'] * len(tms_ids)))
+            cursor.execute(sql_statement, tuple(tms_ids))
+            for row in cursor.fetchall():
+                if row['end_date'] is not None:
+                    end_dates[row['id']] = row['end_date']
+    except Exception:
+        traceback.print_exc()
+        print("Exception occurred while retrieving end dates of {} timeseries from curw_obs".format(len(tms_ids)))
+        return None
+    finally:
+        if connection is not None:
+            connection.close()
+
+    return end_dates
+
+
+def _cache_value(value):
+    return float(value) if value is not None and value == value else None
+
+
+class TailCache:
+    """
+    Values last written to curw_obs for the recent tail of each series, so rows a cycle reads again (the watermark
+    group, reconciliation windows) can be left out of the upsert when they haven't changed. Persisted to a json file
+    so cron runs share it.
+    """
+
+    def __init__(self, path, retention_minutes):
+        self.path = path
+        self.retention = timedelta(minutes=retention_minutes)
+        self.lock = threading.Lock()
+        self.series = None
+
+    def _load(self):
+        if self.series is not None:
+            return
+        self.series = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as cache_file:
+                    self.series = json.load(cache_file)
+            except Exception:
+                traceback.print_exc()
+                print("Exception occurred while reading tail cache {}. Ignoring it.".format(self.path))
+
+    def diff(self, series):
+        """
+        :param series: list of (tms_id, Series, end_date)
+        :return: (list of (tms_id, Series, end_date) holding only the new or changed rows, number of rows skipped)
+        """
+        with self.lock:
+            self._load()
+            changed_series = []
+            skipped = 0
+            for tms_id, rows, end_date in series:
+                cached = self.series.get(tms_id)
+                if cached:
+                    changed = np.array([row_time not in cached or cached[row_time] != _cache_value(value)
+                                        for row_time, value in zip(rows.time_strings(), rows.values.tolist())],
+                                       dtype=bool)
+                    skipped += len(rows) - int(np.count_nonzero(changed))
+                    rows = rows.take(changed)
+                if len(rows) > 0:
+                    changed_series.append((tms_id, rows, end_date))
+            return changed_series, skipped
+
+    def update(self, series):
+        """
+        Record written rows, forgetting the rows older than the retention of each series
+        :param series: list of (tms_id, Series, end_date)
+        """
+        with self.lock:
+            self._load()
+            for tms_id, rows, _ in series:
+                cached = self.series.setdefault(tms_id, {})
+                for row_time, value in zip(rows.time_strings(), rows.values.tolist()):
+                    cached[row_time] = _cache_value(value)
+                cutoff = (datetime.strptime(max(cached), '%Y-%m-%d %H:%M:%S') - self.retention)\
+                    .strftime('%Y-%m-%d %H:%M:%S')
+                for row_time in [row_time for row_time in cached if row_time < cutoff]:
+                    del cached[row_time]
+
+    def retain(self, tms_ids):
+        """
+        Forget the series not in tms_ids
+        """
+        with self.lock:
+            self._load()
+            tms_ids = set(tms_ids)
+            self.series = {tms_id: cached for tms_id, cached in self.series.items() if tms_id in tms_ids}
+
+    def save(self):
+        with self.lock:
+            if self.series is None:
+                return
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as cache_file:
+                    json.dump(self.series, cache_file, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                traceback.print_exc()
+                print("Exception occurred while saving tail cache {}".format(self.path))
+
+
+def upsert_statements(series, row_count, batch_size=UPSERT_BATCH_SIZE):
+    """
+    Statements writing timeseries to curw_obs: multi-row upserts of the rows followed by a single end date update
+    :param series: list of (tms_id, Series, end_date), as held by TimeseriesWriter
+    :param row_count: int: total number of rows of the series
+    :param batch_size: int: max rows per upsert
+    :return: list of (sql_statement, params). Empty if there are no rows.
+    """
+    if row_count <= 0:
+        return []
+
+    # Flat (tms_id, time, value, tms_id, time, value, ...) parameters of all the rows, filled a column at a time
+    params = [None] * (3 * row_count)
+    index = 0
+    for tms_id, rows, _ in series:
+        end = index + 3 * len(rows)
+        params[index:end:3] = [tms_id] * len(rows)
+        params[index + 1:end:3] = rows.time_strings()
+        params[index + 2:end:3] = rows.value_list()
+        index = end
+
+    statements = []
+    for start in range(0, row_count, batch_size):
+        batch_rows = min(batch_size, row_count - start)
+        sql_statement = "INSERT INTO `data` (`id`, `time`, `value`) VALUES {} " \
+                        "ON DUPLICATE KEY UPDATE `value`=VALUES(`value`)"\
+            .format(', '.join(['(%s, %s, %s)'] * batch_rows))
+        statements.append((sql_statement, params[3 * start:3 * (start + batch_rows)]))
+
+    end_dates = {}
+    for tms_id, _, end_date in series:
+        end_dates[tms_id] = end_date
+
+    # End dates only move forward, so backfilling an old range doesn't rewind them.
+    sql_statement = "UPDATE `run` " \
+                    "SET `end_date` = GREATEST(COALESCE(`end_date`, '1970-01-01 00:00:00'), " \
+                    "CAST(CASE `id` {} END AS DATETIME)) WHERE `id` IN ({})"\
+        .format(' '.join(['WHEN %s THEN %s'] * len(end_dates)), ', '.join(['%s'] * len(end_dates)))
+    params = [field for item in end_dates.items() for field in item] + list(end_dates.keys())
+    statements.append((sql_statement, params))
+    return statements
+
+
+def rollup_steps(rollups):
+    """
+    Order the rollups of many series into steps of increasing bucket length. The shortest buckets of an aggregate are
+    computed from the raw rows, and each longer one from the rollup series of the step before it, e.g. a daily sum
+    from the 24 stored hourly sums instead of a whole day of raw rows. So a daily Mean is the mean of its hourly means.
+    :param rollups: dict of curw_obs hash id -> tuple of Plan.RollupPlan
+    :return: list of dicts of source hash id -> tuple of Plan.RollupPlan, one per bucket length, shortest first
+    """
+    steps = {}
+    for tms_id, series_rollups in rollups.items():
+        sources = {}
+        for rollup in sorted(series_rollups, key=lambda rollup: rollup.bucket_seconds):
+            source = sources.get(rollup.aggregate, tms_id)
+            steps.setdefault(rollup.bucket_seconds, {}).setdefault(source, []).append(rollup)
+            sources[rollup.aggregate] = rollup.obs_hash_id
+    return [{source: tuple(step[source]) for source in step} for _, step in sorted(steps.items())]
+
+
+def rollup_read_statements(series, rollups):
+    """
+    Statements reading back the stored rows of the rollup buckets touched by written series, so the buckets can be
+    recomputed from every row they hold rather than only the rows just written
+    :param series: list of (tms_id, Series, end_date) written
+    :param rollups: dict of curw_obs hash id -> tuple of Plan.RollupPlan, one step of rollup_steps
+    :return: list of (sql_statement, params), one per BULK_EXTRACT_BATCH_SIZE series. Each statement returns
+    (tms_id, time, value) rows ordered by tms_id and time.
+    """
+    spans = {}
+    for tms_id, rows, _ in series:
+        if not rollups.get(tms_id) or len(rows) <= 0:
+            continue
+        span = max(rollup.bucket_seconds for rollup in rollups[tms_id])
+        start = int(rows.times.min()) // span * span
+        end = (int(rows.times.max()) // span + 1) * span
+        if tms_id in spans:
+            start, end = min(start, spans[tms_id][0]), max(end, spans[tms_id][1])
+        spans[tms_id] = (start, end)
+
+    windows = [(tms_id,) + tuple(format_epochs(span)) for tms_id, span in spans.items()]
+    statements = []
+    for index in range(0, len(windows), BULK_EXTRACT_BATCH_SIZE):
+        batch = windows[index:index + BULK_EXTRACT_BATCH_SIZE]
+        sql_statement = "SELECT `id`, `time`, `value` FROM `data` WHERE {} ORDER BY `id`, `time`"\
+            .format(' OR '.join(['(`id`=%s AND `time` >= %s AND `time` < %s)'] * len(batch)))
+        statements.append((sql_statement, [field for window in batch for field in window]))
+    return statements
+
+
+def _aggregate_buckets(timeseries, bucket_seconds, aggregate):
+    """
+    :param timeseries: Series, ascending. Rows without a value are left out.
+    :param bucket_seconds: int: bucket length
+    :param aggregate: str: 'Sum' | 'Mean' | 'Max'
+    :return: (array of bucket start times, array of aggregated values) of the buckets holding a value
+    """
+    timeseries = timeseries.take(~np.isnan(timeseries.values))
+    if len(timeseries) <= 0:
+        return timeseries.times, timeseries.values
+
+    buckets = timeseries.times // bucket_seconds * bucket_seconds
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    if aggregate == 'Max':
+        aggregated = np.maximum.reduceat(timeseries.values, starts)
+    else:
+        aggregated = np.add.reduceat(timeseries.values, starts)
+        if aggregate == 'Mean':
+            aggregated /= np.diff(np.append(starts, len(timeseries)))
+    return buckets[starts], aggregated
+
+
+def rollup_series(series, rollups, stored):
+    """
+    Recompute the rollup buckets touched by written series
+    :param series: list of (tms_id, Series, end_date) written
+    :param rollups: dict of curw_obs hash id -> tuple of Plan.RollupPlan, one step of rollup_steps
+    :param stored: dict of curw_obs hash id -> Series of the rows read back by rollup_read_statements
+    :return: list of (tms_id, Series, end_date) of the rollup series, holding only the touched buckets. A bucket is
+    timestamped with its start.
+    """
+    written_times = {}
+    for tms_id, rows, _ in series:
+        if rollups.get(tms_id) and len(rows) > 0:
+            written_times.setdefault(tms_id, []).append(rows.times)
+
+    derived = []
+    for tms_id, times in written_times.items():
+        times = np.concatenate(times)
+        for rollup in rollups[tms_id]:
+            bucket_times, values = _aggregate_buckets(stored.get(tms_id, Series()), rollup.bucket_seconds,
+                                                      rollup.aggregate)
+            touched = np.isin(bucket_times, times // rollup.bucket_seconds * rollup.bucket_seconds)
+            if np.any(touched):
+                buckets = Series(bucket_times[touched], values[touched], rollup.obs_hash_id)
+                derived.append((rollup.obs_hash_id, buckets, buckets.time_at(-1)))
+    return derived
+
+
+class TimeseriesWriter:
+    """
+    Write stage of a pusher cycle. Collects the timeseries of every series in the cycle and writes them to curw_obs
+    with a few large multi-row upserts followed by a single end date update, all in one transaction.
+    With a TailCache, rows identical to the ones already written are skipped. With rollups, the hourly and daily
+    buckets touched by the written rows are recomputed and upserted in the same transaction.
+    add() is thread safe so worker threads can share one writer.
+    """
+
+    def __init__(self, pool, batch_size=UPSERT_BATCH_SIZE, tail_cache=None, rollups=None):
+        """
+        :param rollups: dict of curw_obs hash id -> tuple of Plan.RollupPlan of the series with rollups, or None
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.tail_cache = tail_cache
+        self.rollups = rollups
+        self.skipped_rows = 0
+        self.rollup_rows = 0
+        self.lock = threading.Lock()
+        self.series = []
+        self.row_count = 0
+        self.queued_rows = {}
+        self.failed_series = []
+        self.error = None
+
+    def add(self, tms_id, timeseries, end_date=None):
+        """
+        Queue a timeseries to be written on the next flush
+        :param tms_id: str: curw_obs timeseries (hash) id
+        :param timeseries: Series, or list of [time, value] lists
+        :param end_date: str: timestamp of the latest data. Defaults to the time of the last row.
+        :return: number of valid rows queued
+        """
+        rows = timeseries if isinstance(timeseries, Series) else Series.from_rows(timeseries, tms_id)
+        if len(rows) <= 0:
+            return 0
+
+        if end_date is None:
+            end_date = rows.time_at(-1)
+
+        with self.lock:
+            self.series.append((tms_id, rows, end_date))
+            self.row_count += len(rows)
+            self.queued_rows[tms_id] = self.queued_rows.get(tms_id, 0) + len(rows)
+
+        return len(rows)
+
+    def flush(self):
+        """
+        Write all the queued timeseries to curw_obs and clear the queue. If the write fails, the queued timeseries
+        are kept in failed_series as (tms_id, Series, end_date) so they can be spooled, and the exception in error.
+        :return: number of rows inserted (0 if the write failed)
+        """
+        with self.lock:
+            series = self.series
+            row_count = self.row_count
+            self.series = []
+            self.row_count = 0
+            self.queued_rows = {}
+            self.failed_series = []
+            self.error = None
+
+        if self.tail_cache is not None and row_count > 0:
+            series, skipped_rows = self.tail_cache.diff(series)
+            row_count -= skipped_rows
+            self.skipped_rows += skipped_rows
+
+        if row_count <= 0:
+            return 0
+
+        connection = None
+        try:
+            connection = self.pool.connection()
+            with connection.cursor() as cursor:
+                for sql_statement, params in upsert_statements(series, row_count, self.batch_size):
+                    cursor.execute(sql_statement, params)
+            rollup_rows = self._write_rollups(connection, series) if self.rollups else 0
+
+            connection.commit()
+            self.rollup_rows += rollup_rows
+            if self.tail_cache is not None:
+                self.tail_cache.update(series)
+            return row_count
+
+        except Exception as ex:
+            if connection is not None:
+                connection.rollback()
+            traceback.print_exc()
+            print("Exception occurred while pushing {} rows of {} timeseries to curw_obs"
+                  .format(row_count, len(set(tms_id for tms_id, _, _ in series))))
+            with self.lock:
+                self.failed_series.extend(series)
+                self.error = ex
+            return 0
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _write_rollups(self, connection, series):
+        """
+        Recompute and upsert the rollup buckets touched by the written series, in the transaction which wrote them. Each
+        step of rollup_steps reads back only the buckets touched by the step before it, which it has just upserted.
+        :return: number of rollup rows written
+        """
+        row_count = 0
+        for step in rollup_steps(self.rollups):
+            stored = {}
+            with connection.cursor(pymysql.cursors.Cursor) as cursor:
+                for sql_statement, params in rollup_read_statements(series, step):
+                    cursor.execute(sql_statement, params)
+                    stored.update(extracted_series(cursor.fetchall()))
+
+            series = rollup_series(series, step, stored)
+            step_rows = sum(len(rows) for _, rows, _ in series)
+            with connection.cursor() as cursor:
+                for sql_statement, params in upsert_statements(series, step_rows, self.batch_size):
+                    cursor.execute(sql_statement, params)
+            row_count += step_rows
+        return row_count
+
+
+class ChunkedWriter:
+    """
+    Write an unbounded stream of rows of one timeseries to curw_obs, chunk_rows rows at a time. Rows are buffered in
+    two preallocated arrays which are reused for every chunk, so memory stays flat regardless of the stream length.
+    Each chunk is written by a TimeseriesWriter in its own transaction, which also advances the end date.
+    """
+
+    def __init__(self, pool, tms_id, chunk_rows=STREAM_CHUNK_ROWS, batch_size=UPSERT_BATCH_SIZE, on_flush=None,
+                 rollups=None):
+        """
+        :param on_flush: function(str: time of the last row written) called after each chunk is written, or None
+        :param rollups: see TimeseriesWriter
+        """
+        self.writer = TimeseriesWriter(pool, batch_size, rollups=rollups)
+        self.tms_id = tms_id
+        self.on_flush = on_flush
+        self.times = np.empty(max(1, chunk_rows), dtype=np.int64)
+        self.values = np.empty(max(1, chunk_rows), dtype=np.float64)
+        self.buffered_rows = 0
+        self.written_rows = 0
+
+    def _flush(self):
+        """
+        :return: True if the buffered rows were written
+        """
+        if self.buffered_rows <= 0:
+            return True
+        rows = Series(self.times[:self.buffered_rows], self.values[:self.buffered_rows], self.tms_id)
+        last_time = rows.time_at(-1)
+        self.writer.add(tms_id=self.tms_id, timeseries=rows)
+        inserted_rows = self.writer.flush()
+        if len(self.writer.failed_series) > 0:
+            return False
+        self.written_rows += inserted_rows
+        self.buffered_rows = 0
+        if self.on_flush is not None:
+            self.on_flush(last_time)
+        return True
+
+    def write(self, rows):
+        """
+        Consume a stream of rows, writing a chunk whenever the buffer is full, and the rest once the stream ends.
+        Stops at the first chunk which couldn't be written.
+        :param rows: iterator of (epoch seconds, value) rows, ascending
+        :return: True if every row was written
+        """
+        for row_time, value in rows:
+            self.times[self.buffered_rows] = row_time
+            self.values[self.buffered_rows] = value
+            self.buffered_rows += 1
+            if self.buffered_rows == len(self.times) and not self._flush():
+                return False
+        return self._flush()
+
+
+def insert_timeseries(pool, timeseries, tms_id, end_date=None):
+
+    """
+    Insert timeseries to curw_obs database
+    :param pool: database connection pool
+    :param timeseries: Series, or list of [time, value] lists
+    :param end_date: str: timestamp of the latest data
+    :param tms_id: str: curw_obs timeseries (hash) id
+    :return: number of rows inserted
+    """
+    writer = TimeseriesWriter(pool)
+    writer.add(tms_id=tms_id, timeseries=timeseries, end_date=end_date)
+    return writer.flush()
 
 
 def update_station_description_by_id(pool, station_id, description, append_description=True):
@@ -0,0 +1,468 @@
+"""
+Local stand-ins for curw_iot (curwmysqladapter.MySQLAdapter) and curw_obs (db_adapter pool and Timeseries), and for
+the aiomysql pools of both, backed by in-memory SQLite databases, so the pusher can be run and timed without touching
+the production databases.
+
+install() registers fake curwmysqladapter, aiomysql and db_adapter modules in sys.modules. Call it before importing
+Pusher or Utils. The MySQL statements issued by the pusher are translated to SQLite on the fly, and every statement
+is counted so DB calls per cycle can be reported.
+"""
+import decimal
+import hashlib
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+import types
+from datetime import datetime
+from enum import Enum
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATETIME_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+
+CURW_IOT_SCHEMA = """
+CREATE TABLE `run` (`id` TEXT PRIMARY KEY, `station` TEXT, `variable` TEXT, `unit` TEXT, `type` TEXT,
+                    `source` TEXT, `name` TEXT);
+CREATE TABLE `data` (`id` TEXT, `time` TEXT, `value` REAL, PRIMARY KEY (`id`, `time`));
+"""
+
+CURW_OBS_SCHEMA = """
+CREATE TABLE `unit` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `unit` TEXT, `type` TEXT);
+CREATE TABLE `variable` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `variable` TEXT);
+CREATE TABLE `station` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT, `latitude` TEXT, `longitude` TEXT,
+                        `station_type` TEXT, `description` TEXT);
+CREATE TABLE `run` (`id` TEXT PRIMARY KEY, `station` INTEGER, `variable` INTEGER, `unit` INTEGER,
+                    `start_date` TEXT, `end_date` TEXT);
+CREATE TABLE `data` (`id` TEXT, `time` TEXT, `value` REAL, PRIMARY KEY (`id`, `time`));
+"""
+
+
+def _unix_timestamp(value):
+    if value is None:
+        return None
+    return int((datetime.strptime(str(value)[:19], DATE_FORMAT) - datetime(1970, 1, 1)).total_seconds())
+
+
+def _greatest(*values):
+    if any(value is None for value in values):
+        return None
+    return max(values)
+
+
+def _translate(sql_statement):
+    """
+    Translate the MySQL dialect used by the pusher to SQLite
+    """
+    sql_statement = sql_statement.replace('%s', '?')
+    sql_statement = sql_statement.replace(' DIV ', ' / ')
+    sql_statement = sql_statement.replace(' AS DATETIME)', ' AS TEXT)')
+    sql_statement = sql_statement.replace('INSERT IGNORE ', 'INSERT OR IGNORE ')
+    match = re.search(r'ON DUPLICATE KEY UPDATE (.*)$', sql_statement, re.S)
+    if match:
+        updates = re.sub(r'VALUES\((`\w+`)\)', r'excluded.\1', match.group(1))
+        sql_statement = sql_statement[:match.start()] + 'ON CONFLICT (`id`, `time`) DO UPDATE SET ' + updates
+    return sql_statement
+
+
+def _to_mysql_value(value):
+    # MySQL returns DATETIME columns as datetime objects
+    if isinstance(value, str) and DATETIME_PATTERN.match(value):
+        return datetime.strptime(value, DATE_FORMAT)
+    return value
+
+
+class FakeDatabase:
+    """
+    An in-memory SQLite database shared by all the fake connections of one MySQL database
+    """
+
+    def __init__(self, name, schema):
+        self.name = name
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.connection.create_function('UNIX_TIMESTAMP', 1, _unix_timestamp)
+        self.connection.create_function('UNIX_TIMESTAMP', 0, lambda: int(time.time()))
+        self.connection.create_function('GREATEST', -1, _greatest)
+        self.connection.executescript(schema)
+        self.calls = 0
+
+    def execute(self, sql_statement, params=None, many=False):
+        params = [] if params is None else params
+        with self.lock:
+            self.calls += 1
+            if sql_statement.startswith('SET SESSION '):
+                # Session settings (e.g. MAX_EXECUTION_TIME) have no SQLite counterpart
+                return 0, [], []
+            cursor = self.connection.cursor()
+            if many:
+                cursor.executemany(_translate(sql_statement), [list(row) for row in params])
+            else:
+                if not isinstance(params, (list, tuple)):
+                    params = [params]
+                cursor.execute(_translate(sql_statement), list(params))
+            columns = [column[0] for column in cursor.description] if cursor.description else []
+            rows = [tuple(_to_mysql_value(value) for value in row) for row in cursor.fetchall()]
+            return cursor.rowcount, columns, rows
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def rollback(self):
+        with self.lock:
+            self.connection.rollback()
+
+    def reset_calls(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = 0
+            return calls
+
+
+class FakeCursor:
+
+    def __init__(self, database, as_dict):
+        self.database = database
+        self.as_dict = as_dict
+        self.rows = []
+        self.columns = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def execute(self, sql_statement, params=None):
+        self.rowcount, self.columns, self.rows = self.database.execute(sql_statement, params)
+        return self.rowcount
+
+    def executemany(self, sql_statement, params):
+        self.rowcount, self.columns, self.rows = self.database.execute(sql_statement, params, many=True)
+        return self.rowcount
+
+    def _row(self, row):
+        return dict(zip(self.columns, row)) if self.as_dict else row
+
+    def fetchone(self):
+        return self._row(self.rows.pop(0)) if self.rows else None
+
+    def fetchmany(self, size=1):
+        rows = [self._row(row) for row in self.rows[:size]]
+        del self.rows[:size]
+        return rows
+
+    def fetchall(self):
+        rows = [self._row(row) for row in self.rows]
+        self.rows = []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """
+    pymysql connection look alike. Pool connections return dict rows (DictCursor) like the db_adapter pool,
+    MySQLAdapter connections return tuples unless given a cursor class.
+    """
+
+    def __init__(self, database, as_dict):
+        self.database = database
+        self.as_dict = as_dict
+
+    def cursor(self, cursor_class=None):
+        as_dict = self.as_dict if cursor_class is None else 'Dict' in getattr(cursor_class, '__name__', '')
+        return FakeCursor(self.database, as_dict)
+
+    def autocommit(self, value):
+        # SQLite reads aren't snapshot isolated across statements, so there is nothing to switch
+        pass
+
+    def commit(self):
+        self.database.commit()
+
+    def rollback(self):
+        self.database.rollback()
+
+    def ping(self, reconnect=True):
+        return True
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    """
+    DBUtils PooledDB look alike returned by the fake db_adapter.base.get_Pool
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def connection(self):
+        return FakeConnection(self.database, as_dict=True)
+
+    def close(self):
+        pass
+
+
+CURW_IOT = None
+CURW_OBS = None
+
+
+def reset_databases():
+    global CURW_IOT, CURW_OBS
+    CURW_IOT = FakeDatabase('curw_iot', CURW_IOT_SCHEMA)
+    CURW_OBS = FakeDatabase('curw_obs', CURW_OBS_SCHEMA)
+    return CURW_IOT, CURW_OBS
+
+
+def event_id_of(timeseries_meta):
+    """
+    Event id of a curw_iot timeseries: sha256 of its metadata
+    """
+    hash_data = {key: timeseries_meta[key] for key in ('station', 'variable', 'unit', 'type', 'source', 'name')}
+    return hashlib.sha256(json.dumps(hash_data, sort_keys=True).encode('ascii')).hexdigest()
+
+
+# --- curwmysqladapter ---
+
+class TimeseriesGroupOperation(Enum):
+    mysql_5min_max = 1
+    mysql_5min_avg = 2
+
+
+class MySQLAdapter:
+
+    def __init__(self, host=None, user=None, password=None, db=None, port=3306, **kwargs):
+        self.connection = FakeConnection(CURW_IOT, as_dict=False)
+
+    def get_event_id(self, meta_data):
+        event_id = event_id_of(meta_data)
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM `run` WHERE `id`=%s", event_id)
+            return event_id if cursor.fetchone() is not None else None
+
+    def extract_grouped_time_series(self, event_id, start_date, end_date, group_operation):
+        aggregate = 'MAX' if group_operation == TimeseriesGroupOperation.mysql_5min_max else 'AVG'
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(`time`), {}(`value`) FROM `data` WHERE `id`=%s AND `time` >= %s AND "
+                           "`time` <= %s GROUP BY UNIX_TIMESTAMP(`time`) DIV 300 ORDER BY MIN(`time`)"
+                           .format(aggregate), [event_id, start_date, end_date])
+            return [[time.strftime(DATE_FORMAT), value] for time, value in cursor.fetchall()]
+
+    def close(self):
+        pass
+
+
+# --- aiomysql ---
+
+class FakeAsyncCursor:
+
+    def __init__(self, database):
+        self.cursor = FakeCursor(database, as_dict=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.cursor.close()
+
+    async def execute(self, sql_statement, params=None):
+        return self.cursor.execute(sql_statement, params)
+
+    async def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class FakeAsyncConnection:
+
+    def __init__(self, database):
+        self.database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def cursor(self):
+        return FakeAsyncCursor(self.database)
+
+    async def commit(self):
+        self.database.commit()
+
+    async def rollback(self):
+        self.database.rollback()
+
+    def close(self):
+        pass
+
+
+class FakeAsyncPool:
+    """
+    aiomysql pool look alike. Connections of the 'curw_iot' database go to CURW_IOT, the rest to CURW_OBS.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def acquire(self):
+        return FakeAsyncConnection(CURW_IOT if self.db == 'curw_iot' else CURW_OBS)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+async def create_pool(host=None, port=3306, user=None, password=None, db=None, **kwargs):
+    return FakeAsyncPool(db)
+
+
+# --- db_adapter ---
+
+class StationEnum(Enum):
+    CUrW_WeatherStation = 100000
+    CUrW_WaterLevelGauge = 200000
+    CUrW_CrossSection = 300000
+
+    @staticmethod
+    def getType(name):
+        return StationEnum[name]
+
+    @staticmethod
+    def getTypeString(station_type):
+        return station_type.name
+
+
+class UnitType(Enum):
+    Instantaneous = 'Instantaneous'
+    Accumulative = 'Accumulative'
+    Mean = 'Mean'
+
+    @staticmethod
+    def getType(name):
+        return UnitType[name]
+
+
+def _fetch_id(pool, sql_statement, params):
+    with pool.connection().cursor() as cursor:
+        cursor.execute(sql_statement, params)
+        row = cursor.fetchone()
+        return row['id'] if row is not None else None
+
+
+def get_unit_id(pool, unit, unit_type):
+    return _fetch_id(pool, "SELECT `id` FROM `unit` WHERE `unit`=%s AND `type`=%s", [unit, unit_type.name])
+
+
+def add_unit(pool, unit, unit_type):
+    pool.connection().cursor().execute("INSERT INTO `unit` (`unit`, `type`) VALUES (%s, %s)", [unit, unit_type.name])
+
+
+def get_variable_id(pool, variable):
+    return _fetch_id(pool, "SELECT `id` FROM `variable` WHERE `variable`=%s", [variable])
+
+
+def add_variable(pool, variable):
+    pool.connection().cursor().execute("INSERT INTO `variable` (`variable`) VALUES (%s)", [variable])
+
+
+def get_station_id(pool, latitude, longitude, station_type):
+    return _fetch_id(pool, "SELECT `id` FROM `station` WHERE `latitude`=%s AND `longitude`=%s AND `station_type`=%s",
+                     [latitude, longitude, station_type.name])
+
+
+def add_station(pool, name, latitude, longitude, station_type, description=None):
+    pool.connection().cursor().execute(
+        "INSERT INTO `station` (`name`, `latitude`, `longitude`, `station_type`) VALUES (%s, %s, %s, %s)",
+        [name, latitude, longitude, station_type.name])
+
+
+def update_description(pool, id_, description, append=False):
+    pool.connection().cursor().execute("UPDATE `station` SET `description`=%s WHERE `id`=%s", [description, id_])
+
+
+class Timeseries:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @staticmethod
+    def generate_timeseries_id(meta_data):
+        hash_data = {key: meta_data[key] for key in ('latitude', 'longitude', 'station_type', 'variable', 'unit',
+                                                     'unit_type')}
+        return hashlib.sha256(json.dumps(hash_data, sort_keys=True).encode('ascii')).hexdigest()
+
+    def get_timeseries_id_if_exists(self, meta_data):
+        tms_id = self.generate_timeseries_id(meta_data)
+        return _fetch_id(self.pool, "SELECT `id` FROM `run` WHERE `id`=%s", [tms_id])
+
+    def insert_run(self, run_meta):
+        self.pool.connection().cursor().execute(
+            "INSERT INTO `run` (`id`, `station`, `variable`, `unit`) VALUES (%s, %s, %s, %s)",
+            [run_meta['tms_id'], run_meta['station_id'], run_meta['variable_id'], run_meta['unit_id']])
+        return run_meta['tms_id']
+
+    def update_start_date(self, id_, start_date):
+        self.pool.connection().cursor().execute("UPDATE `run` SET `start_date`=%s WHERE `id`=%s", [start_date, id_])
+
+    def get_end_date(self, id_):
+        with self.pool.connection().cursor() as cursor:
+            cursor.execute("SELECT `end_date` FROM `run` WHERE `id`=%s", [id_])
+            row = cursor.fetchone()
+            return row['end_date'] if row is not None else None
+
+    def update_end_date(self, id_, end_date):
+        self.pool.connection().cursor().execute("UPDATE `run` SET `end_date`=%s WHERE `id`=%s", [end_date, id_])
+
+    def insert_data(self, timeseries, upsert=False):
+        sql_statement = "INSERT INTO `data` (`id`, `time`, `value`) VALUES (%s, %s, %s)"
+        if upsert:
+            sql_statement += " ON DUPLICATE KEY UPDATE `value`=VALUES(`value`)"
+        with self.pool.connection().cursor() as cursor:
+            return cursor.executemany(sql_statement, timeseries)
+
+
+def get_Pool(host=None, port=None, user=None, password=None, db=None):
+    return FakePool(CURW_OBS)
+
+
+def destroy_Pool(pool):
+    pool.close()
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """
+    Register the fake curwmysqladapter, aiomysql and db_adapter modules and create empty curw_iot/curw_obs databases
+    """
+    reset_databases()
+    sqlite3.register_adapter(decimal.Decimal, float)
+    sqlite3.register_adapter(datetime, lambda value: value.strftime(DATE_FORMAT))
+
+    _module('curwmysqladapter', MySQLAdapter=MySQLAdapter, TimeseriesGroupOperation=TimeseriesGroupOperation,
+            Station=object, Data=object)
+    _module('aiomysql', create_pool=create_pool)
+    _module('db_adapter')
+    _module('db_adapter.constants', CURW_OBS_HOST='localhost', CURW_OBS_PORT=3306, CURW_OBS_USERNAME='curw',
+            CURW_OBS_PASSWORD='', CURW_OBS_DATABASE='curw_obs')
+    _module('db_adapter.base', get_Pool=get_Pool, destroy_Pool=destroy_Pool)
+    _module('db_adapter.curw_obs')
+    _module('db_adapter.curw_obs.station', StationEnum=StationEnum, get_station_id=get_station_id,
+            add_station=add_station, update_description=update_description)
+    _module('db_adapter.curw_obs.variable', get_variable_id=get_variable_id, add_variable=add_variable)
+    _module('db_adapter.curw_obs.unit', get_unit_id=get_unit_id, add_unit=add_unit, UnitType=UnitType)
+    _module('db_adapter.curw_obs.timeseries', Timeseries=Timeseries)
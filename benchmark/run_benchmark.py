@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+"""
+Offline benchmark of the pusher against local stand-ins of curw_iot and curw_obs (see fakes.py).
+
+Generates synthetic station configs and 1 minute source data (cumulative rain, gauge readings and instantaneous
+weather variables), then times
+ - a full Pusher cycle (cold: hash ids resolved from the DB, warm: served from the cache),
+ - a chunked and a streamed backfill,
+ - optionally, sharded cycles of several pusher nodes (--nodes),
+ - the precipitation and water level processors on their own,
+and reports rows/sec and DB calls per cycle. --async times the asyncio pipeline of AsyncPusher instead.
+
+    python benchmark/run_benchmark.py --stations 67,500,2000
+"""
+import argparse
+import calendar
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import fakes
+
+fakes.install()
+
+import AsyncPusher
+import Pusher
+import Sharding
+from Series import Series
+import Utils
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+WEATHER_VARIABLES = [
+    # variable, unit, unit_type, min, max
+    ('Precipitation', 'mm', 'Accumulative', 0, 120),
+    ('Temperature', 'oC', 'Instantaneous', 0, 40),
+    ('WindSpeed', 'm/s', 'Instantaneous', 0, 30),
+    ('WindDirection', 'degrees', 'Instantaneous', 0, 360),
+    ('Humidity', '%', 'Instantaneous', 0, 100),
+    ('Pressure', 'mmHg', 'Instantaneous', 600, 900)
+]
+
+
+def generate_config(station_count, seed=0):
+    """
+    Synthetic CONFIG with station_count stations, ~80% weather stations and ~20% water level gauges
+    """
+    rand = random.Random(seed)
+    weather_stations = []
+    water_level_stations = []
+    for index in range(station_count):
+        latitude = round(6.0 + rand.random() * 3, 6)
+        longitude = round(79.5 + rand.random() * 2, 6)
+        station = {
+            'stationId': 'bench_station_%d' % index,
+            'name': 'Bench Station %d' % index,
+            'station_meta': ['bench_station_%d' % index, 'Bench Station %d' % index, latitude, longitude, 0, ''],
+            'source': 'WeatherStation',
+            'type': 'Observed',
+            'description': 'Benchmark station %d' % index,
+            'run_name': 'Benchmark'
+        }
+        if index % 5 == 4:
+            station.update({
+                'variables': ['Waterlevel'], 'units': ['m'], 'unit_type': ['Instantaneous'],
+                'max_values': ['30'], 'min_values': ['0'],
+                'mean_sea_level': round(2 + rand.random() * 4, 3), 'min_wl': -1.0, 'max_wl': 3.0
+            })
+            water_level_stations.append(station)
+        else:
+            variables = WEATHER_VARIABLES if index % 5 != 3 else WEATHER_VARIABLES[1:]
+            station.update({
+                'variables': [v[0] for v in variables], 'units': [v[1] for v in variables],
+                'unit_type': [v[2] for v in variables], 'max_values': [str(v[4]) for v in variables],
+                'min_values': [str(v[3]) for v in variables]
+            })
+            weather_stations.append(station)
+
+    return {
+        'extract_from': {'MYSQL_HOST': 'localhost', 'MYSQL_USER': 'curw', 'MYSQL_PASSWORD': '', 'MYSQL_DB': 'curw_iot'},
+        'rollups': sorted(Utils.ROLLUP_REGISTRY),
+        'weather_stations': weather_stations,
+        'water_level_stations': water_level_stations
+    }
+
+
+def generate_source_data(config, start, end, seed=0):
+    """
+    Fill the fake curw_iot with 1 minute readings of every configured series between start and end
+    :return: number of rows generated
+    """
+    rand = random.Random(seed)
+    minutes = int((end - start).total_seconds() // 60)
+    times = [(start + timedelta(minutes=minute)).strftime(DATE_FORMAT) for minute in range(minutes)]
+    rows = 0
+    for station in config['weather_stations'] + config['water_level_stations']:
+        for variable in station['variables']:
+            timeseries_meta = Utils.get_timeseries_meta(station, variable)
+            event_id = fakes.event_id_of(timeseries_meta)
+            fakes.CURW_IOT.execute(
+                "INSERT INTO `run` (`id`, `station`, `variable`, `unit`, `type`, `source`, `name`) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [event_id] + [timeseries_meta[key] for key in ('station', 'variable', 'unit', 'type', 'source',
+                                                                'name')])
+            values = _generate_values(rand, variable, minutes, station.get('mean_sea_level'))
+            fakes.CURW_IOT.execute("INSERT INTO `data` (`id`, `time`, `value`) VALUES (%s, %s, %s)",
+                                   [(event_id, time, value) for time, value in zip(times, values)], many=True)
+            rows += minutes
+    fakes.CURW_IOT.commit()
+    fakes.CURW_IOT.reset_calls()
+    return rows
+
+
+def _generate_values(rand, variable, count, mean_sea_level=None):
+    if variable == 'Precipitation':
+        values = []
+        cumulative = 0.0
+        for _ in range(count):
+            if rand.random() < 0.2:
+                cumulative += round(rand.random() * 2, 2)
+            if rand.random() < 0.001:
+                cumulative = 0.0
+            values.append(cumulative)
+        return values
+    if variable == 'Waterlevel':
+        level = rand.random() * 2
+        return [round(mean_sea_level - level + math.sin(minute / 90.0) * 0.5, 3) for minute in range(count)]
+    bounds = {v[0]: (v[3], v[4]) for v in WEATHER_VARIABLES}.get(variable, (0, 100))
+    return [round(rand.uniform(*bounds), 2) for _ in range(count)]
+
+
+def _count_rows(database, sql_statement):
+    calls = database.calls
+    rows = database.execute(sql_statement)[2][0][0]
+    database.calls = calls
+    return rows
+
+
+def check_rollups(plan):
+    """
+    Check every stored rollup bucket against the aggregate of the raw rows stored in curw_obs for it, and that no
+    bucket holding raw rows is missing. Longer buckets aggregate the shorter buckets of the same aggregate (see
+    Utils.rollup_steps).
+    :param plan: Plan.StationPlan the rows were pushed with
+    :return: number of buckets checked
+    """
+    calls = fakes.CURW_OBS.calls
+    checked = 0
+    for entry in plan.entries:
+        raw_rows = fakes.CURW_OBS.execute("SELECT `time`, `value` FROM `data` WHERE `id`=%s AND `value` IS NOT NULL",
+                                          [entry.obs_hash_id])[2]
+        shorter = {}
+        for rollup in sorted(entry.rollups, key=lambda rollup: rollup.bucket_seconds):
+            buckets = {}
+            for row_time, value in shorter.get(rollup.aggregate, raw_rows):
+                bucket = calendar.timegm(row_time.timetuple()) // rollup.bucket_seconds * rollup.bucket_seconds
+                buckets.setdefault(datetime.utcfromtimestamp(bucket), []).append(value)
+            expected = {bucket: max(values) if rollup.aggregate == 'Max' else
+                        sum(values) / len(values) if rollup.aggregate == 'Mean' else sum(values)
+                        for bucket, values in buckets.items()}
+            shorter[rollup.aggregate] = sorted(expected.items())
+            stored = dict(fakes.CURW_OBS.execute("SELECT `time`, `value` FROM `data` WHERE `id`=%s",
+                                                 [rollup.obs_hash_id])[2])
+            assert set(stored) == set(expected), \
+                "%s rollup of %s has buckets %s, expected %s" % (rollup.aggregate, entry.obs_hash_id,
+                                                                  sorted(stored), sorted(expected))
+            for bucket, value in expected.items():
+                assert math.isclose(stored[bucket], value, rel_tol=1e-9, abs_tol=1e-9), \
+                    "%s rollup of %s at %s is %s, expected %s" % (rollup.aggregate, entry.obs_hash_id, bucket,
+                                                                   stored[bucket], value)
+            checked += len(expected)
+    fakes.CURW_OBS.calls = calls
+    return checked
+
+
+def _new_pusher(config, workers, pusher_class=Pusher.Pusher, node_id=None):
+    work_dir = tempfile.mkdtemp(prefix='pusher_benchmark_')
+    config_path = os.path.join(work_dir, 'CONFIG.json')
+    with open(config_path, 'w') as config_file:
+        json.dump(config, config_file)
+    Pusher.ROOT_DIR = work_dir
+    pool = Pusher.get_Pool()
+    shard_leases = Sharding.ShardLeases(pool, node_id) if node_id is not None else None
+    return pusher_class(pool, config_path, workers=workers, shard_leases=shard_leases), work_dir
+
+
+def _quietly(function, *args, **kwargs):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_cycle(station_count, workers, source_hours, pusher_class=Pusher.Pusher):
+    fakes.reset_databases()
+    config = generate_config(station_count)
+    now = Pusher.utc_to_sl(datetime.now()).replace(tzinfo=None)
+    source_rows = generate_source_data(config, now - timedelta(hours=source_hours), now)
+
+    pusher, work_dir = _new_pusher(config, workers, pusher_class)
+    try:
+        results = []
+        for label in ('cold', 'warm'):
+            start = time.perf_counter()
+            _quietly(pusher.run_cycle)
+            seconds = time.perf_counter() - start
+            results.append({
+                'cycle': label,
+                'seconds': seconds,
+                'curw_iot_calls': fakes.CURW_IOT.reset_calls(),
+                'curw_obs_calls': fakes.CURW_OBS.reset_calls(),
+                'stored_rows': _count_rows(fakes.CURW_OBS, "SELECT COUNT(*) FROM `data`"),
+                'rollup_buckets': check_rollups(pusher.plan)
+            })
+    finally:
+        pusher.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    series_count = sum(len(station['variables'])
+                       for station in config['weather_stations'] + config['water_level_stations'])
+    for result in results:
+        print("cycle    stations=%-5d series=%-6d %-4s %8.3fs  curw_iot calls=%-6d curw_obs calls=%-6d "
+              "stored rows=%d (source rows=%d) rollup buckets checked=%d"
+              % (station_count, series_count, result['cycle'], result['seconds'], result['curw_iot_calls'],
+                 result['curw_obs_calls'], result['stored_rows'], source_rows, result['rollup_buckets']))
+    return results
+
+
+def check_shards(pushers):
+    """
+    Check that no shard is leased to two of the nodes, and that the shards each node pushed are the ones the lease
+    table holds for it
+    :param pushers: Pusher.Pusher nodes which ran in the round
+    """
+    calls = fakes.CURW_OBS.calls
+    leases = dict((shard, node) for shard, node in fakes.CURW_OBS.execute(
+        "SELECT `shard`, `node` FROM `{}` WHERE `expires_at` > UNIX_TIMESTAMP()".format(Sharding.LEASE_TABLE))[2])
+    fakes.CURW_OBS.calls = calls
+    held = {}
+    for pusher in pushers:
+        node_id = pusher.shard_leases.node_id
+        for shard in pusher.shard_leases.shards:
+            assert shard not in held, "shard %d is held by %s and %s" % (shard, held[shard], node_id)
+            assert leases.get(shard) == node_id, \
+                "%s pushed shard %d leased to %r" % (node_id, shard, leases.get(shard))
+            held[shard] = node_id
+
+
+def _expire_leases(node_ids):
+    """
+    Move the leases and heartbeats of node_ids a lease length into the past, as if the nodes stopped renewing them
+    """
+    calls = fakes.CURW_OBS.calls
+    for table in (Sharding.LEASE_TABLE, Sharding.NODE_TABLE):
+        fakes.CURW_OBS.execute("UPDATE `{}` SET `expires_at`=`expires_at`-%s WHERE `node` IN ({})"
+                               .format(table, ', '.join(['%s'] * len(node_ids))),
+                               [Sharding.DEFAULT_LEASE_SECONDS] + list(node_ids))
+    fakes.CURW_OBS.commit()
+    fakes.CURW_OBS.calls = calls
+
+
+def bench_sharded_cycle(station_count, workers, source_hours, node_count, pusher_class=Pusher.Pusher):
+    """
+    Cycles of node_count sharded pushers taking turns against the same databases: the first rounds show the shards
+    spreading over the nodes, the last ones the shards of a released node, then of nodes whose leases expired, failing
+    over to the rest. Every round checks that no shard is held by two nodes and that every series is pushed exactly
+    once.
+    """
+    fakes.reset_databases()
+    config = generate_config(station_count)
+    now = Pusher.utc_to_sl(datetime.now()).replace(tzinfo=None)
+    generate_source_data(config, now - timedelta(hours=source_hours), now)
+
+    nodes = [_new_pusher(config, workers, pusher_class, node_id='node%d' % index) for index in range(node_count)]
+    try:
+        rounds = [('join', nodes), ('balance', nodes), ('steady', nodes)]
+        if node_count > 1:
+            # The released node comes back last, so the nodes holding its shards meanwhile keep them for this round.
+            rounds += [('release', nodes[1:]), ('rejoin', nodes[1:] + nodes[:1]), ('expiry', nodes[:1])]
+        for label, round_nodes in rounds:
+            if label == 'release':
+                nodes[0][0].shard_leases.release()
+            elif label == 'expiry':
+                _expire_leases([pusher.shard_leases.node_id for pusher, _ in nodes[1:]])
+            start = time.perf_counter()
+            pushed = {}
+            series = []
+            for pusher, _ in round_nodes:
+                Pusher.ROOT_DIR = os.path.dirname(pusher.config_path)
+                _quietly(pusher.run_cycle)
+                owned = [entry.obs_hash_id for entry in pusher.plan.entries
+                         if pusher.shard_leases.owns(entry.obs_hash_id)]
+                for obs_hash_id in owned:
+                    pushed[obs_hash_id] = pushed.get(obs_hash_id, 0) + 1
+                series.append(len(owned))
+            seconds = time.perf_counter() - start
+            check_shards([pusher for pusher, _ in round_nodes])
+            entries = nodes[0][0].plan.entries
+            assert all(pushed.get(entry.obs_hash_id) == 1 for entry in entries), \
+                "%s round pushed %d of %d series, %d of them more than once" \
+                % (label, len(pushed), len(entries), sum(1 for count in pushed.values() if count > 1))
+            print("sharded  stations=%-5d nodes=%-3d %-8s %8.3fs  series per node=%s  curw_iot calls=%-6d "
+                  "stored rows=%d"
+                  % (station_count, len(round_nodes), label, seconds, series, fakes.CURW_IOT.reset_calls(),
+                     _count_rows(fakes.CURW_OBS, "SELECT COUNT(*) FROM `data`")))
+    finally:
+        for pusher, work_dir in nodes:
+            pusher.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_backfill(station_count, workers, days, chunk_hours, pusher_class=Pusher.Pusher, stream=False):
+    fakes.reset_databases()
+    config = generate_config(station_count)
+    end = datetime(2019, 7, 1)
+    start = end - timedelta(days=days)
+    source_rows = generate_source_data(config, start, end)
+
+    pusher, work_dir = _new_pusher(config, workers, pusher_class)
+    try:
+        started = time.perf_counter()
+        _quietly(pusher.run_backfill, start, end, chunk_hours, stream=stream)
+        seconds = time.perf_counter() - started
+        rollup_buckets = check_rollups(pusher.plan)
+    finally:
+        pusher.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    stored_rows = _count_rows(fakes.CURW_OBS, "SELECT COUNT(*) FROM `data`")
+    print("backfill stations=%-5d days=%-3d %-9s %8.3fs  %10.0f source rows/s  curw_iot calls=%-6d "
+          "curw_obs calls=%-6d stored rows=%d rollup buckets checked=%d"
+          % (station_count, days, 'streamed' if stream else 'chunk=%dh' % chunk_hours, seconds, source_rows / seconds,
+             fakes.CURW_IOT.reset_calls(), fakes.CURW_OBS.reset_calls(), stored_rows, rollup_buckets))
+
+
+def bench_processors(rows, repeat):
+    rand = random.Random(1)
+    start = datetime(2019, 7, 1)
+    times = []
+    current = start
+    for _ in range(rows):
+        # mostly 5 minute steps with the odd gap
+        current += timedelta(minutes=rand.choice([5] * 20 + [10, 15, 30, 65]))
+        times.append(current.strftime(DATE_FORMAT))
+    cumulative = _generate_values(rand, 'Precipitation', rows)
+    readings = _generate_values(rand, 'Waterlevel', rows, mean_sea_level=4.0)
+
+    for name, processor, values, kwargs in (
+            ('precipitation', Utils._precipitation_timeseries_processor, cumulative, {}),
+            ('waterlevel', Utils._waterlevel_timeseries_processor, readings,
+             {'mean_sea_level': 4.0, 'waterLevel_min': -1.0, 'waterLevel_max': 3.0})):
+        best = None
+        for _ in range(repeat):
+            timeseries = Series.from_rows([[time, value] for time, value in zip(times, values)])
+            started = time.perf_counter()
+            _quietly(processor, timeseries, **kwargs)
+            seconds = time.perf_counter() - started
+            best = seconds if best is None else min(best, seconds)
+        print("process  %-13s rows=%-8d %8.3fs  %10.0f rows/s" % (name, rows, best, rows / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline pusher benchmark with local curw_iot/curw_obs stand-ins.')
+    parser.add_argument('--stations', default='67,500',
+                        help='Comma separated station counts to time a cycle with. Default is 67,500.')
+    parser.add_argument('--workers', type=int, default=Pusher.DEFAULT_WORKERS,
+                        help='Pusher worker count. Default is %d.' % Pusher.DEFAULT_WORKERS)
+    parser.add_argument('--source-hours', type=int, default=2,
+                        help='Hours of 1 minute source data generated for the cycle benchmark. Default is 2.')
+    parser.add_argument('--backfill-stations', type=int, default=10,
+                        help='Station count of the backfill benchmark. 0 skips it. Default is 10.')
+    parser.add_argument('--backfill-days', type=int, default=7, help='Backfill range in days. Default is 7.')
+    parser.add_argument('--chunk-hours', type=int, default=Pusher.DEFAULT_CHUNK_HOURS,
+                        help='Backfill chunk size in hours. Default is %d.' % Pusher.DEFAULT_CHUNK_HOURS)
+    parser.add_argument('--processor-rows', type=int, default=100000,
+                        help='Rows per processor benchmark. 0 skips it. Default is 100000.')
+    parser.add_argument('--repeat', type=int, default=3, help='Processor benchmark repetitions. Default is 3.')
+    parser.add_argument('--nodes', type=int, default=0,
+                        help='Also time sharded cycles of this many pusher nodes. 0 skips it. Default is 0.')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Time the asyncio pipeline (AsyncPusher) instead of Pusher.')
+    args = parser.parse_args()
+
+    pusher_class = AsyncPusher.AsyncPusher if args.use_async else Pusher.Pusher
+    for station_count in [int(count) for count in args.stations.split(',') if count.strip()]:
+        bench_cycle(station_count, args.workers, args.source_hours, pusher_class)
+        if args.nodes > 0:
+            bench_sharded_cycle(station_count, args.workers, args.source_hours, args.nodes, pusher_class)
+    if args.backfill_stations > 0:
+        bench_backfill(args.backfill_stations, args.workers, args.backfill_days, args.chunk_hours, pusher_class)
+        bench_backfill(args.backfill_stations, args.workers, args.backfill_days, args.chunk_hours, pusher_class,
+                       stream=True)
+    if args.processor_rows > 0:
+        bench_processors(args.processor_rows, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
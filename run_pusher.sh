@@ -13,11 +13,17 @@ fi
 echo "Activating venv python3 virtual environment."
 source venv/bin/activate
 
-# Install dependencies using pip.
+# Install dependencies using pip whenever requirements.txt changed since the last install (tracked by its sha256 in
+# venv/), so dependencies added by an upgrade are installed on existing deployments too without running pip on
+# every start.
+requirements_hash=`sha256sum requirements.txt | cut -d ' ' -f 1`
+if [ "$requirements_hash" != "`cat venv/.requirements.sha256 2>/dev/null`" ]
+then
+    echo "Installing requirements"
+    pip3 install -r requirements.txt && echo "$requirements_hash" > venv/.requirements.sha256
+fi
 if [ ! -f "pusher.log" ]
 then
-    echo "Installing pytz"
-    pip3 install pytz
     echo "Installing mysqladapter"
     pip3 install git+https://github.com/gihankarunarathne/CurwMySQLAdapter.git
     echo "Installing db adapter"
@@ -0,0 +1,36 @@
+#!/usr/bin/env bash
+cd /home/uwcc-admin/Data-Pusher-Obs
+echo "Inside `pwd`"
+
+# If no venv (python3 virtual environment) exists, then create one.
+if [ ! -d "venv" ]
+then
+    echo "Creating venv python3 virtual environment."
+    virtualenv -p python3 venv
+fi
+
+# Activate venv.
+echo "Activating venv python3 virtual environment."
+source venv/bin/activate
+
+# Install dependencies using pip whenever requirements.txt changed since the last install (tracked by its sha256 in
+# venv/), so dependencies added by an upgrade are installed on existing deployments too without running pip on
+# every start.
+requirements_hash=`sha256sum requirements.txt | cut -d ' ' -f 1`
+if [ "$requirements_hash" != "`cat venv/.requirements.sha256 2>/dev/null`" ]
+then
+    echo "Installing requirements"
+    pip3 install -r requirements.txt && echo "$requirements_hash" > venv/.requirements.sha256
+fi
+if [ ! -f "pusher.log" ]
+then
+    echo "Installing mysqladapter"
+    pip3 install git+https://github.com/gihankarunarathne/CurwMySQLAdapter.git
+    echo "Installing db adapter"
+    pip3 install git+https://github.com/shadhini/curw_db_adapter.git
+fi
+
+# Runs Pusher.py as a long running daemon pushing every 5 minutes. Use instead of the run_pusher.sh cron entry.
+# Stop with SIGTERM (e.g. kill <pid>); the current cycle completes before exiting.
+echo "Running Pusher.py in daemon mode. Logs Available in pusher.log file."
+exec python Pusher.py --daemon --interval 300 >> pusher.log 2>&1